@@ -7,16 +7,29 @@ Run: streamlit run app.py
 """
 
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import plotly.express as px
 import plotly.graph_objects as go
 import pandas as pd
+import numpy as np
 import psycopg2
-from psycopg2.extras import RealDictCursor
+import psycopg2.pool
+import psycopg2.extensions
+import psycopg2.errorcodes
 import os
+import re
+import string
+import hashlib
+import weakref
+import threading
 import requests
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
 from datetime import datetime
+from types import MappingProxyType
 from urllib.parse import urlencode
 import io
+import gzip
 
 # =============================================================================
 # GITHUB REPO FOR ISSUES/CONTACT
@@ -30,7 +43,8 @@ MATOMO_URL = os.getenv("MATOMO_URL", "")        # Optional: set via environment
 # JAPANESE REAL ESTATE TERM TOOLTIPS
 # =============================================================================
 
-TOOLTIPS = {
+# Read-only: the same strings are handed to widget help= on every rerun.
+TOOLTIPS = MappingProxyType({
     "tsubo": "Tsubo (坪) is a traditional Japanese unit of area. 1 tsubo ≈ 3.31 m² ≈ 35.58 sq ft. Common in real estate listings.",
     "ldk": "Japanese floor plan notation: L=Living room, D=Dining room, K=Kitchen. Example: 2LDK = 2 bedrooms + Living/Dining/Kitchen area.",
     "mansion": "In Japan, 'mansion' (マンション) refers to a concrete apartment/condo building, not a large house.",
@@ -40,7 +54,7 @@ TOOLTIPS = {
     "building_age": "Years since construction. Older buildings typically depreciate, but location and maintenance matter.",
     "coverage_ratio": "Building Coverage Ratio (建蔽率): Max % of land that can be covered by buildings. Set by zoning.",
     "floor_area_ratio": "Floor Area Ratio (容積率): Max total floor area as % of land area. Higher = taller buildings allowed.",
-}
+})
 
 # =============================================================================
 # CONSTANTS
@@ -89,27 +103,32 @@ def get_matomo_visitors():
         return None
 
 
+def _format_range(value):
+    return f"{value[0]}-{value[1]}"
+
+# (filter key, URL parameter, formatter) for the filters a share URL preserves
+SHARE_URL_SPEC = (
+    ('prefecture_code', 'pref', str),
+    ('municipality_codes', 'muni', ','.join),
+    ('districts', 'dist', ','.join),
+    ('property_types', 'prop', ','.join),
+    ('year_range', 'yr', _format_range),
+    ('building_year_range', 'byr', _format_range),
+    ('area_range', 'area', _format_range),
+    ('price_range', 'price', _format_range),
+)
+
+
 def generate_share_url(filters, tab_name, display_options=None, base_url=None):
     """Generate a shareable URL with all current filter values."""
     params = {"tab": tab_name}
 
     # Add non-None filter values
-    if filters.get('prefecture_code'):
-        params['pref'] = filters['prefecture_code']
-    if filters.get('municipality_codes'):
-        params['muni'] = ','.join(filters['municipality_codes'])
-    if filters.get('districts'):
-        params['dist'] = ','.join(filters['districts'])
-    if filters.get('property_types'):
-        params['prop'] = ','.join(filters['property_types'])
-    if filters.get('year_range'):
-        params['yr'] = f"{filters['year_range'][0]}-{filters['year_range'][1]}"
-    if filters.get('building_year_range'):
-        params['byr'] = f"{filters['building_year_range'][0]}-{filters['building_year_range'][1]}"
-    if filters.get('area_range'):
-        params['area'] = f"{filters['area_range'][0]}-{filters['area_range'][1]}"
-    if filters.get('price_range'):
-        params['price'] = f"{filters['price_range'][0]}-{filters['price_range'][1]}"
+    params.update({
+        param: fmt(value)
+        for key, param, fmt in SHARE_URL_SPEC
+        if (value := filters.get(key))
+    })
 
     # Add display options
     if display_options:
@@ -126,83 +145,75 @@ def generate_share_url(filters, tab_name, display_options=None, base_url=None):
     return f"?{query_string}"
 
 
-def generate_valuation_pdf(valuation_data):
-    """Generate a PDF report for property valuation."""
-    # Create HTML content for the report
-    html_content = f"""
+# Valuation report: static CSS and frame are parsed once at import; each report
+# only formats its values and substitutes them. Fixed table layout keeps print
+# rendering linear in the number of rows.
+VALUATION_REPORT_CSS = """
+            body { font-family: Arial, sans-serif; margin: 40px; line-height: 1.6; }
+            .header { text-align: center; border-bottom: 2px solid #333; padding-bottom: 20px; margin-bottom: 30px; }
+            .header h1 { color: #2E86AB; margin-bottom: 5px; }
+            .section { margin-bottom: 25px; }
+            .section h2 { color: #333; border-bottom: 1px solid #ddd; padding-bottom: 5px; }
+            table { width: 100%; border-collapse: collapse; margin: 15px 0; table-layout: fixed; }
+            th, td { padding: 10px; text-align: left; border-bottom: 1px solid #ddd; }
+            th { background-color: #f5f5f5; width: 40%; }
+            .highlight { background-color: #e8f4f8; font-weight: bold; }
+            .verdict { font-size: 1.3em; padding: 15px; border-radius: 8px; text-align: center; margin: 20px 0; }
+            .verdict.good { background-color: #d4edda; color: #155724; }
+            .verdict.fair { background-color: #fff3cd; color: #856404; }
+            .verdict.high { background-color: #f8d7da; color: #721c24; }
+            .footer { margin-top: 40px; padding-top: 20px; border-top: 1px solid #ddd; font-size: 0.9em; color: #666; }
+            .disclaimer { font-size: 0.8em; color: #999; margin-top: 30px; }
+            @media print { body { margin: 20px; } }
+"""
+
+VALUATION_REPORT_TEMPLATE = string.Template("""
     <!DOCTYPE html>
     <html>
     <head>
         <meta charset="UTF-8">
         <title>Property Valuation Report</title>
-        <style>
-            body {{ font-family: Arial, sans-serif; margin: 40px; line-height: 1.6; }}
-            .header {{ text-align: center; border-bottom: 2px solid #333; padding-bottom: 20px; margin-bottom: 30px; }}
-            .header h1 {{ color: #2E86AB; margin-bottom: 5px; }}
-            .section {{ margin-bottom: 25px; }}
-            .section h2 {{ color: #333; border-bottom: 1px solid #ddd; padding-bottom: 5px; }}
-            table {{ width: 100%; border-collapse: collapse; margin: 15px 0; }}
-            th, td {{ padding: 10px; text-align: left; border-bottom: 1px solid #ddd; }}
-            th {{ background-color: #f5f5f5; }}
-            .highlight {{ background-color: #e8f4f8; font-weight: bold; }}
-            .verdict {{ font-size: 1.3em; padding: 15px; border-radius: 8px; text-align: center; margin: 20px 0; }}
-            .verdict.good {{ background-color: #d4edda; color: #155724; }}
-            .verdict.fair {{ background-color: #fff3cd; color: #856404; }}
-            .verdict.high {{ background-color: #f8d7da; color: #721c24; }}
-            .footer {{ margin-top: 40px; padding-top: 20px; border-top: 1px solid #ddd; font-size: 0.9em; color: #666; }}
-            .disclaimer {{ font-size: 0.8em; color: #999; margin-top: 30px; }}
-            @media print {{ body {{ margin: 20px; }} }}
-        </style>
+        <style>""" + VALUATION_REPORT_CSS + """        </style>
     </head>
     <body>
         <div class="header">
             <h1>🏠 Property Valuation Report</h1>
-            <p>Generated on {datetime.now().strftime('%Y-%m-%d %H:%M')}</p>
+            <p>Generated on $generated_on</p>
         </div>
 
         <div class="section">
             <h2>Property Details</h2>
             <table>
-                <tr><th>Location</th><td>{valuation_data.get('location', 'N/A')}</td></tr>
-                <tr><th>District</th><td>{valuation_data.get('district', 'N/A')}</td></tr>
-                <tr><th>Property Type</th><td>{valuation_data.get('property_type', 'N/A')}</td></tr>
-                <tr><th>Area</th><td>{valuation_data.get('area', 0):.1f} m² ({valuation_data.get('area', 0) * M2_TO_TSUBO:.1f} tsubo)</td></tr>
-                <tr><th>Year Built</th><td>{valuation_data.get('building_year', 'N/A')}</td></tr>
-                <tr><th>Building Age</th><td>{valuation_data.get('building_age', 'N/A')} years</td></tr>
-                <tr><th>Layout</th><td>{valuation_data.get('floor_plan', 'N/A')}</td></tr>
+                <tr><th>Location</th><td>$location</td></tr>
+                <tr><th>District</th><td>$district</td></tr>
+                <tr><th>Property Type</th><td>$property_type</td></tr>
+                <tr><th>Area</th><td>$area m² ($area_tsubo tsubo)</td></tr>
+                <tr><th>Year Built</th><td>$building_year</td></tr>
+                <tr><th>Building Age</th><td>$building_age years</td></tr>
+                <tr><th>Layout</th><td>$floor_plan</td></tr>
             </table>
         </div>
 
         <div class="section">
             <h2>Valuation Summary</h2>
-            <div class="verdict {valuation_data.get('verdict_class', 'fair')}">
-                {valuation_data.get('verdict', 'Fair Price')}
+            <div class="verdict $verdict_class">
+                $verdict
             </div>
             <table>
-                <tr class="highlight"><th>Estimated Market Value</th><td>¥{valuation_data.get('estimated_value', 0):,.0f}</td></tr>
-                <tr><th>Low Estimate</th><td>¥{valuation_data.get('low_estimate', 0):,.0f}</td></tr>
-                <tr><th>High Estimate</th><td>¥{valuation_data.get('high_estimate', 0):,.0f}</td></tr>
-                <tr><th>Median Price per m²</th><td>¥{valuation_data.get('median_price_m2', 0):,.0f}</td></tr>
-                <tr><th>Comparable Transactions</th><td>{valuation_data.get('comparable_count', 0)}</td></tr>
+                <tr class="highlight"><th>Estimated Market Value</th><td>¥$estimated_value</td></tr>
+                <tr><th>Low Estimate</th><td>¥$low_estimate</td></tr>
+                <tr><th>High Estimate</th><td>¥$high_estimate</td></tr>
+                <tr><th>Median Price per m²</th><td>¥$median_price_m2</td></tr>
+                <tr><th>Comparable Transactions</th><td>$comparable_count</td></tr>
             </table>
         </div>
 
-        {f'''
-        <div class="section">
-            <h2>Listing Analysis</h2>
-            <table>
-                <tr><th>Listing Price</th><td>¥{valuation_data.get('listing_price', 0):,.0f}</td></tr>
-                <tr><th>Listing Price per m²</th><td>¥{valuation_data.get('listing_price_m2', 0):,.0f}</td></tr>
-                <tr><th>Difference from Market</th><td>¥{valuation_data.get('price_diff', 0):+,.0f} ({valuation_data.get('price_diff_pct', 0):+.1f}%)</td></tr>
-                <tr><th>Price Percentile</th><td>{valuation_data.get('percentile', 0):.0f}%</td></tr>
-            </table>
-        </div>
-        ''' if valuation_data.get('listing_price') else ''}
+        $listing_section
 
         <div class="section">
             <h2>Market Context</h2>
-            <p>This valuation is based on <strong>{valuation_data.get('comparable_count', 0)}</strong> comparable
-            transactions in <strong>{valuation_data.get('location', 'the selected area')}</strong> from the
+            <p>This valuation is based on <strong>$comparable_count</strong> comparable
+            transactions in <strong>$context_location</strong> from the
             past 3 years, filtered by similar property characteristics.</p>
         </div>
 
@@ -214,12 +225,66 @@ def generate_valuation_pdf(valuation_data):
 
         <div class="footer">
             <p>Data source: MLIT Real Estate Information Library (国土交通省不動産情報ライブラリ)</p>
-            <p>Report generated by Japan Real Estate Analytics | <a href="{GITHUB_REPO_URL}">{GITHUB_REPO_URL}</a></p>
+            <p>Report generated by Japan Real Estate Analytics | <a href="$repo_url">$repo_url</a></p>
         </div>
     </body>
     </html>
+    """)
+
+VALUATION_LISTING_TEMPLATE = string.Template("""
+        <div class="section">
+            <h2>Listing Analysis</h2>
+            <table>
+                <tr><th>Listing Price</th><td>¥$listing_price</td></tr>
+                <tr><th>Listing Price per m²</th><td>¥$listing_price_m2</td></tr>
+                <tr><th>Difference from Market</th><td>¥$price_diff ($price_diff_pct%)</td></tr>
+                <tr><th>Price Percentile</th><td>$percentile%</td></tr>
+            </table>
+        </div>
+        """)
+
+
+def generate_valuation_pdf(valuation_data):
+    """
+    Generate a printable report for property valuation.
+
+    Returns HTML; the user's browser turns it into a PDF (Print -> Save as PDF), so no
+    rasterization runs on the server and nothing here blocks the script thread.
     """
-    return html_content
+    get = valuation_data.get
+    area = get('area', 0)
+
+    listing_section = ''
+    if get('listing_price'):
+        listing_section = VALUATION_LISTING_TEMPLATE.substitute(
+            listing_price=f"{get('listing_price', 0):,.0f}",
+            listing_price_m2=f"{get('listing_price_m2', 0):,.0f}",
+            price_diff=f"{get('price_diff', 0):+,.0f}",
+            price_diff_pct=f"{get('price_diff_pct', 0):+.1f}",
+            percentile=f"{get('percentile', 0):.0f}",
+        )
+
+    return VALUATION_REPORT_TEMPLATE.substitute(
+        generated_on=datetime.now().strftime('%Y-%m-%d %H:%M'),
+        location=get('location', 'N/A'),
+        district=get('district', 'N/A'),
+        property_type=get('property_type', 'N/A'),
+        area=f"{area:.1f}",
+        area_tsubo=f"{area * M2_TO_TSUBO:.1f}",
+        building_year=get('building_year', 'N/A'),
+        building_age=get('building_age', 'N/A'),
+        floor_plan=get('floor_plan', 'N/A'),
+        verdict_class=get('verdict_class', 'fair'),
+        verdict=get('verdict', 'Fair Price'),
+        estimated_value=f"{get('estimated_value', 0):,.0f}",
+        low_estimate=f"{get('low_estimate', 0):,.0f}",
+        high_estimate=f"{get('high_estimate', 0):,.0f}",
+        median_price_m2=f"{get('median_price_m2', 0):,.0f}",
+        comparable_count=get('comparable_count', 0),
+        listing_section=listing_section,
+        context_location=get('location', 'the selected area'),
+        repo_url=GITHUB_REPO_URL,
+    )
 
 # =============================================================================
 # CONFIG
@@ -239,6 +304,37 @@ st.set_page_config(
 # Tab state management via query params
 TAB_NAMES = ["charts", "map", "cohorts", "micro", "valuation", "insights", "data", "quality"]
 TAB_LABELS = ["📈 Charts", "🗺️ Map", "📊 Cohorts", "📍 District", "💰 Valuation", "🔭 Insights", "📋 Raw Data", "⚠️ Data Quality"]
+SUMMARY_FREE_TABS = frozenset({"valuation", "insights"})
+
+CURRENCY_SYMBOLS = MappingProxyType({"JPY": "¥", "USD": "$", "EUR": "€", "GBP": "£"})
+PRICE_FORMATTERS = MappingProxyType({code: f"{symbol}{{:,.0f}}".format for code, symbol in CURRENCY_SYMBOLS.items()})
+
+# Check Listing verdicts by listing-vs-fair-value difference (%): a difference below
+# thresholds[i] (and not below the previous one) gets verdicts[i]; the last applies from 15%.
+# Each is (icon, verdict, detail, report CSS class).
+LISTING_VERDICT_THRESHOLDS = np.array([-15, -5, 5, 15])
+LISTING_VERDICTS = (
+    ("🟢", "**UNDERPRICED**", "This listing appears significantly below market value", "good"),
+    ("🟢", "**GOOD VALUE**", "This listing appears below market average", "good"),
+    ("🟡", "**FAIR PRICE**", "This listing is priced around market value", "fair"),
+    ("🟠", "**ABOVE MARKET**", "This listing is priced above market average", "fair"),
+    ("🔴", "**OVERPRICED**", "This listing appears significantly above market value", "high"),
+)
+
+# Comparables needed before Estimate Value / Check Listing show the distribution and report
+MIN_COMPARABLES_FOR_REPORT = 20
+
+# Track Depreciation trend chart layout, built once rather than per render
+DEPRECIATION_CHART_LAYOUT = go.Layout(
+    title='Median Price/m² Over Time',
+    xaxis_title='Year',
+    yaxis_title='¥/m²',
+    yaxis_tickformat=',',
+    height=350
+)
+
+# Multiselects get sluggish past a few hundred options; beyond this users search instead
+MAX_DISTRICT_OPTIONS = 100
 
 INSIGHT_CHOICES = {
     "🔧 Renovation Premium Crossover":        "renovation",
@@ -275,16 +371,174 @@ def on_tab_change():
 # DATABASE
 # =============================================================================
 
+# NUMERIC results (AVG, ROUND, DECIMAL columns) arrive as floats rather than Decimal
+# objects, so pandas gets float64 columns instead of object columns to convert later.
+NUMERIC_AS_FLOAT = psycopg2.extensions.new_type(
+    psycopg2.extensions.DECIMAL.values,
+    'NUMERIC_AS_FLOAT',
+    lambda value, cur: float(value) if value is not None else None,
+)
+psycopg2.extensions.register_type(NUMERIC_AS_FLOAT)
+
+POOL_MAX_CONNECTIONS = 16
+
+@st.cache_resource
+def get_pool():
+    """Connection pool shared by all sessions (lives in the resource cache because Streamlit re-executes the module)."""
+    return psycopg2.pool.ThreadedConnectionPool(1, POOL_MAX_CONNECTIONS, DATABASE_URL)
+
 @st.cache_resource
+def get_pool_slots():
+    """
+    One permit per pooled connection. ThreadedConnectionPool.getconn raises as soon as
+    the pool is exhausted; taking a permit first makes callers queue instead.
+    """
+    return threading.BoundedSemaphore(POOL_MAX_CONNECTIONS)
+
+@st.cache_resource
+def get_statement_registry():
+    """Server-side prepared statements, tracked per pooled connection, plus queries the server refused to prepare."""
+    return {"prepared": weakref.WeakKeyDictionary(), "unpreparable": set()}
+
+@contextmanager
 def get_connection():
-    return psycopg2.connect(DATABASE_URL)
+    pool = get_pool()
+    slots = get_pool_slots()
+    slots.acquire()
+    try:
+        conn = pool.getconn()
+    except Exception:
+        slots.release()
+        raise
+    broken = False
+    try:
+        conn.autocommit = True  # read-only dashboard: a failed query must not leave the connection aborted
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        # Drop dead connections (server restart, network drop) instead of handing them
+        # to the next query
+        pool.putconn(conn, close=broken or bool(conn.closed))
+        slots.release()
+
+def execute_prepared(cur, query, params):
+    """
+    Execute a query through a server-side prepared statement so Postgres reuses the plan.
 
-@st.cache_data(ttl=3600)
+    Statements are named after a hash of the query text and prepared lazily on each
+    connection. Queries the server refuses to PREPARE (e.g. untyped NULL parameters)
+    fall back to a plain execute and are not prepared again; errors while executing
+    (timeouts, dropped connections) propagate without a retry.
+    """
+    params = tuple(params or ())
+    registry = get_statement_registry()
+    if '%%' in query or query.count('%s') != len(params) or query in registry["unpreparable"]:
+        cur.execute(query, params)
+        return
+
+    name = "q_" + hashlib.md5(query.encode()).hexdigest()[:16]
+    prepared = registry["prepared"].setdefault(cur.connection, set())
+    for attempt in range(2):
+        if name not in prepared:
+            placeholders = iter(range(1, len(params) + 1))
+            try:
+                cur.execute(f"PREPARE {name} AS " + re.sub(r"%s", lambda _: f"${next(placeholders)}", query))
+            except psycopg2.ProgrammingError as e:
+                if e.pgcode == psycopg2.errorcodes.DUPLICATE_PREPARED_STATEMENT:
+                    pass  # prepared on this connection before the registry was reset
+                elif (e.pgcode or "").startswith("42"):  # syntax error or access rule violation
+                    registry["unpreparable"].add(query)
+                    cur.execute(query, params)
+                    return
+                else:
+                    raise
+            prepared.add(name)
+        try:
+            if params:
+                cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+            else:
+                cur.execute(f"EXECUTE {name}")
+            return
+        except psycopg2.Error as e:
+            # The server forgot the statement (DISCARD ALL, restart behind a pooler):
+            # prepare it again once
+            if e.pgcode != psycopg2.errorcodes.INVALID_SQL_STATEMENT_NAME or attempt:
+                raise
+            prepared.discard(name)
+
+# Every result is memoized on (query, params), so reruns that repeat a query (valuation
+# lookups, tab switches) skip the database. Bounded so one-off parameter combinations
+# cannot grow the cache without limit.
+@st.cache_data(ttl=3600, max_entries=512)
 def run_query(query, params=None):
-    conn = get_connection()
-    with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute(query, params or ())
-        return pd.DataFrame(cur.fetchall())
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            execute_prepared(cur, query, params)
+            columns = [d.name for d in cur.description]
+            return _shrink(pd.DataFrame.from_records(cur.fetchall(), columns=columns))
+
+def run_query_copy(query, params=None, dtype=None):
+    """
+    Fetch a large result through COPY ... TO STDOUT as CSV, parsed by pandas' C reader.
+
+    Skips psycopg2 building a Python tuple per row. Meant for the in-process row caches
+    that pull a whole prefecture; not memoized here, since those callers cache the frame
+    themselves and a second copy in run_query's cache would only double the memory.
+    """
+    buffer = io.BytesIO()
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            copy_sql = cur.mogrify(f"COPY ({query}) TO STDOUT WITH (FORMAT CSV, HEADER TRUE)", params)
+            cur.copy_expert(copy_sql.decode(), buffer)
+    buffer.seek(0)
+    return pd.read_csv(buffer, dtype=dtype)
+
+def _shrink(df):
+    """
+    Downcast int64 columns that fit into int32, halving what the cache pickles and
+    plotly ships. int32 is the floor so counts and prices cannot silently overflow in
+    later arithmetic.
+    """
+    int32 = np.iinfo(np.int32)
+    for col in df.select_dtypes(include='int64').columns:
+        values = df[col]
+        if values.min() >= int32.min and values.max() <= int32.max:
+            df[col] = values.astype(np.int32)
+    return df
+
+@st.cache_resource
+def get_query_executor():
+    """Worker threads for queries that keep running while a preview is already on screen."""
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="query")
+
+def run_query_async(query, params=None):
+    """Submit run_query to the background executor and return a Future of its DataFrame."""
+    ctx = get_script_run_ctx()
+
+    def task():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return run_query(query, params)
+
+    return get_query_executor().submit(task)
+
+class FilterSet(dict):
+    """
+    The sidebar filters dict. Cached functions hash it through cache_key(), which is
+    computed once per rerun instead of Streamlit walking the nested dict on every call.
+    """
+
+    def cache_key(self):
+        key = self.__dict__.get('_cache_key')
+        if key is None:
+            key = self._cache_key = tuple(sorted(
+                (name, tuple(sorted(value)) if isinstance(value, list) else value)
+                for name, value in self.items()
+            ))
+        return key
+
+FILTER_HASH_FUNCS = {FilterSet: FilterSet.cache_key}
 
 def get_data_quality_filter(quality_mode="exclude_critical"):
     """
@@ -326,30 +580,54 @@ def build_location_clause(prefecture_code, municipality_codes):
             params.append(municipality_codes)
     return clause, params
 
-@st.cache_data(ttl=3600)
-def get_prefectures():
-    return run_query("""
-        SELECT DISTINCT p.code, p.name_en
-        FROM prefectures p
-        JOIN transactions t ON t.prefecture_code = p.code
-        ORDER BY p.code
+# Reference data changes only when new data is loaded, so it lives in the resource
+# cache (no per-hit pickling, no TTL) as immutable tuples and is cleared explicitly
+# via the sidebar "Refresh reference data" button.
+
+@st.cache_resource
+def get_bootstrap_refdata():
+    """
+    Fetch every prefecture-independent dropdown list and slider range in one round trip.
+
+    Reads the mv_filter_options / mv_year_ranges rollups rather than scanning
+    transactions once per list.
+    """
+    result = run_query("""
+        WITH opts AS (
+            SELECT filter_type, code, name
+            FROM mv_filter_options
+            WHERE name IS NOT NULL AND name != ''
+        )
+        SELECT
+            (SELECT json_agg(json_build_array(name, code) ORDER BY code)
+             FROM opts WHERE filter_type = 'prefecture') as prefectures,
+            (SELECT json_agg(name ORDER BY name) FROM opts WHERE filter_type = 'property_type') as property_types,
+            (SELECT json_agg(name ORDER BY name) FROM opts WHERE filter_type = 'structure') as structures,
+            (SELECT json_agg(name ORDER BY name) FROM opts WHERE filter_type = 'floor_plan') as floor_plans,
+            y.min_transaction_year, y.max_transaction_year,
+            y.min_building_year, y.max_building_year
+        FROM mv_year_ranges y
     """)
+    row = result.iloc[0]
+    return MappingProxyType({
+        'prefectures': MappingProxyType(dict(row['prefectures'] or [])),
+        'property_types': tuple(row['property_types'] or ()),
+        'structures': tuple(row['structures'] or ()),
+        'floor_plans': tuple(row['floor_plans'] or ()),
+        'year_range': (int(row['min_transaction_year']), int(row['max_transaction_year'])),
+        'building_year_range': (int(row['min_building_year']), int(row['max_building_year'])),
+    })
 
-@st.cache_data(ttl=3600)
-def get_municipalities(prefecture_code):
-    return run_query("""
-        SELECT DISTINCT m.code, COALESCE(m.name_en, m.name_ja) as name
-        FROM municipalities m
-        JOIN transactions t ON t.municipality_code = m.code
-        WHERE m.prefecture_code = %s
-        ORDER BY name
-    """, (prefecture_code,))
+def get_prefectures():
+    """Return a read-only {name_en: code} mapping of prefectures that have transactions."""
+    return get_bootstrap_refdata()['prefectures']
 
-@st.cache_data(ttl=3600)
+@st.cache_resource(ttl=3600)
 def get_districts(municipality_codes):
+    """District names in the given municipalities, as a tuple ready for widget options."""
     if not municipality_codes:
-        return pd.DataFrame(columns=['district_name'])
-    return run_query("""
+        return ()
+    result = run_query("""
         SELECT DISTINCT district_name
         FROM transactions
         WHERE municipality_code = ANY(%s)
@@ -357,20 +635,7 @@ def get_districts(municipality_codes):
           AND district_name != ''
         ORDER BY district_name
     """, (municipality_codes,))
-
-@st.cache_data(ttl=3600)
-def get_districts_by_prefecture(prefecture_code):
-    """Get districts for prefectures where municipality_code is NULL."""
-    return run_query("""
-        SELECT DISTINCT district_name
-        FROM transactions
-        WHERE prefecture_code = %s
-          AND municipality_code IS NULL
-          AND district_name IS NOT NULL
-          AND district_name != ''
-        ORDER BY district_name
-        LIMIT 500
-    """, (prefecture_code,))
+    return tuple(result['district_name']) if not result.empty else ()
 
 @st.cache_data(ttl=3600)
 def search_districts(prefecture_code, search_term):
@@ -389,65 +654,116 @@ def search_districts(prefecture_code, search_term):
         LIMIT 50
     """, (prefecture_code, f'%{search_term}%'))
 
-@st.cache_data(ttl=3600)
 def get_property_types():
-    return run_query("""
-        SELECT DISTINCT property_type_raw
-        FROM transactions
-        WHERE property_type_raw IS NOT NULL AND property_type_raw != ''
-        ORDER BY property_type_raw
-    """)
+    return get_bootstrap_refdata()['property_types']
 
-@st.cache_data(ttl=3600)
 def get_structures():
-    return run_query("""
-        SELECT DISTINCT structure
-        FROM transactions
-        WHERE structure IS NOT NULL AND structure != ''
-        ORDER BY structure
-    """)
+    return get_bootstrap_refdata()['structures']
 
-@st.cache_data(ttl=3600)
 def get_floor_plans():
-    return run_query("""
-        SELECT DISTINCT floor_plan
-        FROM transactions
-        WHERE floor_plan IS NOT NULL AND floor_plan != ''
-        ORDER BY floor_plan
-    """)
+    return get_bootstrap_refdata()['floor_plans']
 
-@st.cache_data(ttl=3600)
 def get_year_range():
-    result = run_query("""
-        SELECT MIN(transaction_year) as min_year, MAX(transaction_year) as max_year
-        FROM transactions
-    """)
-    return int(result['min_year'].iloc[0]), int(result['max_year'].iloc[0])
+    return get_bootstrap_refdata()['year_range']
 
-@st.cache_data(ttl=3600)
 def get_building_year_range():
-    result = run_query("""
-        SELECT MIN(building_year) as min_year, MAX(building_year) as max_year
-        FROM transactions
-        WHERE building_year IS NOT NULL AND building_year > 1900
-    """)
-    return int(result['min_year'].iloc[0]), int(result['max_year'].iloc[0])
+    return get_bootstrap_refdata()['building_year_range']
 
-@st.cache_data(ttl=3600)
-def get_stations(prefecture_code):
-    """Get stations with transaction data for a prefecture."""
-    return run_query("""
-        SELECT DISTINCT s.code, COALESCE(s.name_en, s.name_ja) as name
-        FROM stations s
-        JOIN transactions t ON t.nearest_station_code = s.code
-        WHERE s.municipality_code IN (
-            SELECT code FROM municipalities WHERE prefecture_code = %s
+@st.cache_resource(ttl=3600)
+def get_sidebar_refdata(prefecture_code):
+    """
+    Fetch the prefecture-level sidebar lists in one round trip.
+
+    Returns ready-to-use widget options, shared across sessions and read-only:
+    'municipalities' ({name: code}), 'districts' (tuple of names; only for prefectures
+    without municipality data, first MAX_DISTRICT_OPTIONS) and 'stations' ({name: code}; stations with
+    transactions, top 500).
+    """
+    result = run_query("""
+        WITH munis AS (
+            SELECT code, name
+            FROM mv_municipalities_with_tx
+            WHERE prefecture_code = %s
+        ),
+        dists AS (
+            SELECT district_name
+            FROM mv_prefecture_districts
+            WHERE prefecture_code = %s
+              AND NOT EXISTS (SELECT 1 FROM munis)
+            ORDER BY district_name
+            LIMIT %s
+        ),
+        stations AS (
+            SELECT code, name
+            FROM mv_stations_with_tx
+            WHERE prefecture_code = %s
+            ORDER BY name
+            LIMIT 500
         )
-        ORDER BY name
-        LIMIT 500
-    """, (prefecture_code,))
+        SELECT
+            (SELECT json_agg(munis ORDER BY name) FROM munis) as municipalities,
+            (SELECT json_agg(dists ORDER BY district_name) FROM dists) as districts,
+            (SELECT json_agg(stations ORDER BY name) FROM stations) as stations
+    """, (prefecture_code, prefecture_code, MAX_DISTRICT_OPTIONS, prefecture_code))
+
+    row = result.iloc[0] if not result.empty else {}
+    municipalities = {r['name']: r['code'] for r in row.get('municipalities') or []}
+    stations = {r['name']: r['code'] for r in row.get('stations') or []}
+    return MappingProxyType({
+        'municipalities': MappingProxyType(municipalities),
+        'municipality_index': _name_code_index(municipalities),
+        'districts': tuple(r['district_name'] for r in row.get('districts') or []),
+        'stations': MappingProxyType(stations),
+        'station_index': _name_code_index(stations),
+    })
+
+def _name_code_index(options):
+    """Names sorted into an array with their codes aligned, for codes_for_names()."""
+    names = np.array(list(options), dtype=object)
+    codes = np.array(list(options.values()), dtype=object)
+    order = np.argsort(names)
+    return names[order], codes[order]
+
+def codes_for_names(index, selected):
+    """Map selected widget labels to codes with one searchsorted; None when nothing is selected."""
+    if not selected:
+        return None
+    names, codes = index
+    return codes[np.searchsorted(names, np.array(selected, dtype=object))].tolist()
 
-@st.cache_data(ttl=3600)
+@st.cache_resource(ttl=3600)
+def get_price_rollup(prefecture_code):
+    """
+    Quarterly rollup rows (mv_price_trends) for one prefecture, kept in-process.
+
+    A few thousand narrow rows per prefecture: the map tab aggregates them locally, so
+    switching year mode or property types needs no database round trip. Shared across
+    sessions - callers must not mutate the frame.
+    """
+    rollup = run_query("""
+        SELECT
+            v.municipality_code,
+            COALESCE(m.name_en, m.name_ja) as name,
+            v.property_type_raw,
+            v.transaction_year,
+            v.transaction_count,
+            v.avg_price_m2,
+            v.median_price_m2
+        FROM mv_price_trends v
+        JOIN municipalities m ON v.municipality_code = m.code
+        WHERE v.prefecture_code = %s
+    """, (prefecture_code,))
+    if rollup.empty:
+        return rollup
+    return rollup.astype({
+        'property_type_raw': 'category',
+        'transaction_year': 'int16',
+        'transaction_count': 'int64',
+        'avg_price_m2': 'float64',
+        'median_price_m2': 'float64',
+    })
+
+@st.cache_data(ttl=3600, max_entries=64, hash_funcs=FILTER_HASH_FUNCS)
 def get_map_data(filters, latest_only=False):
     """Get aggregated price data by municipality for map visualization.
 
@@ -463,115 +779,76 @@ def get_map_data(filters, latest_only=False):
         # Use only the most recent year
         year_start = year_end
 
-    query = """
-        SELECT
-            m.code as municipality_code,
-            COALESCE(m.name_en, m.name_ja) as name,
-            COUNT(*) as transactions,
-            ROUND(AVG(t.unit_price)) as avg_price_m2,
-            PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY t.unit_price)::INTEGER as median_price_m2
-        FROM transactions t
-        JOIN municipalities m ON t.municipality_code = m.code
-        WHERE t.prefecture_code = %s
-          AND t.unit_price IS NOT NULL
-          AND t.unit_price > 0
-          AND t.unit_price < 50000000
-          AND t.transaction_year BETWEEN %s AND %s
-    """
-    params = [filters['prefecture_code'], year_start, year_end]
+    empty = pd.DataFrame(columns=['municipality_code', 'name', 'transactions', 'avg_price_m2', 'median_price_m2'])
+    rollup = get_price_rollup(filters['prefecture_code'])
+    if rollup.empty:
+        return empty
 
+    rows = rollup[rollup['transaction_year'].between(year_start, year_end)]
     if filters.get('property_types'):
-        query += " AND t.property_type_raw = ANY(%s)"
-        params.append(filters['property_types'])
-
-    query += " GROUP BY m.code, m.name_en, m.name_ja HAVING COUNT(*) >= 5"
-    query += " ORDER BY median_price_m2 DESC"
-
-    return run_query(query, params)
-
-
-@st.cache_data(ttl=3600)
-def get_latest_median_price(filters):
-    """Get median price for the latest quarter (last data point) in the selected range."""
-    year_start = filters.get('year_range', [2005, 2025])[0]
-    year_end = filters.get('year_range', [2005, 2025])[1]
-
-    # First, find the latest quarter with data in the range
-    latest_query = """
-        SELECT t.transaction_year, t.transaction_quarter
-        FROM transactions t
-        WHERE t.unit_price IS NOT NULL
-          AND t.unit_price > 0
-          AND t.transaction_year BETWEEN %s AND %s
+        rows = rows[rows['property_type_raw'].isin(filters['property_types'])]
+
+    # Counts and averages are exact; the median is the transaction-weighted mean of
+    # quarterly medians.
+    weights = rows['transaction_count']
+    totals = rows.assign(
+        avg_weighted=rows['avg_price_m2'] * weights,
+        median_weighted=rows['median_price_m2'] * weights,
+    ).groupby(['municipality_code', 'name'], sort=False)[['transaction_count', 'avg_weighted', 'median_weighted']].sum()
+    totals = totals[totals['transaction_count'] >= 5]
+    if totals.empty:
+        return empty
+
+    map_data = pd.DataFrame({
+        'transactions': totals['transaction_count'],
+        'avg_price_m2': (totals['avg_weighted'] / totals['transaction_count']).round(),
+        'median_price_m2': (totals['median_weighted'] / totals['transaction_count']).round().astype(int),
+    }).reset_index()
+    return map_data.sort_values('median_price_m2', ascending=False, ignore_index=True)
+
+
+@st.cache_data(ttl=3600, max_entries=64, hash_funcs=FILTER_HASH_FUNCS)
+def get_summary_stats(filters):
     """
-    latest_params = [year_start, year_end]
-
-    if filters.get('prefecture_code'):
-        latest_query = latest_query.replace("WHERE", "WHERE t.prefecture_code = %s AND")
-        latest_params.insert(0, filters['prefecture_code'])
+    Summary bar figures in one round trip: matching count, period median, and the latest
+    quarter with data together with its median.
 
-    if filters.get('municipality_codes'):
-        latest_query += " AND t.municipality_code = ANY(%s)"
-        latest_params.append(filters['municipality_codes'])
+    The filtered rows are scanned once into a CTE; the period and latest-quarter
+    aggregates come back as two tagged rows of a UNION ALL.
 
-    if filters.get('property_types'):
-        latest_query += " AND t.property_type_raw = ANY(%s)"
-        latest_params.append(filters['property_types'])
-
-    if filters.get('districts'):
-        latest_query += " AND t.district_name = ANY(%s)"
-        latest_params.append(filters['districts'])
-
-    if filters.get('station_codes'):
-        latest_query += " AND t.nearest_station_code = ANY(%s)"
-        latest_params.append(filters['station_codes'])
-
-    latest_query += " ORDER BY t.transaction_year DESC, t.transaction_quarter DESC LIMIT 1"
-
-    latest_result = run_query(latest_query, latest_params)
-    if latest_result.empty:
-        return None, None
-
-    latest_year = int(latest_result['transaction_year'].iloc[0])
-    latest_quarter = int(latest_result['transaction_quarter'].iloc[0])
-
-    # Now get the median for that specific quarter
-    query = """
-        SELECT
-            PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY t.unit_price) as median
-        FROM transactions t
-        WHERE t.unit_price IS NOT NULL
-          AND t.unit_price > 0
-          AND t.unit_price < 50000000
-          AND t.transaction_year = %s
-          AND t.transaction_quarter = %s
+    Returns (count, median, latest_median, latest_year, latest_quarter); the latest_*
+    values are None when no row has a quarter.
     """
-    params = [latest_year, latest_quarter]
-
-    if filters.get('prefecture_code'):
-        query = query.replace("WHERE", "WHERE t.prefecture_code = %s AND")
-        params.insert(0, filters['prefecture_code'])
-
-    if filters.get('municipality_codes'):
-        query += " AND t.municipality_code = ANY(%s)"
-        params.append(filters['municipality_codes'])
-
-    if filters.get('property_types'):
-        query += " AND t.property_type_raw = ANY(%s)"
-        params.append(filters['property_types'])
-
-    if filters.get('districts'):
-        query += " AND t.district_name = ANY(%s)"
-        params.append(filters['districts'])
-
-    if filters.get('station_codes'):
-        query += " AND t.nearest_station_code = ANY(%s)"
-        params.append(filters['station_codes'])
-
-    result = run_query(query, params)
-    if not result.empty and result['median'].iloc[0]:
-        return float(result['median'].iloc[0]), f"{latest_year} Q{latest_quarter}", latest_year, latest_quarter
-    return None, None, None, None
+    filtered, params = build_query("t.transaction_year, t.transaction_quarter, t.unit_price", filters)
+    result = run_query(f"""
+        WITH f AS MATERIALIZED ({filtered}),
+        latest AS (
+            SELECT transaction_year, transaction_quarter
+            FROM f
+            WHERE transaction_quarter IS NOT NULL
+            ORDER BY transaction_year DESC, transaction_quarter DESC
+            LIMIT 1
+        )
+        SELECT 'period' as tag, NULL::smallint as transaction_year, NULL::smallint as transaction_quarter,
+               COUNT(*) as count,
+               PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY f.unit_price) as median
+        FROM f
+        UNION ALL
+        SELECT 'latest', l.transaction_year, l.transaction_quarter,
+               COUNT(*),
+               PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY f.unit_price)
+        FROM f
+        JOIN latest l USING (transaction_year, transaction_quarter)
+        GROUP BY l.transaction_year, l.transaction_quarter
+    """, params)
+
+    rows = result.set_index('tag')
+    count = int(rows.at['period', 'count'])
+    median = float(rows.at['period', 'median']) if pd.notna(rows.at['period', 'median']) else 0.0
+    if 'latest' not in rows.index or pd.isna(rows.at['latest', 'median']):
+        return count, median, None, None, None
+    latest = rows.loc['latest']
+    return count, median, float(latest['median']), int(latest['transaction_year']), int(latest['transaction_quarter'])
 
 # =============================================================================
 # CURRENCY CONVERSION (FX rates from database)
@@ -579,7 +856,7 @@ def get_latest_median_price(filters):
 
 @st.cache_data(ttl=3600)
 def get_historical_fx_rates(start_year, end_year, target_currency="USD"):
-    """Fetch historical quarterly FX rates from database."""
+    """Fetch historical quarterly FX rates as a Series indexed by (year, quarter)."""
     result = run_query("""
         SELECT year, quarter, rate
         FROM fx_rates
@@ -588,11 +865,9 @@ def get_historical_fx_rates(start_year, end_year, target_currency="USD"):
         ORDER BY year, quarter
     """, (target_currency, start_year, end_year))
 
-    rates = {}
-    if not result.empty:
-        for _, row in result.iterrows():
-            rates[(int(row['year']), int(row['quarter']))] = float(row['rate'])
-    return rates
+    if result.empty:
+        return pd.Series(dtype=float, name='rate')
+    return result.astype({'year': int, 'quarter': int, 'rate': float}).set_index(['year', 'quarter'])['rate']
 
 @st.cache_data(ttl=3600)
 def get_current_fx_rate(target_currency="USD"):
@@ -613,84 +888,96 @@ def get_current_fx_rate(target_currency="USD"):
 # QUERY BUILDER
 # =============================================================================
 
-def build_query(select_clause, filters, group_by=None, order_by=None, limit=None):
-    """Build SQL query with dynamic filters."""
-    query = f"SELECT {select_clause} FROM transactions t"
-
-    # Join municipalities if needed
-    if 'ward' in select_clause.lower() or 'm.name_en' in select_clause:
-        query += " LEFT JOIN municipalities m ON t.municipality_code = m.code"
-
-    conditions = ["t.unit_price IS NOT NULL", "t.unit_price > 0", "t.unit_price < 50000000"]
-    params = []
-
-    if filters.get('prefecture_code'):
-        conditions.append("t.prefecture_code = %s")
-        params.append(filters['prefecture_code'])
+# Filter key -> (SQL condition, params builder). The order fixes placeholder order.
+FILTER_CLAUSES = {
+    'prefecture_code': ("t.prefecture_code = %s", lambda v: [v]),
+    'municipality_codes': ("t.municipality_code = ANY(%s)", lambda v: [v]),
+    # For prefectures like Hokkaido where municipality_code is NULL
+    'no_municipality_data': ("t.municipality_code IS NULL", lambda v: []),
+    'districts': ("t.district_name = ANY(%s)", lambda v: [v]),
+    'station_codes': ("t.nearest_station_code = ANY(%s)", lambda v: [v]),
+    'property_types': ("t.property_type_raw = ANY(%s)", lambda v: [v]),
+    'structures': ("t.structure = ANY(%s)", lambda v: [v]),
+    'floor_plans': ("t.floor_plan = ANY(%s)", lambda v: [v]),
+    'year_range': ("t.transaction_year BETWEEN %s AND %s", lambda v: list(v)),
+    'building_year_range': ("t.building_year BETWEEN %s AND %s", lambda v: list(v)),
+    'price_range': ("t.trade_price BETWEEN %s AND %s", lambda v: [v[0] * 1000000, v[1] * 1000000]),
+    'price_m2_range': ("t.unit_price BETWEEN %s AND %s", lambda v: [v[0] * 10000, v[1] * 10000]),
+    'area_range': ("t.area_m2 BETWEEN %s AND %s", lambda v: list(v)),
+    # Not a sidebar filter: scatter sampling keeps the first N of SAMPLE_BUCKETS buckets
+    'sample_buckets': ("t.sample_bucket < %s", lambda v: [v]),
+    # Not a sidebar filter: Raw Data keyset pagination, rows after (year, quarter, id) in
+    # RAW_DATA_ORDER
+    'keyset_before': ("(t.transaction_year, COALESCE(t.transaction_quarter, 0), t.id) < (%s, %s, %s)", lambda v: list(v)),
+}
 
-    if filters.get('municipality_codes'):
-        conditions.append("t.municipality_code = ANY(%s)")
-        params.append(filters['municipality_codes'])
-    elif filters.get('no_municipality_data'):
-        # For prefectures like Hokkaido where municipality_code is NULL
-        conditions.append("t.municipality_code IS NULL")
+# Newest first; the id tiebreak makes the order total so keyset pages never skip or repeat rows
+RAW_DATA_ORDER = "t.transaction_year DESC, COALESCE(t.transaction_quarter, 0) DESC, t.id DESC"
+RAW_DATA_PAGE_SIZE = 100
 
-    if filters.get('districts'):
-        conditions.append("t.district_name = ANY(%s)")
-        params.append(filters['districts'])
+# transactions.sample_bucket is a fixed pseudo-random tag in [0, SAMPLE_BUCKETS), set at
+# ingestion, so any bucket prefix is a uniform and repeatable sample
+SAMPLE_BUCKETS = 128
 
-    if filters.get('station_codes'):
-        conditions.append("t.nearest_station_code = ANY(%s)")
-        params.append(filters['station_codes'])
+QUALITY_CONDITIONS = {
+    'exclude_critical': """
+            t.id NOT IN (
+                SELECT transaction_id FROM data_quality_flags
+                WHERE issue_code IN ('sentinel_area_9999', 'sentinel_area_8888', 'sentinel_price_extreme_low',
+                                      'missing_both_location')
+            )
+        """,
+    'only_suspicious': """
+            t.id IN (
+                SELECT transaction_id FROM data_quality_flags
+            )
+        """,
+}
 
-    if filters.get('property_types'):
-        conditions.append("t.property_type_raw = ANY(%s)")
-        params.append(filters['property_types'])
+# Municipality lists up to this length are joined against a VALUES list instead of
+# "= ANY(array)", which lets the planner drive one index scan per code.
+MUNICIPALITY_VALUES_MAX = 32
 
-    if filters.get('structures'):
-        conditions.append("t.structure = ANY(%s)")
-        params.append(filters['structures'])
+def filter_shape(filters):
+    """Active filter keys in clause order; filters with the same shape share one SQL text."""
+    shape = tuple(key for key in FILTER_CLAUSES if filters.get(key))
+    if 'municipality_codes' in shape:
+        shape = tuple(key for key in shape if key != 'no_municipality_data')
+        count = len(set(filters['municipality_codes']))
+        if count <= MUNICIPALITY_VALUES_MAX:
+            shape = tuple(('municipality_values', count) if key == 'municipality_codes' else key for key in shape)
+    return shape
 
-    if filters.get('floor_plans'):
-        conditions.append("t.floor_plan = ANY(%s)")
-        params.append(filters['floor_plans'])
+@st.cache_resource
+def get_query_templates():
+    """Composed SQL text keyed by (select, filter shape, quality mode, group/order, limited)."""
+    return {}
 
-    if filters.get('year_range'):
-        conditions.append("t.transaction_year BETWEEN %s AND %s")
-        params.extend(filters['year_range'])
+@st.cache_resource
+def get_built_queries():
+    """(SQL, params) from build_query keyed by the full FilterSet value, for repeat calls."""
+    return {}
 
-    if filters.get('building_year_range'):
-        conditions.append("t.building_year BETWEEN %s AND %s")
-        params.extend(filters['building_year_range'])
+def compose_query(select_clause, shape, quality_filter, group_by=None, order_by=None, limited=False):
+    """Compose the SQL text for a filter shape. Parameter values (LIMIT included) are bound separately."""
+    query = f"SELECT {select_clause} FROM transactions t"
 
-    if filters.get('price_range'):
-        conditions.append("t.trade_price BETWEEN %s AND %s")
-        params.extend([filters['price_range'][0] * 1000000, filters['price_range'][1] * 1000000])
+    for key in shape:
+        if isinstance(key, tuple):  # ('municipality_values', count)
+            # Typed as char(5) so the join compares bpchar to bpchar and can use the index
+            values = ", ".join(["(%s::char(5))"] * key[1])
+            query += f" JOIN (VALUES {values}) v(code) ON t.municipality_code = v.code"
 
-    if filters.get('price_m2_range'):
-        conditions.append("t.unit_price BETWEEN %s AND %s")
-        params.extend([filters['price_m2_range'][0] * 10000, filters['price_m2_range'][1] * 10000])
+    # Join municipalities if needed
+    if 'ward' in select_clause.lower() or 'm.name_en' in select_clause:
+        query += " LEFT JOIN municipalities m ON t.municipality_code = m.code"
 
-    if filters.get('area_range'):
-        conditions.append("t.area_m2 BETWEEN %s AND %s")
-        params.extend(filters['area_range'])
+    conditions = ["t.unit_price IS NOT NULL", "t.unit_price > 0", "t.unit_price < 50000000"]
+    conditions.extend(FILTER_CLAUSES[key][0] for key in shape if not isinstance(key, tuple))
 
     # Add data quality filter
-    quality_filter = filters.get('quality_filter', 'exclude_critical')
-    if quality_filter == 'exclude_critical':
-        conditions.append("""
-            t.id NOT IN (
-                SELECT transaction_id FROM data_quality_flags
-                WHERE issue_code IN ('sentinel_area_9999', 'sentinel_area_8888', 'sentinel_price_extreme_low',
-                                      'missing_both_location')
-            )
-        """)
-    elif quality_filter == 'only_suspicious':
-        conditions.append("""
-            t.id IN (
-                SELECT transaction_id FROM data_quality_flags
-            )
-        """)
+    if quality_filter in QUALITY_CONDITIONS:
+        conditions.append(QUALITY_CONDITIONS[quality_filter])
 
     query += " WHERE " + " AND ".join(conditions)
 
@@ -700,9 +987,55 @@ def build_query(select_clause, filters, group_by=None, order_by=None, limit=None
     if order_by:
         query += f" ORDER BY {order_by}"
 
+    if limited:
+        query += " LIMIT %s"
+
+    return query
+
+def build_query(select_clause, filters, group_by=None, order_by=None, limit=None):
+    """
+    Build SQL query with dynamic filters.
+
+    The SQL text depends only on which filters are active, so it is composed once per
+    shape and reused; identical text also lets run_query reuse its prepared statement.
+
+    For a FilterSet the finished (SQL, params) pair is memoized as well, so the sidebar
+    filters are walked once per query rather than on every call and rerun.
+    """
+    built = get_built_queries()
+    memo_key = None
+    if isinstance(filters, FilterSet):
+        memo_key = (filters.cache_key(), select_clause, group_by, order_by, limit)
+        hit = built.get(memo_key)
+        if hit is not None:
+            return hit[0], list(hit[1])
+
+    shape = filter_shape(filters)
+    key = (select_clause, shape, filters.get('quality_filter', 'exclude_critical'), group_by, order_by,
+           bool(limit))
+
+    templates = get_query_templates()
+    query = templates.get(key)
+    if query is None:
+        if len(templates) >= 512:
+            templates.clear()
+        query = templates[key] = compose_query(*key)
+
+    params = []
+    for name in shape:
+        if isinstance(name, tuple):
+            # VALUES placeholders sit in the FROM clause, ahead of every WHERE placeholder
+            params[:0] = list(dict.fromkeys(filters['municipality_codes']))
+        else:
+            params.extend(FILTER_CLAUSES[name][1](filters[name]))
+
     if limit:
-        query += f" LIMIT {limit}"
+        params.append(limit)
 
+    if memo_key is not None:
+        if len(built) >= 1024:
+            built.clear()
+        built[memo_key] = (query, tuple(params))
     return query, params
 
 # =============================================================================
@@ -712,21 +1045,19 @@ def build_query(select_clause, filters, group_by=None, order_by=None, limit=None
 st.sidebar.header("📍 Location Filters")
 
 # Prefecture
-prefectures = get_prefectures()
-prefecture_options = dict(zip(prefectures['name_en'], prefectures['code']))
+prefecture_options = get_prefectures()
+prefecture_names = tuple(prefecture_options)
 selected_prefecture_name = st.sidebar.selectbox(
     "Prefecture",
-    options=list(prefecture_options.keys()),
-    index=list(prefecture_options.keys()).index("Tokyo") if "Tokyo" in prefecture_options else 0
+    options=prefecture_names,
+    index=prefecture_names.index("Tokyo") if "Tokyo" in prefecture_options else 0
 )
 selected_prefecture = prefecture_options[selected_prefecture_name]
 
+sidebar_refdata = get_sidebar_refdata(selected_prefecture)
+
 # Municipality (Ward/City)
-municipalities = get_municipalities(selected_prefecture)
-if not municipalities.empty and 'name' in municipalities.columns:
-    municipality_options = dict(zip(municipalities['name'], municipalities['code']))
-else:
-    municipality_options = {}
+municipality_options = sidebar_refdata['municipalities']
 
 # Check if this prefecture has municipality data
 has_municipality_data = len(municipality_options) > 0
@@ -739,18 +1070,18 @@ if has_municipality_data:
 
     selected_municipalities = st.sidebar.multiselect(
         "Ward / City",
-        options=list(municipality_options.keys()),
+        options=tuple(municipality_options),
         default=default_municipality
     )
-    selected_municipality_codes = [municipality_options[m] for m in selected_municipalities] if selected_municipalities else None
+    selected_municipality_codes = codes_for_names(sidebar_refdata['municipality_index'], selected_municipalities)
 
     # District (Chome) - only show when municipalities are selected
     if selected_municipality_codes:
         districts = get_districts(selected_municipality_codes)
-        if not districts.empty:
+        if districts:
             selected_districts = st.sidebar.multiselect(
                 "District / Chome",
-                options=districts['district_name'].tolist(),
+                options=districts,
                 help=TOOLTIPS["chome"]
             )
             selected_districts = selected_districts if selected_districts else None
@@ -775,12 +1106,15 @@ else:
         search_results = search_districts(selected_prefecture, district_search)
         if not search_results.empty:
             # Show results with transaction counts
-            district_options = [f"{row['district_name']} ({row['tx_count']:,})" for _, row in search_results.iterrows()]
-            district_map = {f"{row['district_name']} ({row['tx_count']:,})": row['district_name'] for _, row in search_results.iterrows()}
+            search_results = search_results.head(MAX_DISTRICT_OPTIONS)
+            district_map = {
+                f"{name} ({count:,})": name
+                for name, count in zip(search_results['district_name'], search_results['tx_count'])
+            }
 
             selected_district_labels = st.sidebar.multiselect(
                 "Matching Districts",
-                options=district_options
+                options=tuple(district_map)
             )
             selected_districts = [district_map[label] for label in selected_district_labels] if selected_district_labels else None
         else:
@@ -788,33 +1122,32 @@ else:
             selected_districts = None
     else:
         # Fallback to top districts by transaction count
-        districts = get_districts_by_prefecture(selected_prefecture)
-        if not districts.empty:
+        districts = sidebar_refdata['districts']
+        if districts:
             selected_districts = st.sidebar.multiselect(
-                "District / Area (top 500)",
-                options=districts['district_name'].tolist()
+                f"District / Area (first {MAX_DISTRICT_OPTIONS})",
+                options=districts,
+                help="Use the search box above to find other districts"
             )
             selected_districts = selected_districts if selected_districts else None
         else:
             selected_districts = None
 
 # Station filter
-stations = get_stations(selected_prefecture)
-if not stations.empty and 'name' in stations.columns:
-    station_options = dict(zip(stations['name'], stations['code']))
+station_options = sidebar_refdata['stations']
+if station_options:
     selected_stations = st.sidebar.multiselect(
         "🚉 Near Station",
-        options=list(station_options.keys())
+        options=tuple(station_options)
     )
-    selected_station_codes = [station_options[s] for s in selected_stations] if selected_stations else None
+    selected_station_codes = codes_for_names(sidebar_refdata['station_index'], selected_stations)
 else:
     selected_station_codes = None
 
 st.sidebar.header("🏢 Property Filters")
 
 # Property type - default to Pre-owned Condominiums
-property_types = get_property_types()
-property_type_list = property_types['property_type_raw'].tolist()
+property_type_list = get_property_types()
 default_property_type = ["Pre-owned Condominiums, etc."] if "Pre-owned Condominiums, etc." in property_type_list else []
 selected_property_types = st.sidebar.multiselect(
     "Property Type",
@@ -824,27 +1157,29 @@ selected_property_types = st.sidebar.multiselect(
 selected_property_types = selected_property_types if selected_property_types else None
 
 # Structure
-structures = get_structures()
 selected_structures = st.sidebar.multiselect(
     "Structure (RC, Wood, etc.)",
-    options=structures['structure'].tolist(),
+    options=get_structures(),
     help=TOOLTIPS["rc"]
 )
 selected_structures = selected_structures if selected_structures else None
 
 # Floor plan
-floor_plans = get_floor_plans()
 selected_floor_plans = st.sidebar.multiselect(
     "Layout (1LDK, 2DK, etc.)",
-    options=floor_plans['floor_plan'].tolist(),
+    options=get_floor_plans(),
     help=TOOLTIPS["ldk"]
 )
 selected_floor_plans = selected_floor_plans if selected_floor_plans else None
 
-st.sidebar.header("📏 Size Filters")
+# Range sliders sit in a form so dragging them reruns the page once, on Apply,
+# instead of on every tick
+range_form = st.sidebar.form("range_filters", border=False)
+
+range_form.header("📏 Size Filters")
 
 # Area range
-area_range = st.sidebar.slider(
+area_range = range_form.slider(
     "Area (m²)",
     min_value=0,
     max_value=500,
@@ -855,10 +1190,10 @@ area_range = area_range if area_range != (0, 500) else None
 
 # Note: building_floors and walk_minutes removed - 0% populated in data
 
-st.sidebar.header("💰 Price Filters")
+range_form.header("💰 Price Filters")
 
 # Price range (millions)
-price_range = st.sidebar.slider(
+price_range = range_form.slider(
     "Total Price (¥ millions)",
     min_value=0,
     max_value=500,
@@ -868,7 +1203,7 @@ price_range = st.sidebar.slider(
 price_range = price_range if price_range != (0, 500) else None
 
 # Price per m2 (万円)
-price_m2_range = st.sidebar.slider(
+price_m2_range = range_form.slider(
     "Price per m² (¥ 万)",
     min_value=0,
     max_value=500,
@@ -878,11 +1213,11 @@ price_m2_range = st.sidebar.slider(
 )
 price_m2_range = price_m2_range if price_m2_range != (0, 500) else None
 
-st.sidebar.header("📅 Date Filters")
+range_form.header("📅 Date Filters")
 
 # Transaction year range
 min_year, max_year = get_year_range()
-year_range = st.sidebar.slider(
+year_range = range_form.slider(
     "Transaction Year",
     min_value=min_year,
     max_value=max_year,
@@ -891,7 +1226,7 @@ year_range = st.sidebar.slider(
 
 # Building year range
 min_build_year, max_build_year = get_building_year_range()
-building_year_range = st.sidebar.slider(
+building_year_range = range_form.slider(
     "Year Built",
     min_value=min_build_year,
     max_value=max_build_year,
@@ -899,6 +1234,7 @@ building_year_range = st.sidebar.slider(
     help=TOOLTIPS["building_age"]
 )
 building_year_range = building_year_range if building_year_range != (min_build_year, max_build_year) else None
+range_form.form_submit_button("Apply ranges", width="stretch")
 
 st.sidebar.header("📊 Chart Options")
 
@@ -951,6 +1287,8 @@ price_unit = st.sidebar.radio(
     help=TOOLTIPS["tsubo"]
 )
 use_tsubo = price_unit == "per tsubo"
+# Unit-price multiplier for this rerun (1.0 when showing per m²)
+tsubo_factor = TSUBO_TO_M2 if use_tsubo else 1.0
 
 # Currency toggle
 currency = st.sidebar.radio(
@@ -960,6 +1298,8 @@ currency = st.sidebar.radio(
     horizontal=True
 )
 use_fx = currency != "JPY"
+# Bound once per rerun so formatting a value is a single str.format call
+format_currency = PRICE_FORMATTERS[currency]
 
 st.sidebar.header("🔍 Data Quality")
 
@@ -979,8 +1319,32 @@ quality_mode_map = {
 }
 quality_filter = quality_mode_map[quality_mode]
 
+@st.cache_resource
+def get_data_generation():
+    """Shared counter bumped by refresh_reference_data; per-session caches key on it."""
+    return {'value': 0}
+
+# Session-state caches filled by run_query_year_delta
+YEAR_DELTA_CACHES = ('price_trends_delta',)
+
+def refresh_reference_data():
+    """Drop cached dropdown data and query results after a data load."""
+    get_data_generation()['value'] += 1
+    for cache_name in YEAR_DELTA_CACHES:
+        st.session_state.pop(cache_name, None)
+    for fetch in (get_bootstrap_refdata, get_sidebar_refdata, get_districts, get_price_rollup, get_ranking_rows,
+                  get_map_data, get_summary_stats, get_histogram_data, get_age_vs_price_by_area):
+        fetch.clear()
+    run_query.clear()
+
+st.sidebar.button(
+    "🔄 Refresh reference data",
+    on_click=refresh_reference_data,
+    help="Reload prefectures, property types and year ranges after new data has been imported"
+)
+
 # Fetch FX rates if needed (cached)
-fx_rates = {}
+fx_rates = pd.Series(dtype=float, name='rate')
 current_fx_rate = None
 if use_fx:
     fx_rates = get_historical_fx_rates(min_year, max_year, currency)
@@ -988,8 +1352,15 @@ if use_fx:
     if current_fx_rate:
         st.sidebar.caption(f"Current rate: ¥1 = {currency} {current_fx_rate:.6f}")
 
+# Dense quarterly rate table for vectorized lookups: slot (year - min_year) * 4 + quarter - 1,
+# with quarters lacking a historical rate pre-filled with the current rate
+fx_table = np.full((max_year - min_year + 1) * 4, current_fx_rate or 1.0)
+if not fx_rates.empty:
+    fx_slots = (fx_rates.index.get_level_values(0) - min_year) * 4 + fx_rates.index.get_level_values(1) - 1
+    fx_table[fx_slots.to_numpy()] = fx_rates.to_numpy()
+
 # Build filters dict
-filters = {
+filters = FilterSet({
     'prefecture_code': selected_prefecture,
     'municipality_codes': selected_municipality_codes,
     'no_municipality_data': not has_municipality_data,  # For prefectures like Hokkaido
@@ -1004,7 +1375,7 @@ filters = {
     'price_m2_range': price_m2_range,
     'area_range': area_range,
     'quality_filter': quality_filter,
-}
+})
 
 # =============================================================================
 # HELPER FUNCTIONS FOR DISPLAY
@@ -1015,24 +1386,48 @@ def convert_price(price_jpy, year=None, quarter=None):
     if not use_fx or price_jpy is None:
         return price_jpy
 
-    # Convert Decimal to float if needed
-    price = float(price_jpy) if price_jpy is not None else None
+    # Same rate table as the vectorized path: historical where known, else current
+    if year and quarter:
+        return price_jpy * fx_multiplier((year,), (quarter,))[0]
+    return price_jpy * (current_fx_rate or 1.0)
 
-    # Try to get historical rate
-    if year and quarter and (year, quarter) in fx_rates:
-        rate = fx_rates[(year, quarter)]
-    elif current_fx_rate:
-        rate = current_fx_rate
-    else:
-        return price  # No rate available
+def fx_multiplier(years, quarters):
+    """
+    Vectorized FX rates for arrays of transaction years and quarters.
+
+    Uses the historical quarterly rate where available and the current rate otherwise;
+    all ones when displaying JPY.
+    """
+    if not use_fx:
+        return np.ones(len(years))
+    # Float slots so a missing year or quarter (NaN) falls outside the table
+    slots = (np.asarray(years, dtype=float) - min_year) * 4 + np.asarray(quarters, dtype=float) - 1
+    in_table = (slots >= 0) & (slots < len(fx_table))
+    rates = np.full(len(slots), current_fx_rate or 1.0)
+    rates[in_table] = fx_table[slots[in_table].astype(int)]
+    return rates
 
-    return price * rate
+def convert_price_series(prices, years=None, quarters=None, is_unit_price=True):
+    """
+    Vectorized convert_price (plus tsubo conversion for unit prices) over a column.
 
-def convert_to_tsubo(price_per_m2):
-    """Convert price/m² to price/tsubo."""
-    if price_per_m2 is None:
-        return None
-    return price_per_m2 * TSUBO_TO_M2
+    With years and quarters each row uses its quarter's historical rate, otherwise the
+    current rate. Returns a float64 array with NaN for missing prices.
+    """
+    values = pd.to_numeric(pd.Series(prices), errors='coerce').to_numpy(dtype=float, copy=True)
+    # Fold the scalar factors together first so the column itself is multiplied once,
+    # in place
+    factor = tsubo_factor if is_unit_price else 1.0
+    if use_fx and years is None and current_fx_rate:
+        factor *= current_fx_rate
+    if use_fx and years is not None:
+        rates = fx_multiplier(years, quarters)
+        if factor != 1.0:
+            rates *= factor
+        values *= rates
+    elif factor != 1.0:
+        values *= factor
+    return values
 
 def format_price(price, year=None, quarter=None, is_unit_price=True):
     """Format price with currency symbol and optional tsubo conversion."""
@@ -1043,18 +1438,10 @@ def format_price(price, year=None, quarter=None, is_unit_price=True):
     converted = convert_price(price, year, quarter)
 
     # Convert to tsubo if needed (only for unit prices)
-    if is_unit_price and use_tsubo:
-        converted = convert_to_tsubo(converted)
+    if is_unit_price:
+        converted *= tsubo_factor
 
-    # Format with appropriate symbol
-    if use_fx:
-        if currency == "USD":
-            return f"${converted:,.0f}"
-        elif currency == "EUR":
-            return f"€{converted:,.0f}"
-        elif currency == "GBP":
-            return f"£{converted:,.0f}"
-    return f"¥{converted:,.0f}"
+    return format_currency(converted)
 
 def get_unit_label():
     """Get the current unit label for charts."""
@@ -1063,8 +1450,46 @@ def get_unit_label():
         return f"{currency}/{unit}"
     return f"¥/{unit}"
 
-def _insights_location_filter(filters, key):
-    use_location = st.checkbox(
+def build_trend_figures(periods, medians, averages, counts, unit_label):
+    """Time series price and volume figures from the (already cached) trend aggregates."""
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(
+        x=periods,
+        y=medians,
+        mode='lines+markers',
+        name=f'Median {unit_label}',
+        line=dict(color='#2E86AB', width=2)
+    ))
+    fig.add_trace(go.Scatter(
+        x=periods,
+        y=averages,
+        mode='lines',
+        name=f'Average {unit_label}',
+        line=dict(color='#A23B72', width=1, dash='dash')
+    ))
+    fig.update_layout(
+        xaxis_title="Period",
+        yaxis_title=f"Price ({unit_label})",
+        hovermode='x unified',
+        yaxis_tickformat=',',
+        height=500
+    )
+
+    volume = go.Figure(go.Bar(
+        x=periods,
+        y=counts,
+        hovertemplate='Period=%{x}<br>Transactions=%{y:,}<extra></extra>'
+    ))
+    volume.update_layout(
+        title='Transaction Volume',
+        xaxis_title='Period',
+        yaxis_title='Transactions',
+        height=300
+    )
+    return fig, volume
+
+def _insights_location_filter(filters, key):
+    use_location = st.checkbox(
         "Limit to sidebar location",
         value=False,
         key=f"insight_loc_{key}",
@@ -1085,7 +1510,7 @@ def get_price_trends(filters, frequency='Quarterly'):
             t.transaction_year,
             COUNT(*) as transaction_count,
             ROUND(AVG(t.unit_price)) as avg_price_m2,
-            PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY t.unit_price) as median_price_m2,
+            PERCENTILE_DISC(0.5) WITHIN GROUP (ORDER BY t.unit_price) as median_price_m2,
             ROUND(AVG(t.trade_price)) as avg_price
         """
         group_by = "t.transaction_year"
@@ -1096,16 +1521,65 @@ def get_price_trends(filters, frequency='Quarterly'):
             t.transaction_quarter,
             COUNT(*) as transaction_count,
             ROUND(AVG(t.unit_price)) as avg_price_m2,
-            PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY t.unit_price) as median_price_m2,
+            PERCENTILE_DISC(0.5) WITHIN GROUP (ORDER BY t.unit_price) as median_price_m2,
             ROUND(AVG(t.trade_price)) as avg_price
         """
         group_by = "t.transaction_year, t.transaction_quarter"
         order_by = "t.transaction_year, t.transaction_quarter"
 
-    query, params = build_query(select, filters, group_by, order_by)
-    return run_query(query, params)
+    return run_query_year_delta('price_trends_delta', select, filters, group_by, order_by)
+
+def run_query_year_delta(cache_name, select, filters, group_by, order_by):
+    """
+    Run a query grouped by transaction year, reusing this session's previous result
+    when only the year range changed: just the newly included years are queried and
+    appended, and years outside the range are dropped on the way out.
+
+    Only valid when no result row spans several years (transaction_year is a group key).
+    """
+    year_start, year_end = filters['year_range']
+    base_filters = FilterSet({k: v for k, v in filters.items() if k != 'year_range'})
+    # The generation invalidates every session's copy once new data is loaded
+    base_key = (select, group_by, order_by, base_filters.cache_key(), get_data_generation()['value'])
+
+    cached = st.session_state.get(cache_name)
+    reusable = (
+        cached is not None
+        and cached['base_key'] == base_key
+        and year_start <= cached['years'][1] + 1
+        and year_end >= cached['years'][0] - 1
+    )
+
+    if reusable:
+        have_start, have_end = cached['years']
+        spans = []
+        if year_start < have_start:
+            spans.append((year_start, have_start - 1))
+        if year_end > have_end:
+            spans.append((have_end + 1, year_end))
+        frames = [cached['df']] + [
+            run_query(*build_query(select, {**filters, 'year_range': span}, group_by, order_by))
+            for span in spans
+        ]
+        result = pd.concat(frames, ignore_index=True) if spans else cached['df']
+        years = (min(have_start, year_start), max(have_end, year_end))
+    else:
+        result = run_query(*build_query(select, filters, group_by, order_by))
+        years = (year_start, year_end)
+
+    st.session_state[cache_name] = {'base_key': base_key, 'years': years, 'df': result}
+
+    sort_cols = [c for c in ('transaction_year', 'transaction_quarter') if c in result.columns]
+    in_range = result[result['transaction_year'].between(year_start, year_end)]
+    return in_range.sort_values(sort_cols, ignore_index=True)
 
-def get_scatter_data(filters, limit=5000):
+def get_scatter_query(filters, limit=5000, randomize=True, matching_rows=None):
+    """
+    Scatter sample query. Without randomize it is a cheap first-rows preview.
+
+    Given the number of matching rows, large result sets read only a prefix of the
+    precomputed sample buckets instead of sorting every matching row by random().
+    """
     select = """
         t.transaction_year,
         t.unit_price,
@@ -1117,34 +1591,66 @@ def get_scatter_data(filters, limit=5000):
         t.municipality_code,
         t.structure
     """
-    query, params = build_query(select, filters, limit=limit)
-    # Add random ordering for sampling
-    query = query.replace(f"LIMIT {limit}", f"ORDER BY RANDOM() LIMIT {limit}")
-    return run_query(query, params)
+    if not randomize or (matching_rows is not None and matching_rows <= limit):
+        return build_query(select, filters, limit=limit)
+    # Take enough buckets for about twice the limit so uneven buckets still fill it,
+    # and fall back to a full shuffle when that would be most of the rows anyway.
+    buckets = -(-2 * limit * SAMPLE_BUCKETS // int(matching_rows)) if matching_rows else SAMPLE_BUCKETS
+    if buckets >= SAMPLE_BUCKETS // 2:
+        return build_query(select, filters, order_by="RANDOM()", limit=limit)
+    # The bucket prefix is only ~2x the limit, so shuffling it is cheap; without an
+    # ORDER BY the LIMIT would keep rows in physical (ingest) order.
+    return build_query(select, {**filters, 'sample_buckets': buckets}, order_by="RANDOM()", limit=limit)
+
+@st.cache_data(ttl=3600, max_entries=64, hash_funcs=FILTER_HASH_FUNCS)
+def get_histogram_data(filters, nbins=50):
+    """
+    Price-per-m² histogram binned server-side with width_bucket, over every matching row.
 
-def get_histogram_data(filters, limit=50000):
-    select = "t.unit_price"
-    query, params = build_query(select, filters, limit=limit)
-    return run_query(query, params)
+    One row per non-empty bin (bin_start, bin_end, count); the distribution's count,
+    median, mean and standard deviation are repeated on each row.
+    """
+    filtered, params = build_query("t.unit_price", filters)
+    query = f"""
+        WITH f AS ({filtered}),
+        s AS (
+            SELECT MIN(unit_price) as lo, MAX(unit_price) + 1 as hi, COUNT(*) as total,
+                   PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY unit_price) as median,
+                   AVG(unit_price) as mean, STDDEV_SAMP(unit_price) as std
+            FROM f
+        )
+        SELECT
+            width_bucket(f.unit_price, s.lo, s.hi, %s) as bin,
+            COUNT(*) as count,
+            MIN(s.lo) as lo, MIN(s.hi) as hi, MIN(s.total) as total,
+            MIN(s.median) as median, MIN(s.mean) as mean, MIN(s.std) as std
+        FROM f CROSS JOIN s
+        GROUP BY bin
+        ORDER BY bin
+    """
+    hist = run_query(query, params + [nbins])
+    if hist.empty:
+        return hist
+    width = (float(hist['hi'].iloc[0]) - float(hist['lo'].iloc[0])) / nbins
+    hist['bin_start'] = float(hist['lo'].iloc[0]) + (hist['bin'] - 1) * width
+    hist['bin_end'] = hist['bin_start'] + width
+    return hist
 
 def get_ward_comparison(filters):
     select = """
         m.name_en as ward,
         COUNT(*) as transactions,
         ROUND(AVG(t.unit_price)) as avg_price_m2,
-        PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY t.unit_price) as median_price_m2
+        PERCENTILE_DISC(0.5) WITHIN GROUP (ORDER BY t.unit_price) as median_price_m2
     """
     # Don't filter by municipality for comparison
     comparison_filters = {k: v for k, v in filters.items() if k != 'municipality_codes' and k != 'districts'}
 
     query = f"""
         SELECT {select}
-        FROM transactions t
+        FROM mv_transactions_clean t
         LEFT JOIN municipalities m ON t.municipality_code = m.code
-        WHERE t.unit_price IS NOT NULL
-          AND t.unit_price > 0
-          AND t.unit_price < 50000000
-          AND t.prefecture_code = %s
+        WHERE t.prefecture_code = %s
     """
     params = [comparison_filters['prefecture_code']]
 
@@ -1160,26 +1666,28 @@ def get_ward_comparison(filters):
 
     return run_query(query, params)
 
+# Labels for transactions.area_bucket (set by the ingestion trigger)
+AREA_BUCKET_LABELS = np.array(['Small (<40m²)', 'Medium (40-70m²)', 'Large (70-100m²)', 'XL (100m²+)'], dtype=object)
+
+@st.cache_data(ttl=3600, max_entries=64, hash_funcs=FILTER_HASH_FUNCS)
 def get_age_vs_price_by_area(filters):
     """Get average price by building age, grouped by area size."""
     select = """
         (t.transaction_year - t.building_year) as building_age,
-        CASE
-            WHEN t.area_m2 < 40 THEN 'Small (<40m²)'
-            WHEN t.area_m2 < 70 THEN 'Medium (40-70m²)'
-            WHEN t.area_m2 < 100 THEN 'Large (70-100m²)'
-            ELSE 'XL (100m²+)'
-        END as size_category,
+        t.area_bucket,
         ROUND(AVG(t.unit_price)) as avg_price_m2,
         COUNT(*) as count
     """
     query, params = build_query(select, filters)
-    query += " AND t.building_year IS NOT NULL"
-    query += " GROUP BY building_age, size_category"
+    query += " AND t.building_year IS NOT NULL AND t.area_bucket IS NOT NULL"
+    query += " GROUP BY building_age, t.area_bucket"
     query += " HAVING COUNT(*) >= 5"
-    query += " ORDER BY building_age, size_category"
+    query += " ORDER BY building_age, t.area_bucket"
 
-    return run_query(query, params)
+    result = run_query(query, params)
+    if not result.empty:
+        result.insert(1, 'size_category', AREA_BUCKET_LABELS[result.pop('area_bucket').to_numpy(dtype=int)])
+    return result
 
 
 def get_station_price_trends(prefecture_code, station_codes, filters, frequency='Quarterly'):
@@ -1193,36 +1701,33 @@ def get_station_price_trends(prefecture_code, station_codes, filters, frequency=
     if frequency == 'Yearly':
         select = """
             s.code as station_code,
-            COALESCE(s.name_en, s.name_ja) as station_name,
+            s.display_name as station_name,
             t.transaction_year,
             COUNT(*) as transaction_count,
             ROUND(AVG(t.unit_price)) as avg_price_m2,
-            PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY t.unit_price) as median_price_m2
+            PERCENTILE_DISC(0.5) WITHIN GROUP (ORDER BY t.unit_price) as median_price_m2
         """
-        group_by = "s.code, s.name_en, s.name_ja, t.transaction_year"
+        group_by = "s.code, s.display_name, t.transaction_year"
         order_by = "t.transaction_year, station_name"
     else:
         select = """
             s.code as station_code,
-            COALESCE(s.name_en, s.name_ja) as station_name,
+            s.display_name as station_name,
             t.transaction_year,
             t.transaction_quarter,
             COUNT(*) as transaction_count,
             ROUND(AVG(t.unit_price)) as avg_price_m2,
-            PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY t.unit_price) as median_price_m2
+            PERCENTILE_DISC(0.5) WITHIN GROUP (ORDER BY t.unit_price) as median_price_m2
         """
-        group_by = "s.code, s.name_en, s.name_ja, t.transaction_year, t.transaction_quarter"
+        group_by = "s.code, s.display_name, t.transaction_year, t.transaction_quarter"
         order_by = "t.transaction_year, t.transaction_quarter, station_name"
 
     query = f"""
         SELECT {select}
-        FROM transactions t
+        FROM mv_transactions_clean t
         JOIN stations s ON t.nearest_station_code = s.code
         WHERE t.prefecture_code = %s
           AND t.nearest_station_code = ANY(%s)
-          AND t.unit_price IS NOT NULL
-          AND t.unit_price > 0
-          AND t.unit_price < 50000000
           AND t.transaction_year BETWEEN %s AND %s
     """
     params = [prefecture_code, station_codes, year_start, year_end]
@@ -1251,7 +1756,7 @@ def get_district_price_trends(prefecture_code, municipality_codes, districts, fi
             t.transaction_year,
             COUNT(*) as transaction_count,
             ROUND(AVG(t.unit_price)) as avg_price_m2,
-            PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY t.unit_price) as median_price_m2
+            PERCENTILE_DISC(0.5) WITHIN GROUP (ORDER BY t.unit_price) as median_price_m2
         """
         group_by = "t.district_name, t.transaction_year"
         order_by = "t.transaction_year, t.district_name"
@@ -1262,19 +1767,16 @@ def get_district_price_trends(prefecture_code, municipality_codes, districts, fi
             t.transaction_quarter,
             COUNT(*) as transaction_count,
             ROUND(AVG(t.unit_price)) as avg_price_m2,
-            PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY t.unit_price) as median_price_m2
+            PERCENTILE_DISC(0.5) WITHIN GROUP (ORDER BY t.unit_price) as median_price_m2
         """
         group_by = "t.district_name, t.transaction_year, t.transaction_quarter"
         order_by = "t.transaction_year, t.transaction_quarter, t.district_name"
 
     query = f"""
         SELECT {select}
-        FROM transactions t
+        FROM mv_transactions_clean t
         WHERE t.prefecture_code = %s
           AND t.district_name = ANY(%s)
-          AND t.unit_price IS NOT NULL
-          AND t.unit_price > 0
-          AND t.unit_price < 50000000
           AND t.transaction_year BETWEEN %s AND %s
     """
     params = [prefecture_code, districts, year_start, year_end]
@@ -1293,80 +1795,85 @@ def get_district_price_trends(prefecture_code, municipality_codes, districts, fi
     return run_query(query, params)
 
 
-def get_station_rankings(prefecture_code, filters, limit=50):
-    """Get stations ranked by median price."""
-    year_start = filters.get('year_range', [2005, 2025])[0]
-    year_end = filters.get('year_range', [2005, 2025])[1]
+@st.cache_resource(ttl=3600, max_entries=4)
+def get_ranking_rows(prefecture_code):
+    """
+    Valid-price transactions for one prefecture, narrowed to what the rankings group by.
 
-    query = """
+    Fetched once per prefecture so moving the year slider or changing property types
+    re-ranks in-process instead of re-aggregating on the server. Shared across
+    sessions - callers must not mutate the frame.
+    """
+    return run_query_copy("""
         SELECT
-            s.code as station_code,
-            COALESCE(s.name_en, s.name_ja) as station_name,
-            COUNT(*) as transaction_count,
-            ROUND(AVG(t.unit_price)) as avg_price_m2,
-            PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY t.unit_price)::INTEGER as median_price_m2
-        FROM transactions t
-        JOIN stations s ON t.nearest_station_code = s.code
+            t.municipality_code,
+            t.district_name,
+            t.nearest_station_code,
+            t.property_type_raw,
+            t.transaction_year,
+            t.unit_price
+        FROM mv_transactions_clean t
         WHERE t.prefecture_code = %s
-          AND t.unit_price IS NOT NULL
-          AND t.unit_price > 0
-          AND t.unit_price < 50000000
-          AND t.transaction_year BETWEEN %s AND %s
-    """
-    params = [prefecture_code, year_start, year_end]
-
+    """, (prefecture_code,), dtype={
+        'municipality_code': 'category',
+        'district_name': 'category',
+        'nearest_station_code': 'category',
+        'property_type_raw': 'category',
+        'transaction_year': 'int16',
+        'unit_price': 'int32',
+    })
+
+def _select_ranking_rows(prefecture_code, filters, municipality_codes=None):
+    rows = get_ranking_rows(prefecture_code)
+    if rows.empty:
+        return rows
+    year_start, year_end = filters.get('year_range', [2005, 2025])
+    mask = rows['transaction_year'].between(year_start, year_end)
+    if municipality_codes:
+        mask &= rows['municipality_code'].isin(municipality_codes)
     if filters.get('property_types'):
-        query += " AND t.property_type_raw = ANY(%s)"
-        params.append(filters['property_types'])
+        mask &= rows['property_type_raw'].isin(filters['property_types'])
+    return rows[mask]
 
-    query += f"""
-        GROUP BY s.code, s.name_en, s.name_ja
-        HAVING COUNT(*) >= 10
-        ORDER BY median_price_m2 DESC
-        LIMIT {limit}
-    """
+def _rank_by_median(rows, key, min_count, limit):
+    """Groups of rows by key with at least min_count rows, highest median price first."""
+    stats = rows.groupby(key, observed=True, sort=False)['unit_price'].agg(
+        transaction_count='size', avg_price_m2='mean', median_price_m2='median'
+    )
+    stats = stats[stats['transaction_count'] >= min_count].assign(
+        avg_price_m2=lambda df: df['avg_price_m2'].round(),
+        median_price_m2=lambda df: df['median_price_m2'].round().astype(int),
+    )
+    return stats.nlargest(limit, 'median_price_m2').reset_index()
 
-    return run_query(query, params)
+def get_station_rankings(prefecture_code, filters, limit=50):
+    """Get stations ranked by median price."""
+    rows = _select_ranking_rows(prefecture_code, filters)
+    if rows.empty:
+        return pd.DataFrame(columns=['station_code', 'station_name', 'transaction_count', 'avg_price_m2', 'median_price_m2'])
+
+    rankings = _rank_by_median(rows.dropna(subset=['nearest_station_code']), 'nearest_station_code', 10, limit)
+    rankings = rankings.rename(columns={'nearest_station_code': 'station_code'})
+    rankings['station_code'] = rankings['station_code'].astype(str)
+    names = run_query("""
+        SELECT code, display_name as station_name
+        FROM stations
+        WHERE code = ANY(%s)
+    """, (rankings['station_code'].tolist(),))
+    rankings = rankings.merge(names, left_on='station_code', right_on='code').drop(columns='code')
+    return rankings[['station_code', 'station_name', 'transaction_count', 'avg_price_m2', 'median_price_m2']]
 
 
 def get_district_rankings(prefecture_code, municipality_codes, filters, limit=50):
     """Get districts ranked by median price."""
-    year_start = filters.get('year_range', [2005, 2025])[0]
-    year_end = filters.get('year_range', [2005, 2025])[1]
-
-    query = """
-        SELECT
-            t.district_name,
-            COUNT(*) as transaction_count,
-            ROUND(AVG(t.unit_price)) as avg_price_m2,
-            PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY t.unit_price)::INTEGER as median_price_m2
-        FROM transactions t
-        WHERE t.prefecture_code = %s
-          AND t.district_name IS NOT NULL
-          AND t.district_name != ''
-          AND t.unit_price IS NOT NULL
-          AND t.unit_price > 0
-          AND t.unit_price < 50000000
-          AND t.transaction_year BETWEEN %s AND %s
-    """
-    params = [prefecture_code, year_start, year_end]
-
-    if municipality_codes:
-        query += " AND t.municipality_code = ANY(%s)"
-        params.append(municipality_codes)
-
-    if filters.get('property_types'):
-        query += " AND t.property_type_raw = ANY(%s)"
-        params.append(filters['property_types'])
-
-    query += f"""
-        GROUP BY t.district_name
-        HAVING COUNT(*) >= 5
-        ORDER BY median_price_m2 DESC
-        LIMIT {limit}
-    """
+    rows = _select_ranking_rows(prefecture_code, filters, municipality_codes)
+    if rows.empty:
+        return pd.DataFrame(columns=['district_name', 'transaction_count', 'avg_price_m2', 'median_price_m2'])
 
-    return run_query(query, params)
+    rows = rows[rows['district_name'].notna() & (rows['district_name'] != '')]
+    rankings = _rank_by_median(rows, 'district_name', 5, limit)
+    rankings['district_name'] = rankings['district_name'].astype(str)
+    return rankings
 
 # =============================================================================
 # INSIGHTS DATA FUNCTIONS
@@ -1722,7 +2229,7 @@ def get_zoning_density_data(quality_filter="exclude_critical", prefecture_code=N
     """
     return run_query(query, params)
 
-@st.cache_data(ttl=3600)
+@st.cache_data(ttl=3600, max_entries=64, hash_funcs=FILTER_HASH_FUNCS)
 def get_property_type_trends(filters):
     prefecture_code = filters.get('prefecture_code', '13')
     municipality_codes = filters.get('municipality_codes', [])
@@ -1764,43 +2271,33 @@ def get_property_type_trends(filters):
 st.title("🏠 Japan Real Estate Analytics")
 st.caption("Data source: MLIT Real Estate Information Library | 6.1M+ transactions")
 
-# Summary stats
-col1, col2, col3, col4 = st.columns(4)
-
-with st.spinner("Loading summary stats..."):
-    # Quick count query
-    count_query, count_params = build_query("COUNT(*) as count", filters)
-    count_result = run_query(count_query, count_params)
-    transaction_count = count_result['count'].iloc[0] if not count_result.empty else 0
+# Summary stats. Valuation and Insights take their own inputs rather than the sidebar
+# filters, so they skip the summary queries.
+if TAB_NAMES[get_current_tab()] not in SUMMARY_FREE_TABS:
+    col1, col2, col3, col4 = st.columns(4)
+
+    with st.spinner("Loading summary stats..."):
+        transaction_count, median_price, latest_median_price, latest_year, latest_quarter = get_summary_stats(filters)
+        if latest_median_price is None:
+            latest_median_price = median_price  # Fallback to period median
+            latest_period = f"{year_range[1]}"
+            latest_year = year_range[1]
+            latest_quarter = 4  # Default to Q4
+        else:
+            latest_period = f"{latest_year} Q{latest_quarter}"
 
-    # Period median (over entire date range)
-    median_query, median_params = build_query(
-        "PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY t.unit_price) as median",
-        filters
+    col1.metric("Matching Transactions", f"{transaction_count:,}")
+    col2.metric(
+        f"Latest Median ({latest_period})",
+        format_price(latest_median_price, year=latest_year, quarter=latest_quarter, is_unit_price=True),
+        help=f"Median price per {get_unit_label()} for {latest_period} (last data point)"
     )
-    median_result = run_query(median_query, median_params)
-    median_price = median_result['median'].iloc[0] if not median_result.empty and median_result['median'].iloc[0] else 0
-
-    # Latest median (most recent quarter - last data point)
-    latest_median_price, latest_period, latest_year, latest_quarter = get_latest_median_price(filters)
-    if latest_median_price is None:
-        latest_median_price = median_price  # Fallback to period median
-        latest_period = f"{year_range[1]}"
-        latest_year = year_range[1]
-        latest_quarter = 4  # Default to Q4
-
-col1.metric("Matching Transactions", f"{transaction_count:,}")
-col2.metric(
-    f"Latest Median ({latest_period})",
-    format_price(latest_median_price, year=latest_year, quarter=latest_quarter, is_unit_price=True),
-    help=f"Median price per {get_unit_label()} for {latest_period} (last data point)"
-)
-col3.metric(
-    f"Period Median ({year_range[0]}-{year_range[1]})",
-    format_price(median_price, is_unit_price=True),
-    help=f"Median price per {get_unit_label()} over the entire selected period"
-)
-col4.metric("Prefecture", selected_prefecture_name)
+    col3.metric(
+        f"Period Median ({year_range[0]}-{year_range[1]})",
+        format_price(median_price, is_unit_price=True),
+        help=f"Median price per {get_unit_label()} over the entire selected period"
+    )
+    col4.metric("Prefecture", selected_prefecture_name)
 
 # Share button
 display_options = {
@@ -1808,8 +2305,6 @@ display_options = {
     'use_tsubo': use_tsubo,
     'cohort_type': st.session_state.get('cohort_type', 'Building Age'),
 }
-share_query = generate_share_url(filters, TAB_NAMES[get_current_tab()], display_options)
-
 share_col1, share_col2 = st.columns([6, 1])
 with share_col2:
     if st.button("🔗 Share View", help="Copy a link to this view with your current filters"):
@@ -1818,6 +2313,10 @@ with share_col2:
 if st.session_state.get('show_share_url'):
     import streamlit.components.v1 as components
 
+    share_query = generate_share_url(filters, TAB_NAMES[get_current_tab()], display_options)
+    # The cohort radio lives in a fragment; it compares against this to refresh the URL
+    st.session_state['share_panel_cohort'] = display_options['cohort_type']
+
     # Use JavaScript to get the actual base URL and construct full share URL
     share_js = f"""
     <div id="share-container" style="font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif;">
@@ -1884,187 +2383,12 @@ selected_tab = st.radio(
 
 st.divider()
 
-# ============= CHARTS TAB =============
-if selected_tab == "📈 Charts":
-    # Dynamic chart based on chart_mode
-    if chart_mode == "Time Series":
-        st.subheader("Historical Price Trends")
-
-        with st.spinner("Loading price trends..."):
-            trends = get_price_trends(filters, frequency)
-
-        if not trends.empty:
-            if frequency == 'Yearly':
-                trends['period'] = trends['transaction_year'].astype(str)
-                trends['quarter'] = 2  # Default for yearly
-            else:
-                trends['period'] = trends['transaction_year'].astype(str) + ' Q' + trends['transaction_quarter'].astype(str)
-                trends['quarter'] = trends['transaction_quarter']
-
-            # Apply conversions for display
-            def apply_conversions(row):
-                price = float(row['median_price_m2'])  # Convert Decimal to float
-                year = int(row['transaction_year'])
-                quarter = int(row['quarter']) if 'quarter' in row else 2
-
-                # Apply FX conversion with historical rate
-                if use_fx and (year, quarter) in fx_rates:
-                    price = price * fx_rates[(year, quarter)]
-                elif use_fx and current_fx_rate:
-                    price = price * current_fx_rate
-
-                # Apply tsubo conversion
-                if use_tsubo:
-                    price = convert_to_tsubo(price)
-
-                return price
-
-            trends['display_median'] = trends.apply(apply_conversions, axis=1)
-            trends['display_avg'] = trends.apply(
-                lambda row: apply_conversions(pd.Series({
-                    'median_price_m2': float(row['avg_price_m2']),  # Convert Decimal to float
-                    'transaction_year': row['transaction_year'],
-                    'quarter': row.get('quarter', 2)
-                })), axis=1
-            )
-
-            fig = go.Figure()
-
-            unit_label = get_unit_label()
-
-            fig.add_trace(go.Scatter(
-                x=trends['period'],
-                y=trends['display_median'],
-                mode='lines+markers',
-                name=f'Median {unit_label}',
-                line=dict(color='#2E86AB', width=2)
-            ))
-
-            fig.add_trace(go.Scatter(
-                x=trends['period'],
-                y=trends['display_avg'],
-                mode='lines',
-                name=f'Average {unit_label}',
-                line=dict(color='#A23B72', width=1, dash='dash')
-            ))
-
-            fig.update_layout(
-                xaxis_title="Period",
-                yaxis_title=f"Price ({unit_label})",
-                hovermode='x unified',
-                yaxis_tickformat=',',
-                height=500
-            )
-
-            st.plotly_chart(fig, width="stretch")
-
-            # Transaction volume
-            fig2 = px.bar(
-                trends,
-                x='period',
-                y='transaction_count',
-                title='Transaction Volume',
-                labels={'transaction_count': 'Transactions', 'period': 'Period'}
-            )
-            fig2.update_layout(height=300)
-            st.plotly_chart(fig2, width="stretch")
-        else:
-            st.warning("No data available for selected filters")
-
-    elif chart_mode == "Histogram":
-        st.subheader("Price Distribution")
-
-        with st.spinner("Loading price distribution..."):
-            hist_data = get_histogram_data(filters)
-
-        if not hist_data.empty:
-            fig = px.histogram(
-                hist_data,
-                x='unit_price',
-                nbins=50,
-                title='Distribution of Price per m²',
-                labels={'unit_price': 'Price per m² (¥)', 'count': 'Count'}
-            )
-            fig.update_layout(
-                xaxis_tickformat=',',
-                height=500
-            )
-            st.plotly_chart(fig, width="stretch")
-
-            # Stats
-            stat_col1, stat_col2, stat_col3, stat_col4 = st.columns(4)
-            stat_col1.metric("Count", f"{len(hist_data):,}")
-            stat_col2.metric("Median", f"¥{hist_data['unit_price'].median():,.0f}/m²")
-            stat_col3.metric("Mean", f"¥{hist_data['unit_price'].mean():,.0f}/m²")
-            stat_col4.metric("Std Dev", f"¥{hist_data['unit_price'].std():,.0f}")
-        else:
-            st.warning("No data available for selected filters")
-
-    elif chart_mode == "Scatter (X vs Y)":
-        st.subheader(f"{scatter_y} vs {scatter_x}")
-
-        with st.spinner("Loading scatter data..."):
-            scatter_data = get_scatter_data(filters)
-
-        if not scatter_data.empty:
-            # Map axis selections to column names
-            x_col_map = {
-                "Building Age": "building_age",
-                "Area (m²)": "area_m2",
-                "Year Built": "building_year",
-                "Transaction Year": "transaction_year"
-            }
-            y_col_map = {
-                "Price per m²": "unit_price",
-                "Total Price": "trade_price"
-            }
-
-            x_col = x_col_map.get(scatter_x, "building_age")
-            y_col = y_col_map.get(scatter_y, "unit_price")
-
-            # Filter out invalid data
-            plot_data = scatter_data.dropna(subset=[x_col, y_col])
-
-            if x_col == "building_age":
-                plot_data = plot_data[(plot_data['building_age'] >= 0) & (plot_data['building_age'] <= 60)]
-
-            if not plot_data.empty:
-                fig = px.scatter(
-                    plot_data,
-                    x=x_col,
-                    y=y_col,
-                    color='structure' if 'structure' in plot_data.columns else None,
-                    opacity=0.3,
-                    trendline='ols',
-                    title=f'{scatter_y} vs {scatter_x}',
-                    labels={x_col: scatter_x, y_col: scatter_y}
-                )
-                fig.update_layout(
-                    yaxis_tickformat=',',
-                    height=600
-                )
-                st.plotly_chart(fig, width="stretch")
-
-                # Regression stats
-                if len(plot_data) > 10:
-                    from scipy import stats
-                    valid = plot_data.dropna(subset=[x_col, y_col])
-                    if len(valid) > 10:
-                        slope, intercept, r_value, p_value, std_err = stats.linregress(
-                            valid[x_col],
-                            valid[y_col]
-                        )
-                        if x_col == "building_age":
-                            st.info(f"**Regression:** {scatter_y} changes by ¥{slope:,.0f} per year of age (R² = {r_value**2:.3f})")
-                        else:
-                            st.info(f"**Regression:** R² = {r_value**2:.3f}")
-            else:
-                st.warning("No valid data for the selected axes")
-        else:
-            st.warning("No data available for selected filters")
+# Heavy tabs render inside st.fragment: interacting with their own widgets reruns
+# only the fragment, not the sidebar, summary stats and the rest of the script.
 
-# ============= MAP TAB =============
-elif selected_tab == "🗺️ Map":
+@st.fragment
+def render_map_tab():
+    """Map tab. Runs as a fragment so toggling the map mode does not rerun the summary queries."""
     st.subheader(f"Price Map: {selected_prefecture_name}")
 
     # Toggle for data mode
@@ -2084,49 +2408,49 @@ elif selected_tab == "🗺️ Map":
         # Apply conversions
         unit_label = get_unit_label()
 
-        def convert_map_price(price):
-            if price is None:
-                return None
-            result = float(price)  # Convert Decimal to float
-            if use_fx and current_fx_rate:
-                result = result * current_fx_rate
-            if use_tsubo:
-                result = convert_to_tsubo(result)
-            return result
+        map_data['display_median'] = convert_price_series(map_data['median_price_m2'])
+        map_data['display_avg'] = convert_price_series(map_data['avg_price_m2'])
 
-        map_data['display_median'] = map_data['median_price_m2'].apply(convert_map_price)
-        map_data['display_avg'] = map_data['avg_price_m2'].apply(convert_map_price)
+        # Plot from plain arrays with graph_objects: plotly express would rebuild a
+        # long-form frame from the DataFrame for every chart.
+        names = map_data['name'].to_numpy()
+        medians = map_data['display_median'].to_numpy(dtype=float)
+        counts = map_data['transactions'].to_numpy()
 
         # Create bar chart (map choropleth would need GeoJSON which is complex)
-        fig = px.bar(
-            map_data.head(30),
-            x='name',
-            y='display_median',
-            color='display_median',
-            color_continuous_scale='RdYlGn_r',
-            title=f'Median Price by Ward/City ({unit_label}) - {map_mode}',
-            labels={'display_median': unit_label, 'name': 'Ward/City'},
-            text='transactions'
-        )
+        top = slice(0, 30)
+        fig = go.Figure(go.Bar(
+            x=names[top],
+            y=medians[top],
+            text=counts[top],
+            texttemplate='%{text:,}',
+            textposition='outside',
+            marker=dict(color=medians[top], colorscale='RdYlGn_r', showscale=True,
+                        colorbar=dict(title=unit_label)),
+            hovertemplate=f'Ward/City=%{{x}}<br>{unit_label}=%{{y:,.0f}}<br>transactions=%{{text:,}}<extra></extra>'
+        ))
         fig.update_layout(
+            title=f'Median Price by Ward/City ({unit_label}) - {map_mode}',
+            xaxis_title='Ward/City',
+            yaxis_title=unit_label,
             xaxis_tickangle=-45,
             yaxis_tickformat=',',
             height=500,
             showlegend=False
         )
-        fig.update_traces(texttemplate='%{text:,}', textposition='outside')
         st.plotly_chart(fig, width="stretch")
 
         # Also show as a treemap for visual comparison
         st.subheader("Price Treemap")
-        fig2 = px.treemap(
-            map_data,
-            path=['name'],
-            values='transactions',
-            color='display_median',
-            color_continuous_scale='RdYlGn_r',
-            title=f'Transactions by Area (color = {unit_label})'
-        )
+        fig2 = go.Figure(go.Treemap(
+            labels=names,
+            parents=[""] * len(names),
+            values=counts,
+            marker=dict(colors=medians, colorscale='RdYlGn_r', showscale=True,
+                        colorbar=dict(title=unit_label)),
+            hovertemplate=f'%{{label}}<br>transactions=%{{value:,}}<br>{unit_label}=%{{color:,.0f}}<extra></extra>'
+        ))
+        fig2.update_layout(title=f'Transactions by Area (color = {unit_label})')
         fig2.update_layout(height=500)
         st.plotly_chart(fig2, width="stretch")
 
@@ -2158,70 +2482,547 @@ elif selected_tab == "🗺️ Map":
     else:
         st.warning("No data available for selected filters")
 
-# ============= COHORTS TAB =============
-elif selected_tab == "📊 Cohorts":
-    st.subheader("Cohort Analysis")
-    st.caption("Compare price trends across different market segments over time. Sidebar filters are applied before analysis.")
 
-    # Cohort type selector - get default from URL params
-    cohort_options = ["Building Age", "Property Size", "Total Price"]
-    url_cohort = st.query_params.get("cohort", "Building Age")
-    url_cohort_idx = cohort_options.index(url_cohort) if url_cohort in cohort_options else 0
+@st.fragment
+def render_valuation_tab():
+    """Valuation tab. Runs as a fragment so the valuation form only reruns this tab."""
+    st.subheader("Property Valuation")
 
-    col_cohort_type, col_threshold = st.columns([3, 1])
-    with col_cohort_type:
-        cohort_type = st.radio(
-            "Cohort Type",
-            options=cohort_options,
-            index=url_cohort_idx,
-            horizontal=True,
-            key="cohort_type",
-            help="Choose how to segment the market for comparison"
-        )
-    with col_threshold:
-        min_transactions = st.number_input(
-            "Min transactions/quarter",
-            min_value=1,
-            max_value=20,
-            value=5,
-            help="Minimum transactions per quarter to include in price charts. Lower values show more data but may be noisy."
-        )
+    # Toggle between valuation modes
+    valuation_mode = st.radio(
+        "Mode",
+        options=["Estimate Value", "Check Listing Price", "Track Depreciation"],
+        horizontal=True,
+        key="valuation_mode"
+    )
 
-    # Cohort options based on type
-    if cohort_type == "Building Age":
-        selected_cohorts = st.multiselect(
-            "Age Cohorts (years)",
-            options=[5, 10, 15, 20, 25, 30, 35, 40, 50],
-            default=[10, 20, 30],
-            help="Select building ages to compare. Each cohort shows apartments that were X years old at the time of transaction."
-        )
-        cohort_field = "building_age"
-        cohort_label = "Building Age"
+    val_col1, val_col2 = st.columns(2)
 
-    elif cohort_type == "Property Size":
-        size_options = {
-            "Compact (≤30m²)": (0, 30),
-            "Small (>30-50m²)": (30, 50),
-            "Medium (>50-70m²)": (50, 70),
-            "Large (>70-100m²)": (70, 100),
-            "XL (>100m²)": (100, 9999),
-        }
-        selected_cohort_names = st.multiselect(
-            "Size Cohorts",
-            options=list(size_options.keys()),
-            default=list(size_options.keys()),
-            help="Select property size ranges to compare"
+    with val_col1:
+        st.markdown("##### Property Details")
+
+        val_municipality = st.selectbox(
+            "Ward / City",
+            options=("", *municipality_options),
+            key="val_municipality"
         )
-        selected_cohorts = [size_options[name] for name in selected_cohort_names]
-        cohort_field = "area_m2"
-        cohort_label = "Size"
 
-    else:  # Total Price
-        price_options = {
-            "Entry (≤30M¥)": (0, 30),
-            "Affordable (>30-50M¥)": (30, 50),
-            "Mid-range (>50-80M¥)": (50, 80),
-            "Upper (>80-120M¥)": (80, 120),
+        # Show district only for Estimate Value and Check Listing modes
+        if valuation_mode != "Track Depreciation":
+            val_district = st.text_input(
+                "District / Address (optional)",
+                placeholder="e.g. Roppongi 1-chome",
+                key="val_district"
+            )
+
+            val_property_type = st.selectbox(
+                "Property Type",
+                options=property_type_list,
+                key="val_property_type"
+            )
+        else:
+            val_district = None
+            val_property_type = "Pre-owned Condominiums, etc."
+
+        # Show listing price input only in "Check Listing Price" mode
+        if valuation_mode == "Check Listing Price":
+            val_listing_price = st.number_input(
+                "Listing Price (¥)",
+                min_value=1000000,
+                max_value=2000000000,
+                value=50000000,
+                step=1000000,
+                format="%d",
+                key="val_listing_price"
+            )
+        else:
+            val_listing_price = None
+
+        # Show purchase info for depreciation mode
+        if valuation_mode == "Track Depreciation":
+            dep_purchase_year = st.number_input(
+                "Year Purchased",
+                min_value=2005,
+                max_value=max_year,
+                value=2015,
+                step=1,
+                key="dep_purchase_year"
+            )
+
+            dep_purchase_price = st.number_input(
+                "Purchase Price (¥)",
+                min_value=1000000,
+                max_value=2000000000,
+                value=50000000,
+                step=1000000,
+                format="%d",
+                key="dep_purchase_price"
+            )
+
+        val_area = st.number_input(
+            "Area (m²)",
+            min_value=10.0,
+            max_value=500.0,
+            value=60.0,
+            step=5.0,
+            key="val_area"
+        )
+
+        val_building_year = st.number_input(
+            "Year Built",
+            min_value=1960,
+            max_value=2025,
+            value=2010,
+            step=1,
+            key="val_building_year"
+        )
+
+        if valuation_mode != "Track Depreciation":
+            val_floor_plan = st.selectbox(
+                "Layout (optional)",
+                options=["", "1K", "1DK", "1LDK", "2K", "2DK", "2LDK", "3K", "3DK", "3LDK", "4LDK+"],
+                key="val_floor_plan"
+            )
+        else:
+            val_floor_plan = None
+
+        if valuation_mode == "Estimate Value":
+            action_button = st.button("💰 Estimate Value", type="primary", width="stretch")
+        elif valuation_mode == "Check Listing Price":
+            action_button = st.button("🔍 Check Listing", type="primary", width="stretch")
+        else:
+            action_button = st.button("📉 Calculate Depreciation", type="primary", width="stretch")
+
+    with val_col2:
+        if valuation_mode == "Estimate Value":
+            st.markdown("##### Estimated Value")
+        elif valuation_mode == "Check Listing Price":
+            st.markdown("##### Market Comparison")
+        else:
+            st.markdown("##### Estimated Current Value")
+
+        if action_button and val_municipality:
+            current_year = year_range[1]
+            building_age = current_year - val_building_year
+            val_muni_code = municipality_options[val_municipality]
+
+            # Track Depreciation mode has different logic
+            if valuation_mode == "Track Depreciation":
+                # Get historical prices for similar properties
+                # Precomputed 10m² area-bin medians; the bins spanning the ±30% window
+                # are combined as a transaction-weighted mean of their medians
+                dep_query = """
+                    SELECT
+                        transaction_year,
+                        (SUM(median_price_m2::float8 * transaction_count) / SUM(transaction_count))::INTEGER as median_price_m2,
+                        SUM(transaction_count)::INTEGER as count
+                    FROM mv_condo_area_prices
+                    WHERE municipality_code = %s
+                      AND area_bin BETWEEN width_bucket(%s::float8, 10, 200, 19)
+                                       AND width_bucket(%s::float8, 10, 200, 19)
+                    GROUP BY transaction_year
+                    HAVING SUM(transaction_count) >= 5
+                    ORDER BY transaction_year
+                """
+                dep_params = [val_muni_code, val_area * 0.7, val_area * 1.3]
+
+                with st.spinner("Calculating depreciation..."):
+                    dep_data = run_query(dep_query, dep_params)
+
+                if not dep_data.empty and len(dep_data) >= 2:
+                    # Get price at purchase year and current year
+                    yearly_medians = dep_data.set_index('transaction_year')['median_price_m2']
+                    purchase_price_m2 = yearly_medians.get(dep_purchase_year)
+                    current_price_m2 = yearly_medians.get(max_year)
+
+                    if purchase_price_m2 is not None and current_price_m2 is not None:
+                        purchase_price_m2 = float(purchase_price_m2)
+                        current_price_m2 = float(current_price_m2)
+
+                        # Calculate market appreciation/depreciation
+                        market_change = (current_price_m2 - purchase_price_m2) / purchase_price_m2
+
+                        # Estimate current value based on market change
+                        estimated_current = dep_purchase_price * (1 + market_change)
+                        value_change = estimated_current - dep_purchase_price
+                        value_change_pct = market_change * 100
+
+                        # Building age effect
+                        years_held = max_year - dep_purchase_year
+                        age_at_purchase = dep_purchase_year - val_building_year
+                        age_now = max_year - val_building_year
+
+                        if value_change >= 0:
+                            st.success(f"### ¥{estimated_current:,.0f}")
+                            st.caption(f"Estimated appreciation: ¥{value_change:+,.0f} ({value_change_pct:+.1f}%)")
+                        else:
+                            st.error(f"### ¥{estimated_current:,.0f}")
+                            st.caption(f"Estimated depreciation: ¥{value_change:+,.0f} ({value_change_pct:+.1f}%)")
+
+                        st.markdown(f"""
+                        | Metric | Value |
+                        |--------|-------|
+                        | **Purchase Price** | ¥{dep_purchase_price:,.0f} |
+                        | **Estimated Current Value** | ¥{estimated_current:,.0f} |
+                        | **Change** | ¥{value_change:+,.0f} ({value_change_pct:+.1f}%) |
+                        | **Years Held** | {years_held} years |
+                        | **Age at Purchase** | {age_at_purchase} years old |
+                        | **Age Now** | {age_now} years old |
+                        | **Market Price/m² (at purchase)** | ¥{purchase_price_m2:,.0f} |
+                        | **Market Price/m² (now)** | ¥{current_price_m2:,.0f} |
+                        """)
+
+                        # Show historical trend
+                        st.divider()
+                        st.markdown("##### Market Trend for Similar Properties")
+
+                        fig = go.Figure(go.Scatter(
+                            x=dep_data['transaction_year'].to_numpy(),
+                            y=dep_data['median_price_m2'].to_numpy(),
+                            mode='lines+markers',
+                            hovertemplate='Year=%{x}<br>¥/m²=%{y:,}<extra></extra>'
+                        ), layout=DEPRECIATION_CHART_LAYOUT)
+
+                        # Add markers for purchase and current
+                        fig.add_vline(x=dep_purchase_year, line_dash="dash", line_color="green",
+                                     annotation_text="Purchased")
+                        fig.add_vline(x=max_year, line_dash="dash", line_color="blue",
+                                     annotation_text="Now")
+
+                        st.plotly_chart(fig, width="stretch")
+
+                    else:
+                        st.warning("Not enough data for the purchase year or current year. Try adjusting the parameters.")
+                else:
+                    st.warning("Not enough comparable transactions found. Try selecting a different ward or adjusting the area.")
+
+            else:
+                # Estimate Value and Check Listing modes
+                comp_query = """
+                    SELECT
+                        t.trade_price,
+                        t.unit_price,
+                        t.area_m2,
+                        t.building_year,
+                        t.transaction_year - t.building_year as building_age,
+                        t.floor_plan,
+                        t.district_name,
+                        t.transaction_year,
+                        t.transaction_quarter
+                    FROM transactions t
+                    WHERE t.municipality_code = %s
+                      AND t.property_type_raw = %s
+                      AND t.unit_price IS NOT NULL
+                      AND t.unit_price > 0
+                      AND t.unit_price < 50000000
+                      AND t.transaction_year >= %s
+                      AND t.area_m2 BETWEEN %s AND %s
+                """
+                comp_params = [
+                    val_muni_code,
+                    val_property_type,
+                    current_year - 3,
+                    val_area * 0.7,
+                    val_area * 1.3
+                ]
+
+                if val_building_year > 0:
+                    comp_query += " AND t.building_year IS NOT NULL"
+                    comp_query += " AND (t.transaction_year - t.building_year) BETWEEN %s AND %s"
+                    comp_params.extend([max(0, building_age - 10), building_age + 10])
+
+                if val_floor_plan:
+                    comp_query += " AND t.floor_plan = %s"
+                    comp_params.append(val_floor_plan)
+
+                if val_district:
+                    val_district = val_district.strip()
+                    if val_district in get_districts([val_muni_code]):
+                        # A full district name: equality rides idx_tx_district
+                        comp_query += " AND t.district_name = %s"
+                        comp_params.append(val_district)
+                    else:
+                        # Substring search, served by the trigram index; LIKE wildcards
+                        # typed by the user are matched literally
+                        escaped = re.sub(r"([\\%_])", r"\\\1", val_district)
+                        comp_query += " AND t.district_name ILIKE %s"
+                        comp_params.append(f"%{escaped}%")
+
+                comp_query += " ORDER BY t.transaction_year DESC, t.transaction_quarter DESC LIMIT %s"
+                listing_price_per_m2 = val_listing_price / val_area if val_listing_price else 0.0
+
+                # Statistics, the 20-bin price histogram and the 10 rows shown in the table,
+                # all over the 100 most recent comparables, come back as one row.
+                comp_stats_query = f"""
+                    WITH c AS MATERIALIZED ({comp_query}),
+                    s AS (SELECT MIN(unit_price) as lo, MAX(unit_price) + 1 as hi FROM c)
+                    SELECT
+                        COUNT(*) as count,
+                        PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY c.unit_price) as median,
+                        STDDEV_SAMP(c.unit_price) as std,
+                        AVG(CASE WHEN c.unit_price < %s::float8 THEN 100.0 ELSE 0.0 END) as listing_percentile,
+                        MIN(s.lo) as lo,
+                        MIN(s.hi) as hi,
+                        (
+                            SELECT json_agg(json_build_object('bin', b.bin, 'count', b.count) ORDER BY b.bin)
+                            FROM (
+                                SELECT width_bucket(c.unit_price, s.lo, s.hi, 20) as bin, COUNT(*) as count
+                                FROM c CROSS JOIN s
+                                GROUP BY bin
+                            ) b
+                        ) as histogram,
+                        (
+                            SELECT json_agg(r ORDER BY r.transaction_year DESC, r.transaction_quarter DESC)
+                            FROM (
+                                SELECT * FROM c
+                                ORDER BY transaction_year DESC, transaction_quarter DESC
+                                LIMIT 10
+                            ) r
+                        ) as recent
+                    FROM c CROSS JOIN s
+                """
+
+                with st.spinner("Finding comparable properties..."):
+                    comp_stats = run_query(comp_stats_query, comp_params + [100, listing_price_per_m2]).iloc[0]
+                comparables = pd.DataFrame.from_records(comp_stats['recent'] or [])
+
+                comp_count = int(comp_stats['count'])
+                if comp_count >= 3:
+                    median_unit_price = float(comp_stats['median'])
+                    std_unit_price = float(comp_stats['std'])
+
+                    if valuation_mode == "Estimate Value":
+                        # Valuation mode
+                        estimated_price_median = median_unit_price * val_area
+                        low_estimate = (median_unit_price - std_unit_price) * val_area
+                        high_estimate = (median_unit_price + std_unit_price) * val_area
+
+                        st.metric(
+                            "Estimated Market Value",
+                            f"¥{estimated_price_median:,.0f}",
+                            help="Based on median price per m² of comparable transactions"
+                        )
+
+                        st.markdown(f"""
+                        | Metric | Value |
+                        |--------|-------|
+                        | **Low Estimate** | ¥{max(0, low_estimate):,.0f} |
+                        | **Median Estimate** | ¥{estimated_price_median:,.0f} |
+                        | **High Estimate** | ¥{high_estimate:,.0f} |
+                        | **Price per m² (Median)** | ¥{median_unit_price:,.0f} |
+                        | **Comparable Transactions** | {comp_count} |
+                        """)
+
+                    else:
+                        # Check Listing mode
+                        fair_value = median_unit_price * val_area
+                        price_diff = val_listing_price - fair_value
+                        price_diff_pct = (price_diff / fair_value) * 100
+                        percentile = float(comp_stats['listing_percentile'])
+
+                        verdict_icon, verdict, verdict_detail, verdict_class = LISTING_VERDICTS[
+                            np.searchsorted(LISTING_VERDICT_THRESHOLDS, price_diff_pct, side='right')
+                        ]
+
+                        st.markdown(f"### {verdict_icon} {verdict}")
+                        st.caption(verdict_detail)
+
+                        st.markdown(f"""
+                        | Metric | Value |
+                        |--------|-------|
+                        | **Listing Price** | ¥{val_listing_price:,.0f} |
+                        | **Listing ¥/m²** | ¥{listing_price_per_m2:,.0f} |
+                        | **Market Median ¥/m²** | ¥{median_unit_price:,.0f} |
+                        | **Fair Value Estimate** | ¥{fair_value:,.0f} |
+                        | **Difference** | ¥{price_diff:+,.0f} ({price_diff_pct:+.1f}%) |
+                        | **Price Percentile** | {percentile:.0f}% |
+                        | **Comparables Found** | {comp_count} |
+                        """)
+
+                    st.divider()
+                    st.markdown("##### Recent Comparable Sales")
+
+                    display_cols = ['transaction_year', 'transaction_quarter', 'district_name',
+                                   'area_m2', 'building_age', 'unit_price', 'trade_price']
+                    display_data = comparables[[c for c in display_cols if c in comparables.columns]].astype(
+                        {'district_name': 'category', 'area_m2': 'float32'}
+                    )
+
+                    st.dataframe(
+                        display_data,
+                        column_config={
+                            'trade_price': st.column_config.NumberColumn(format="yen"),
+                            'unit_price': st.column_config.NumberColumn(format="yen"),
+                            'area_m2': st.column_config.NumberColumn(format="%.1f m²"),
+                            'building_age': st.column_config.NumberColumn(format="%d yr")
+                        },
+                        width="stretch",
+                        height=350
+                    )
+
+                    # The distribution chart and the report need a real sample; below that
+                    # the estimate and the recent sales above are all that is shown
+                    if comp_count < MIN_COMPARABLES_FOR_REPORT:
+                        st.info(f"Only {comp_count} comparables: the price distribution and downloadable report "
+                                f"need at least {MIN_COMPARABLES_FOR_REPORT}. Widen the area or drop the layout filter for more.")
+                    else:
+                        # Price distribution
+                        bins = pd.DataFrame(comp_stats['histogram'])
+                        width = (float(comp_stats['hi']) - float(comp_stats['lo'])) / 20
+                        bin_start = float(comp_stats['lo']) + (bins['bin'].to_numpy() - 1) * width
+                        fig = go.Figure(go.Bar(
+                            x=bin_start + width / 2,
+                            y=bins['count'].to_numpy(),
+                            width=width,
+                            customdata=np.column_stack([bin_start, bin_start + width]),
+                            hovertemplate='¥%{customdata[0]:,.0f} - ¥%{customdata[1]:,.0f}<br>Count: %{y:,}<extra></extra>',
+                        ))
+                        fig.update_layout(
+                            title='Price Distribution of Comparable Properties',
+                            xaxis_title='Price per m² (¥)',
+                            yaxis_title='count',
+                            bargap=0
+                        )
+                        fig.add_vline(x=median_unit_price, line_dash="dash", line_color="green",
+                                     annotation_text=f"Median: ¥{median_unit_price:,.0f}")
+                        if valuation_mode == "Check Listing Price":
+                            fig.add_vline(x=listing_price_per_m2, line_dash="solid", line_color="red", line_width=3,
+                                         annotation_text=f"Listing: ¥{listing_price_per_m2:,.0f}")
+                        fig.update_layout(height=300, xaxis_tickformat=',')
+                        st.plotly_chart(fig, width="stretch")
+
+                        # PDF Export button
+                        st.divider()
+
+                        # Prepare valuation data for PDF
+                        valuation_pdf_data = {
+                            'location': val_municipality,
+                            'district': val_district or 'Not specified',
+                            'property_type': val_property_type,
+                            'area': val_area,
+                            'building_year': val_building_year,
+                            'building_age': building_age,
+                            'floor_plan': val_floor_plan or 'Not specified',
+                            'median_price_m2': median_unit_price,
+                            'comparable_count': comp_count,
+                        }
+
+                        if valuation_mode == "Estimate Value":
+                            valuation_pdf_data.update({
+                                'estimated_value': estimated_price_median,
+                                'low_estimate': max(0, low_estimate),
+                                'high_estimate': high_estimate,
+                                'verdict': 'Estimated Market Value',
+                                'verdict_class': 'fair',
+                            })
+                        else:  # Check Listing Price
+                            valuation_pdf_data.update({
+                                'estimated_value': fair_value,
+                                'low_estimate': (median_unit_price - std_unit_price) * val_area,
+                                'high_estimate': (median_unit_price + std_unit_price) * val_area,
+                                'listing_price': val_listing_price,
+                                'listing_price_m2': listing_price_per_m2,
+                                'price_diff': price_diff,
+                                'price_diff_pct': price_diff_pct,
+                                'percentile': percentile,
+                                'verdict': verdict,
+                                'verdict_class': verdict_class,
+                            })
+
+                        pdf_html = generate_valuation_pdf(valuation_pdf_data)
+
+                        st.download_button(
+                            label="📄 Download Valuation Report (HTML)",
+                            data=pdf_html,
+                            file_name=f"valuation_report_{val_municipality}_{datetime.now().strftime('%Y%m%d')}.html",
+                            mime="text/html",
+                            help="Download a printable HTML report. Open in browser and use Print → Save as PDF for a PDF version."
+                        )
+
+                else:
+                    st.warning(f"Only {comp_count} comparable transactions found. Try adjusting criteria.")
+                    st.info("Tips: Remove floor plan filter, widen the district search, or increase the area range.")
+
+        elif action_button:
+            st.warning("Please select a Ward/City")
+        else:
+            if valuation_mode == "Estimate Value":
+                st.info("👈 Enter property details and click **Estimate Value**")
+            elif valuation_mode == "Check Listing Price":
+                st.info("👈 Enter listing details and click **Check Listing**")
+            else:
+                st.info("👈 Enter your property details and click **Calculate Depreciation**")
+
+
+@st.fragment
+def render_cohorts_tab():
+    """Cohorts tab. Runs as a fragment so changing the cohort controls only reruns this tab."""
+    st.subheader("Cohort Analysis")
+    st.caption("Compare price trends across different market segments over time. Sidebar filters are applied before analysis.")
+
+    # Cohort type selector - get default from URL params
+    cohort_options = ["Building Age", "Property Size", "Total Price"]
+    url_cohort = st.query_params.get("cohort", "Building Age")
+    url_cohort_idx = cohort_options.index(url_cohort) if url_cohort in cohort_options else 0
+
+    col_cohort_type, col_threshold = st.columns([3, 1])
+    with col_cohort_type:
+        cohort_type = st.radio(
+            "Cohort Type",
+            options=cohort_options,
+            index=url_cohort_idx,
+            horizontal=True,
+            key="cohort_type",
+            help="Choose how to segment the market for comparison"
+        )
+    # A fragment rerun leaves the share panel (built outside) with the old cohort;
+    # rerun the whole app so its URL picks up the new one
+    if st.session_state.get('show_share_url') and st.session_state.get('share_panel_cohort') != cohort_type:
+        st.rerun()
+    with col_threshold:
+        min_transactions = st.number_input(
+            "Min transactions/quarter",
+            min_value=1,
+            max_value=20,
+            value=5,
+            help="Minimum transactions per quarter to include in price charts. Lower values show more data but may be noisy."
+        )
+
+    # Cohort options based on type
+    if cohort_type == "Building Age":
+        selected_cohorts = st.multiselect(
+            "Age Cohorts (years)",
+            options=[5, 10, 15, 20, 25, 30, 35, 40, 50],
+            default=[10, 20, 30],
+            help="Select building ages to compare. Each cohort shows apartments that were X years old at the time of transaction."
+        )
+        cohort_field = "building_age"
+        cohort_label = "Building Age"
+
+    elif cohort_type == "Property Size":
+        size_options = {
+            "Compact (≤30m²)": (0, 30),
+            "Small (>30-50m²)": (30, 50),
+            "Medium (>50-70m²)": (50, 70),
+            "Large (>70-100m²)": (70, 100),
+            "XL (>100m²)": (100, 9999),
+        }
+        selected_cohort_names = st.multiselect(
+            "Size Cohorts",
+            options=list(size_options.keys()),
+            default=list(size_options.keys()),
+            help="Select property size ranges to compare"
+        )
+        selected_cohorts = [size_options[name] for name in selected_cohort_names]
+        cohort_field = "area_m2"
+        cohort_label = "Size"
+
+    else:  # Total Price
+        price_options = {
+            "Entry (≤30M¥)": (0, 30),
+            "Affordable (>30-50M¥)": (30, 50),
+            "Mid-range (>50-80M¥)": (50, 80),
+            "Upper (>80-120M¥)": (80, 120),
             "Premium (>120-200M¥)": (120, 200),
             "Luxury (>200M¥)": (200, 9999),
         }
@@ -2236,39 +3037,48 @@ elif selected_tab == "📊 Cohorts":
         cohort_label = "Price Range"
 
     if selected_cohorts:
-        # Build query based on cohort type
+        # Cohort assignment and aggregation run in the database; only one row per
+        # (quarter, cohort) comes back. Age cohorts take the nearest selected age within
+        # two years, range cohorts the first (low, high] range containing the value.
         if cohort_type == "Building Age":
-            cohort_query = """
-                SELECT
-                    t.transaction_year,
-                    t.transaction_quarter,
-                    (t.transaction_year - t.building_year) as building_age,
-                    t.unit_price,
-                    t.trade_price,
-                    t.area_m2
-                FROM transactions t
-                WHERE t.prefecture_code = %s
-                  AND t.unit_price IS NOT NULL
-                  AND t.unit_price > 0
-                  AND t.unit_price < 50000000
-                  AND t.building_year IS NOT NULL
-                  AND t.transaction_year BETWEEN %s AND %s
+            cohort_value = "(t.transaction_year - t.building_year)"
+            cohort_match = """
+                SELECT b.bucket || 'yr' as cohort
+                FROM unnest(%s::int[]) b(bucket)
+                WHERE abs(f.cohort_value - b.bucket) <= 2
+                ORDER BY abs(f.cohort_value - b.bucket), b.bucket
+                LIMIT 1
             """
+            match_params = [sorted(selected_cohorts)]
         else:
-            cohort_query = """
-                SELECT
-                    t.transaction_year,
-                    t.transaction_quarter,
-                    t.unit_price,
-                    t.trade_price,
-                    t.area_m2
-                FROM transactions t
-                WHERE t.prefecture_code = %s
-                  AND t.unit_price IS NOT NULL
-                  AND t.unit_price > 0
-                  AND t.unit_price < 50000000
-                  AND t.transaction_year BETWEEN %s AND %s
+            cohort_value = "t.area_m2" if cohort_type == "Property Size" else "t.trade_price / 1000000.0"
+            cohort_match = """
+                SELECT r.name as cohort
+                FROM unnest(%s::text[], %s::float8[], %s::float8[]) WITH ORDINALITY r(name, low, high, ord)
+                WHERE f.cohort_value <= r.high AND (f.cohort_value > r.low OR r.low = 0)
+                ORDER BY r.ord
+                LIMIT 1
             """
+            match_params = [
+                selected_cohort_names,
+                [float(low) for low, _ in selected_cohorts],
+                [float(high) for _, high in selected_cohorts],
+            ]
+
+        cohort_query = f"""
+            SELECT
+                t.transaction_year,
+                t.transaction_quarter,
+                {cohort_value} as cohort_value,
+                t.unit_price
+            FROM transactions t
+            WHERE t.prefecture_code = %s
+              AND t.unit_price IS NOT NULL
+              AND t.unit_price > 0
+              AND t.unit_price < 50000000
+              AND {cohort_value} IS NOT NULL
+              AND t.transaction_year BETWEEN %s AND %s
+        """
 
         cohort_params = [selected_prefecture, year_range[0], year_range[1]]
 
@@ -2308,241 +3118,181 @@ elif selected_tab == "📊 Cohorts":
             cohort_query += " AND t.district_name = ANY(%s)"
             cohort_params.append(filters['districts'])
 
-        with st.spinner("Loading cohort data..."):
-            cohort_data = run_query(cohort_query, cohort_params)
-
-        if not cohort_data.empty:
-            # Create period column
-            cohort_data['period'] = cohort_data['transaction_year'].astype(str) + ' Q' + cohort_data['transaction_quarter'].astype(str)
-
-            # Assign cohort based on type
-            if cohort_type == "Building Age":
-                def assign_age_bucket(age, buckets):
-                    for bucket in sorted(buckets):
-                        if abs(age - bucket) <= 2:
-                            return f"{bucket}yr"
-                    return None
-                cohort_data['cohort'] = cohort_data['building_age'].apply(lambda x: assign_age_bucket(x, selected_cohorts))
-
-            elif cohort_type == "Property Size":
-                def assign_size_bucket(area):
-                    for name, (low, high) in zip(selected_cohort_names, selected_cohorts):
-                        if low == 0:  # First bucket: ≤ high
-                            if area <= high:
-                                return name
-                        else:  # Other buckets: > low and ≤ high
-                            if low < area <= high:
-                                return name
-                    return None
-                cohort_data['cohort'] = cohort_data['area_m2'].apply(assign_size_bucket)
-
-            else:  # Total Price
-                def assign_price_bucket(price):
-                    price_m = price / 1_000_000  # Convert to millions
-                    for name, (low, high) in zip(selected_cohort_names, selected_cohorts):
-                        if low == 0:  # First bucket: ≤ high
-                            if price_m <= high:
-                                return name
-                        else:  # Other buckets: > low and ≤ high
-                            if low < price_m <= high:
-                                return name
-                    return None
-                cohort_data['cohort'] = cohort_data['trade_price'].apply(assign_price_bucket)
-
-            cohort_data = cohort_data[cohort_data['cohort'].notna()]
-
-            if not cohort_data.empty:
-                # Aggregate by period and cohort
-                agg_data = cohort_data.groupby(['transaction_year', 'transaction_quarter', 'cohort']).agg(
-                    median_price=('unit_price', 'median'),
-                    avg_price=('unit_price', 'mean'),
-                    count=('unit_price', 'count')
-                ).reset_index()
-                agg_data['period'] = agg_data['transaction_year'].astype(str) + ' Q' + agg_data['transaction_quarter'].astype(str)
-
-                # Sort by year and quarter for proper x-axis ordering
-                agg_data = agg_data.sort_values(['transaction_year', 'transaction_quarter'])
-
-                # Keep unfiltered data for volume chart
-                agg_data_all = agg_data.copy()
-
-                # Check for low volume cohorts before filtering
-                cohort_volumes = agg_data.groupby('cohort')['count'].sum()
-                low_volume_cohorts = cohort_volumes[cohort_volumes < 50].index.tolist()
-
-                # Filter to cohorts with enough data for price charts
-                agg_data = agg_data[agg_data['count'] >= min_transactions]
-
-                if not agg_data.empty:
-                    # Apply currency/tsubo conversions
-                    unit_label = get_unit_label()
-
-                    def convert_cohort_price(row):
-                        price = float(row['median_price'])
-                        year = int(row['transaction_year'])
-                        quarter = int(row['transaction_quarter'])
-
-                        if use_fx and (year, quarter) in fx_rates:
-                            price = price * fx_rates[(year, quarter)]
-                        elif use_fx and current_fx_rate:
-                            price = price * current_fx_rate
-
-                        if use_tsubo:
-                            price = convert_to_tsubo(price)
+        cohort_query = f"""
+            WITH f AS ({cohort_query})
+            SELECT
+                f.transaction_year,
+                f.transaction_quarter,
+                c.cohort,
+                PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY f.unit_price) as median_price,
+                AVG(f.unit_price) as avg_price,
+                COUNT(*) as count
+            FROM f
+            CROSS JOIN LATERAL ({cohort_match}) c
+            GROUP BY f.transaction_year, f.transaction_quarter, c.cohort
+            ORDER BY f.transaction_year, f.transaction_quarter, c.cohort
+        """
 
-                        return price
+        with st.spinner("Loading cohort data..."):
+            agg_data = run_query(cohort_query, cohort_params + match_params)
 
-                    def convert_cohort_avg(row):
-                        price = float(row['avg_price'])
-                        year = int(row['transaction_year'])
-                        quarter = int(row['transaction_quarter'])
+        if not agg_data.empty:
+            agg_data['period'] = agg_data['transaction_year'].astype(str) + ' Q' + agg_data['transaction_quarter'].astype(str)
 
-                        if use_fx and (year, quarter) in fx_rates:
-                            price = price * fx_rates[(year, quarter)]
-                        elif use_fx and current_fx_rate:
-                            price = price * current_fx_rate
+            # Sort by year and quarter for proper x-axis ordering
+            agg_data = agg_data.sort_values(['transaction_year', 'transaction_quarter'])
 
-                        if use_tsubo:
-                            price = convert_to_tsubo(price)
+            # Keep unfiltered data for volume chart
+            agg_data_all = agg_data.copy()
 
-                        return price
+            # Check for low volume cohorts before filtering
+            cohort_volumes = agg_data.groupby('cohort', sort=False)['count'].sum()
+            low_volume_cohorts = cohort_volumes[cohort_volumes < 50].index.tolist()
 
-                    agg_data['display_median'] = agg_data.apply(convert_cohort_price, axis=1)
-                    agg_data['display_avg'] = agg_data.apply(convert_cohort_avg, axis=1)
+            # Filter to cohorts with enough data for price charts
+            agg_data = agg_data[agg_data['count'] >= min_transactions]
 
-                    # Get sorted unique periods for x-axis ordering
-                    period_order = agg_data['period'].unique().tolist()
+            if not agg_data.empty:
+                # Apply currency/tsubo conversions
+                unit_label = get_unit_label()
 
-                    # Median price chart
-                    fig = px.line(
-                        agg_data,
-                        x='period',
-                        y='display_median',
-                        color='cohort',
-                        title=f'Median Price ({unit_label}) by {cohort_label} Cohort',
-                        labels={'display_median': f'Median {unit_label}', 'period': 'Period', 'cohort': cohort_label},
-                        markers=True,
-                        category_orders={'period': period_order}
-                    )
-                    fig.update_layout(
-                        yaxis_tickformat=',',
-                        height=450,
-                        hovermode='x unified',
-                        xaxis_tickangle=-45,
-                        xaxis_nticks=20
-                    )
-                    st.plotly_chart(fig, width="stretch")
-
-                    # Average price chart (to compare with median)
-                    st.markdown("##### Average vs Median Comparison")
-                    st.caption("Diverging average and median can indicate market segmentation or outlier effects")
-
-                    fig2 = px.line(
-                        agg_data,
-                        x='period',
-                        y='display_avg',
-                        color='cohort',
-                        title=f'Average Price ({unit_label}) by {cohort_label} Cohort',
-                        labels={'display_avg': f'Average {unit_label}', 'period': 'Period', 'cohort': cohort_label},
-                        markers=True,
-                        line_dash_sequence=['dash'],
-                        category_orders={'period': period_order}
-                    )
-                    fig2.update_layout(
-                        yaxis_tickformat=',',
-                        height=400,
-                        hovermode='x unified',
-                        xaxis_tickangle=-45,
-                        xaxis_nticks=20
-                    )
-                    st.plotly_chart(fig2, width="stretch")
-
-                    # Transaction volume (uses unfiltered data to show true volume)
-                    st.markdown("##### Transaction Volume by Cohort")
-                    period_order_all = agg_data_all.drop_duplicates('period')['period'].tolist()
-                    fig3 = px.bar(
-                        agg_data_all,
-                        x='period',
-                        y='count',
-                        color='cohort',
-                        title='Transaction Volume (All Data)',
-                        labels={'count': 'Transactions', 'period': 'Period', 'cohort': cohort_label},
-                        category_orders={'period': period_order_all}
-                    )
-                    fig3.update_layout(
-                        height=300,
-                        barmode='stack',
-                        xaxis_tickangle=-45,
-                        xaxis_nticks=20
-                    )
-                    st.plotly_chart(fig3, width="stretch")
+                years, quarters = agg_data['transaction_year'], agg_data['transaction_quarter']
+                agg_data['display_median'] = convert_price_series(agg_data['median_price'], years, quarters)
+                agg_data['display_avg'] = convert_price_series(agg_data['avg_price'], years, quarters)
 
-                    # Show warning for low volume cohorts
-                    if low_volume_cohorts:
-                        cohort_warning = ", ".join(low_volume_cohorts)
-                        st.warning(f"⚠️ Low data volume for: **{cohort_warning}** (<50 total transactions). Price trends may be unreliable.")
+                # Get sorted unique periods for x-axis ordering
+                period_order = agg_data['period'].unique().tolist()
 
-                    # Explanation based on cohort type
-                    if cohort_type == "Building Age":
-                        st.info("""
-                        **How to read this chart:**
-                        Each line shows the median price for apartments that were X years old *at the time of sale*.
+                # Median price chart
+                fig = px.line(
+                    agg_data,
+                    x='period',
+                    y='display_median',
+                    color='cohort',
+                    title=f'Median Price ({unit_label}) by {cohort_label} Cohort',
+                    labels={'display_median': f'Median {unit_label}', 'period': 'Period', 'cohort': cohort_label},
+                    markers=True,
+                    category_orders={'period': period_order}
+                )
+                fig.update_layout(
+                    yaxis_tickformat=',',
+                    height=450,
+                    hovermode='x unified',
+                    xaxis_tickangle=-45,
+                    xaxis_nticks=20
+                )
+                st.plotly_chart(fig, width="stretch")
 
-                        For example, the "10yr" line shows:
-                        - In 2020: apartments built in 2010 (10 years old in 2020)
-                        - In 2023: apartments built in 2013 (10 years old in 2023)
+                # Average price chart (to compare with median)
+                st.markdown("##### Average vs Median Comparison")
+                st.caption("Diverging average and median can indicate market segmentation or outlier effects")
 
-                        This "sliding age" approach lets you compare how the market values apartments of the same age across different time periods.
-                        """)
-                    elif cohort_type == "Property Size":
-                        st.info("""
-                        **How to read this chart:**
-                        Each line shows the median price/m² for properties within a size range.
-
-                        Comparing sizes helps identify:
-                        - Premium pricing for certain size segments
-                        - Market shifts toward larger or smaller units
-                        - Supply/demand imbalances by size
-                        """)
-                    else:  # Total Price
-                        st.info("""
-                        **How to read this chart:**
-                        Each line shows the median price/m² for transactions within a total price range.
-
-                        This helps identify:
-                        - Whether luxury segment is driving averages up while mainstream stagnates
-                        - Price compression or expansion between segments
-                        - Market bifurcation trends
-                        """)
+                fig2 = px.line(
+                    agg_data,
+                    x='period',
+                    y='display_avg',
+                    color='cohort',
+                    title=f'Average Price ({unit_label}) by {cohort_label} Cohort',
+                    labels={'display_avg': f'Average {unit_label}', 'period': 'Period', 'cohort': cohort_label},
+                    markers=True,
+                    line_dash_sequence=['dash'],
+                    category_orders={'period': period_order}
+                )
+                fig2.update_layout(
+                    yaxis_tickformat=',',
+                    height=400,
+                    hovermode='x unified',
+                    xaxis_tickangle=-45,
+                    xaxis_nticks=20
+                )
+                st.plotly_chart(fig2, width="stretch")
 
-                    # Summary table
-                    summary = agg_data.groupby('cohort').agg(
-                        avg_median=('display_median', 'mean'),
-                        avg_average=('display_avg', 'mean'),
-                        total_transactions=('count', 'sum')
-                    ).reset_index()
-                    summary['median_avg_gap'] = ((summary['avg_average'] - summary['avg_median']) / summary['avg_median'] * 100).round(1)
-                    summary.columns = [cohort_label, f'Avg Median ({unit_label})', f'Avg Mean ({unit_label})', 'Total Transactions', 'Mean-Median Gap %']
-                    st.dataframe(
-                        summary.style.format({
-                            f'Avg Median ({unit_label})': '{:,.0f}',
-                            f'Avg Mean ({unit_label})': '{:,.0f}',
-                            'Total Transactions': '{:,}',
-                            'Mean-Median Gap %': '{:+.1f}%'
-                        }),
-                        width="stretch"
-                    )
-                else:
-                    st.warning("Not enough data points for the selected cohorts. Try selecting different ranges or expanding the year range.")
+                # Transaction volume (uses unfiltered data to show true volume)
+                st.markdown("##### Transaction Volume by Cohort")
+                period_order_all = agg_data_all.drop_duplicates('period')['period'].tolist()
+                fig3 = px.bar(
+                    agg_data_all,
+                    x='period',
+                    y='count',
+                    color='cohort',
+                    title='Transaction Volume (All Data)',
+                    labels={'count': 'Transactions', 'period': 'Period', 'cohort': cohort_label},
+                    category_orders={'period': period_order_all}
+                )
+                fig3.update_layout(
+                    height=300,
+                    barmode='stack',
+                    xaxis_tickangle=-45,
+                    xaxis_nticks=20
+                )
+                st.plotly_chart(fig3, width="stretch")
+
+                # Show warning for low volume cohorts
+                if low_volume_cohorts:
+                    cohort_warning = ", ".join(low_volume_cohorts)
+                    st.warning(f"⚠️ Low data volume for: **{cohort_warning}** (<50 total transactions). Price trends may be unreliable.")
+
+                # Explanation based on cohort type
+                if cohort_type == "Building Age":
+                    st.info("""
+                    **How to read this chart:**
+                    Each line shows the median price for apartments that were X years old *at the time of sale*.
+
+                    For example, the "10yr" line shows:
+                    - In 2020: apartments built in 2010 (10 years old in 2020)
+                    - In 2023: apartments built in 2013 (10 years old in 2023)
+
+                    This "sliding age" approach lets you compare how the market values apartments of the same age across different time periods.
+                    """)
+                elif cohort_type == "Property Size":
+                    st.info("""
+                    **How to read this chart:**
+                    Each line shows the median price/m² for properties within a size range.
+
+                    Comparing sizes helps identify:
+                    - Premium pricing for certain size segments
+                    - Market shifts toward larger or smaller units
+                    - Supply/demand imbalances by size
+                    """)
+                else:  # Total Price
+                    st.info("""
+                    **How to read this chart:**
+                    Each line shows the median price/m² for transactions within a total price range.
+
+                    This helps identify:
+                    - Whether luxury segment is driving averages up while mainstream stagnates
+                    - Price compression or expansion between segments
+                    - Market bifurcation trends
+                    """)
+
+                # Summary table
+                summary = agg_data.groupby('cohort').agg(
+                    avg_median=('display_median', 'mean'),
+                    avg_average=('display_avg', 'mean'),
+                    total_transactions=('count', 'sum')
+                ).reset_index()
+                summary['median_avg_gap'] = ((summary['avg_average'] - summary['avg_median']) / summary['avg_median'] * 100).round(1)
+                summary.columns = [cohort_label, f'Avg Median ({unit_label})', f'Avg Mean ({unit_label})', 'Total Transactions', 'Mean-Median Gap %']
+                st.dataframe(
+                    summary.style.format({
+                        f'Avg Median ({unit_label})': '{:,.0f}',
+                        f'Avg Mean ({unit_label})': '{:,.0f}',
+                        'Total Transactions': '{:,}',
+                        'Mean-Median Gap %': '{:+.1f}%'
+                    }),
+                    width="stretch"
+                )
             else:
-                st.warning("No transactions found matching the selected cohorts.")
+                st.warning("Not enough data points for the selected cohorts. Try selecting different ranges or expanding the year range.")
         else:
-            st.warning("No data available for the selected filters.")
+            st.warning("No transactions found matching the selected cohorts.")
     else:
         st.info(f"👈 Select {cohort_type.lower()} cohorts to compare")
 
-# ============= DISTRICT TAB =============
-elif selected_tab == "📍 District":
+
+@st.fragment
+def render_district_tab():
+    """District tab. Runs as a fragment so picking districts only reruns this tab."""
     st.subheader("District Analysis")
     st.caption("Analyze price trends at the micro-market level by district/chome")
 
@@ -2556,15 +3306,15 @@ elif selected_tab == "📍 District":
             available_districts = get_districts(selected_municipality_codes)
         elif has_municipality_data:
             st.info("Select a Ward/City in the sidebar to see districts")
-            available_districts = pd.DataFrame()
+            available_districts = ()
         else:
-            available_districts = get_districts_by_prefecture(selected_prefecture)
+            available_districts = sidebar_refdata['districts']
 
-        if not available_districts.empty:
+        if available_districts:
             # District multiselect
             selected_micro_districts = st.multiselect(
                 "Districts",
-                options=available_districts['district_name'].tolist(),
+                options=available_districts,
                 max_selections=8,
                 help=TOOLTIPS["chome"] + " Select up to 8 to compare."
             )
@@ -2574,24 +3324,16 @@ elif selected_tab == "📍 District":
         # Show district rankings
         st.markdown("##### Top Districts by Price")
         with st.spinner("Loading district rankings..."):
+            # Ranked highest median first; 20 covers both the table and the bar chart
             district_rankings = get_district_rankings(
                 selected_prefecture,
                 selected_municipality_codes,
-                filters
+                filters,
+                limit=20
             )
 
         if not district_rankings.empty:
-            def convert_ranking_price(price):
-                if price is None:
-                    return None
-                result = float(price)
-                if use_fx and current_fx_rate:
-                    result = result * current_fx_rate
-                if use_tsubo:
-                    result = convert_to_tsubo(result)
-                return result
-
-            district_rankings['display_median'] = district_rankings['median_price_m2'].apply(convert_ranking_price)
+            district_rankings['display_median'] = convert_price_series(district_rankings['median_price_m2'])
 
             display_rankings = district_rankings[['district_name', 'display_median', 'transaction_count']].head(15)
             display_rankings.columns = ['District', get_unit_label(), 'Transactions']
@@ -2621,6 +3363,9 @@ elif selected_tab == "📍 District":
                 )
 
             if not district_trends.empty:
+                # A handful of districts repeated on every period row
+                district_trends['district_name'] = district_trends['district_name'].astype('category')
+
                 # Create period column
                 if frequency == 'Yearly':
                     district_trends['period'] = district_trends['transaction_year'].astype(str)
@@ -2629,23 +3374,12 @@ elif selected_tab == "📍 District":
                     district_trends['period'] = district_trends['transaction_year'].astype(str) + ' Q' + district_trends['transaction_quarter'].astype(str)
                     district_trends['quarter'] = district_trends['transaction_quarter']
 
-                # Apply conversions
-                def apply_district_conversions(row):
-                    price = float(row['median_price_m2'])
-                    year = int(row['transaction_year'])
-                    quarter = int(row['quarter'])
-
-                    if use_fx and (year, quarter) in fx_rates:
-                        price = price * fx_rates[(year, quarter)]
-                    elif use_fx and current_fx_rate:
-                        price = price * current_fx_rate
-
-                    if use_tsubo:
-                        price = convert_to_tsubo(price)
-
-                    return price
-
-                district_trends['display_median'] = district_trends.apply(apply_district_conversions, axis=1)
+                # Apply conversions (yearly rows use the Q2 rate)
+                district_trends['display_median'] = convert_price_series(
+                    district_trends['median_price_m2'],
+                    district_trends['transaction_year'],
+                    district_trends['quarter']
+                )
 
                 # Line chart
                 fig = px.line(
@@ -2679,7 +3413,7 @@ elif selected_tab == "📍 District":
 
                 # Summary stats
                 st.markdown("##### Summary Statistics")
-                summary = district_trends.groupby('district_name').agg(
+                summary = district_trends.groupby('district_name', observed=True).agg(
                     avg_median=('display_median', 'mean'),
                     total_transactions=('transaction_count', 'sum')
                 ).reset_index()
@@ -2688,539 +3422,301 @@ elif selected_tab == "📍 District":
                     summary.style.format({
                         f'Avg Median ({unit_label})': '{:,.0f}',
                         'Total Transactions': '{:,}'
-                    }),
-                    width="stretch"
-                )
-            else:
-                st.warning("No data available for the selected districts. Try different districts or adjust filters.")
-        else:
-            st.info("👈 Select districts from the list to see price trends")
-
-            # Show overall district comparison as a bar chart
-            if 'district_rankings' in dir() and not district_rankings.empty:
-                st.markdown(f"##### District Price Comparison ({unit_label})")
-                fig = px.bar(
-                    district_rankings.head(20),
-                    x='district_name',
-                    y='display_median',
-                    color='display_median',
-                    color_continuous_scale='RdYlGn_r',
-                    title='Top 20 Districts by Median Price',
-                    labels={'display_median': unit_label, 'district_name': 'District'}
-                )
-                fig.update_layout(
-                    xaxis_tickangle=-45,
-                    yaxis_tickformat=',',
-                    height=450,
-                    showlegend=False
-                )
-                st.plotly_chart(fig, width="stretch")
-
-# ============= VALUATION TAB =============
-elif selected_tab == "💰 Valuation":
-    st.subheader("Property Valuation")
-
-    # Toggle between valuation modes
-    valuation_mode = st.radio(
-        "Mode",
-        options=["Estimate Value", "Check Listing Price", "Track Depreciation"],
-        horizontal=True,
-        key="valuation_mode"
-    )
-
-    val_col1, val_col2 = st.columns(2)
-
-    with val_col1:
-        st.markdown("##### Property Details")
-
-        val_municipality = st.selectbox(
-            "Ward / City",
-            options=[""] + list(municipality_options.keys()),
-            key="val_municipality"
-        )
-
-        # Show district only for Estimate Value and Check Listing modes
-        if valuation_mode != "Track Depreciation":
-            val_district = st.text_input(
-                "District / Address (optional)",
-                placeholder="e.g. Roppongi 1-chome",
-                key="val_district"
-            )
-
-            val_property_type = st.selectbox(
-                "Property Type",
-                options=property_types['property_type_raw'].tolist(),
-                key="val_property_type"
-            )
-        else:
-            val_district = None
-            val_property_type = "Pre-owned Condominiums, etc."
-
-        # Show listing price input only in "Check Listing Price" mode
-        if valuation_mode == "Check Listing Price":
-            val_listing_price = st.number_input(
-                "Listing Price (¥)",
-                min_value=1000000,
-                max_value=2000000000,
-                value=50000000,
-                step=1000000,
-                format="%d",
-                key="val_listing_price"
-            )
-        else:
-            val_listing_price = None
-
-        # Show purchase info for depreciation mode
-        if valuation_mode == "Track Depreciation":
-            dep_purchase_year = st.number_input(
-                "Year Purchased",
-                min_value=2005,
-                max_value=max_year,
-                value=2015,
-                step=1,
-                key="dep_purchase_year"
-            )
-
-            dep_purchase_price = st.number_input(
-                "Purchase Price (¥)",
-                min_value=1000000,
-                max_value=2000000000,
-                value=50000000,
-                step=1000000,
-                format="%d",
-                key="dep_purchase_price"
-            )
-
-        val_area = st.number_input(
-            "Area (m²)",
-            min_value=10.0,
-            max_value=500.0,
-            value=60.0,
-            step=5.0,
-            key="val_area"
-        )
-
-        val_building_year = st.number_input(
-            "Year Built",
-            min_value=1960,
-            max_value=2025,
-            value=2010,
-            step=1,
-            key="val_building_year"
-        )
-
-        if valuation_mode != "Track Depreciation":
-            val_floor_plan = st.selectbox(
-                "Layout (optional)",
-                options=["", "1K", "1DK", "1LDK", "2K", "2DK", "2LDK", "3K", "3DK", "3LDK", "4LDK+"],
-                key="val_floor_plan"
-            )
-        else:
-            val_floor_plan = None
-
-        if valuation_mode == "Estimate Value":
-            action_button = st.button("💰 Estimate Value", type="primary", width="stretch")
-        elif valuation_mode == "Check Listing Price":
-            action_button = st.button("🔍 Check Listing", type="primary", width="stretch")
+                    }),
+                    width="stretch"
+                )
+            else:
+                st.warning("No data available for the selected districts. Try different districts or adjust filters.")
         else:
-            action_button = st.button("📉 Calculate Depreciation", type="primary", width="stretch")
+            st.info("👈 Select districts from the list to see price trends")
 
-    with val_col2:
-        if valuation_mode == "Estimate Value":
-            st.markdown("##### Estimated Value")
-        elif valuation_mode == "Check Listing Price":
-            st.markdown("##### Market Comparison")
-        else:
-            st.markdown("##### Estimated Current Value")
+            # Show overall district comparison as a bar chart
+            if not district_rankings.empty:
+                st.markdown(f"##### District Price Comparison ({unit_label})")
+                fig = px.bar(
+                    district_rankings,
+                    x='district_name',
+                    y='display_median',
+                    color='display_median',
+                    color_continuous_scale='RdYlGn_r',
+                    title='Top 20 Districts by Median Price',
+                    labels={'display_median': unit_label, 'district_name': 'District'}
+                )
+                fig.update_layout(
+                    xaxis_tickangle=-45,
+                    yaxis_tickformat=',',
+                    height=450,
+                    showlegend=False
+                )
+                st.plotly_chart(fig, width="stretch")
 
-        if action_button and val_municipality:
-            current_year = year_range[1]
-            building_age = current_year - val_building_year
-            val_muni_code = municipality_options[val_municipality]
 
-            # Track Depreciation mode has different logic
-            if valuation_mode == "Track Depreciation":
-                # Get historical prices for similar properties
-                dep_query = """
-                    SELECT
-                        t.transaction_year,
-                        PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY t.unit_price)::INTEGER as median_price_m2,
-                        COUNT(*) as count
-                    FROM transactions t
-                    WHERE t.municipality_code = %s
-                      AND t.property_type_raw = 'Pre-owned Condominiums, etc.'
-                      AND t.unit_price IS NOT NULL
-                      AND t.unit_price > 0
-                      AND t.unit_price < 50000000
-                      AND t.area_m2 BETWEEN %s AND %s
-                      AND t.building_year IS NOT NULL
-                    GROUP BY t.transaction_year
-                    HAVING COUNT(*) >= 5
-                    ORDER BY t.transaction_year
-                """
-                dep_params = [val_muni_code, val_area * 0.7, val_area * 1.3]
+# ============= CHARTS TAB =============
+if selected_tab == "📈 Charts":
+    # Dynamic chart based on chart_mode
+    if chart_mode == "Time Series":
+        st.subheader("Historical Price Trends")
 
-                with st.spinner("Calculating depreciation..."):
-                    dep_data = run_query(dep_query, dep_params)
+        with st.spinner("Loading price trends..."):
+            trends = get_price_trends(filters, frequency)
 
-                if not dep_data.empty and len(dep_data) >= 2:
-                    # Get price at purchase year and current year
-                    purchase_year_data = dep_data[dep_data['transaction_year'] == dep_purchase_year]
-                    current_year_data = dep_data[dep_data['transaction_year'] == max_year]
+        if not trends.empty:
+            if frequency == 'Yearly':
+                trends['period'] = trends['transaction_year'].astype(str)
+                trends['quarter'] = 2  # Default for yearly
+            else:
+                trends['period'] = trends['transaction_year'].astype(str) + ' Q' + trends['transaction_quarter'].astype(str)
+                trends['quarter'] = trends['transaction_quarter']
 
-                    if not purchase_year_data.empty and not current_year_data.empty:
-                        purchase_price_m2 = float(purchase_year_data['median_price_m2'].iloc[0])
-                        current_price_m2 = float(current_year_data['median_price_m2'].iloc[0])
+            # Apply conversions for display (historical FX per period, then tsubo)
+            years, quarters = trends['transaction_year'], trends['quarter']
+            trends['display_median'] = convert_price_series(trends['median_price_m2'], years, quarters)
+            trends['display_avg'] = convert_price_series(trends['avg_price_m2'], years, quarters)
+
+            fig, fig2 = build_trend_figures(
+                trends['period'].to_numpy(),
+                trends['display_median'].to_numpy(dtype=float),
+                trends['display_avg'].to_numpy(dtype=float),
+                trends['transaction_count'].to_numpy(),
+                get_unit_label()
+            )
+            st.plotly_chart(fig, width="stretch", key="trend_chart")
+            st.plotly_chart(fig2, width="stretch", key="trend_volume_chart")
+        else:
+            st.warning("No data available for selected filters")
 
-                        # Calculate market appreciation/depreciation
-                        market_change = (current_price_m2 - purchase_price_m2) / purchase_price_m2
+    elif chart_mode == "Histogram":
+        st.subheader("Price Distribution")
 
-                        # Estimate current value based on market change
-                        estimated_current = dep_purchase_price * (1 + market_change)
-                        value_change = estimated_current - dep_purchase_price
-                        value_change_pct = market_change * 100
+        with st.spinner("Loading price distribution..."):
+            hist_data = get_histogram_data(filters)
 
-                        # Building age effect
-                        years_held = max_year - dep_purchase_year
-                        age_at_purchase = dep_purchase_year - val_building_year
-                        age_now = max_year - val_building_year
+        if not hist_data.empty:
+            bin_start = hist_data['bin_start'].to_numpy()
+            bin_end = hist_data['bin_end'].to_numpy()
+            fig = go.Figure(go.Bar(
+                x=(bin_start + bin_end) / 2,
+                y=hist_data['count'].to_numpy(),
+                width=bin_end - bin_start,
+                customdata=np.column_stack([bin_start, bin_end]),
+                hovertemplate='¥%{customdata[0]:,.0f} - ¥%{customdata[1]:,.0f}<br>Count: %{y:,}<extra></extra>',
+            ))
+            fig.update_layout(
+                title='Distribution of Price per m²',
+                xaxis_title='Price per m² (¥)',
+                yaxis_title='Count',
+                xaxis_tickformat=',',
+                bargap=0,
+                height=500
+            )
+            st.plotly_chart(fig, width="stretch")
 
-                        if value_change >= 0:
-                            st.success(f"### ¥{estimated_current:,.0f}")
-                            st.caption(f"Estimated appreciation: ¥{value_change:+,.0f} ({value_change_pct:+.1f}%)")
-                        else:
-                            st.error(f"### ¥{estimated_current:,.0f}")
-                            st.caption(f"Estimated depreciation: ¥{value_change:+,.0f} ({value_change_pct:+.1f}%)")
+            # Stats (computed over all matching rows by the same query)
+            stats = hist_data.iloc[0]
+            stat_col1, stat_col2, stat_col3, stat_col4 = st.columns(4)
+            stat_col1.metric("Count", f"{int(stats['total']):,}")
+            stat_col2.metric("Median", f"¥{float(stats['median']):,.0f}/m²")
+            stat_col3.metric("Mean", f"¥{float(stats['mean']):,.0f}/m²")
+            stat_col4.metric("Std Dev", f"¥{float(stats['std']) if pd.notna(stats['std']) else 0:,.0f}")
+        else:
+            st.warning("No data available for selected filters")
 
-                        st.markdown(f"""
-                        | Metric | Value |
-                        |--------|-------|
-                        | **Purchase Price** | ¥{dep_purchase_price:,.0f} |
-                        | **Estimated Current Value** | ¥{estimated_current:,.0f} |
-                        | **Change** | ¥{value_change:+,.0f} ({value_change_pct:+.1f}%) |
-                        | **Years Held** | {years_held} years |
-                        | **Age at Purchase** | {age_at_purchase} years old |
-                        | **Age Now** | {age_now} years old |
-                        | **Market Price/m² (at purchase)** | ¥{purchase_price_m2:,.0f} |
-                        | **Market Price/m² (now)** | ¥{current_price_m2:,.0f} |
-                        """)
+    elif chart_mode == "Scatter (X vs Y)":
+        st.subheader(f"{scatter_y} vs {scatter_x}")
 
-                        # Show historical trend
-                        st.divider()
-                        st.markdown("##### Market Trend for Similar Properties")
+        # The random sample needs a full scan of the filtered rows; start it in the
+        # background and show a first-rows preview until it arrives.
+        scatter_future = run_query_async(*get_scatter_query(filters, matching_rows=transaction_count))
+        scatter_slot = st.empty()
+
+        def draw_scatter(scatter_data, preview=False):
+            with scatter_slot.container():
+                if preview:
+                    st.caption(f"⏳ Preview of {len(scatter_data):,} transactions - loading random sample...")
+                if not scatter_data.empty:
+                    # Map axis selections to column names
+                    x_col_map = {
+                        "Building Age": "building_age",
+                        "Area (m²)": "area_m2",
+                        "Year Built": "building_year",
+                        "Transaction Year": "transaction_year"
+                    }
+                    y_col_map = {
+                        "Price per m²": "unit_price",
+                        "Total Price": "trade_price"
+                    }
 
-                        fig = px.line(
-                            dep_data,
-                            x='transaction_year',
-                            y='median_price_m2',
-                            markers=True,
-                            title='Median Price/m² Over Time',
-                            labels={'median_price_m2': '¥/m²', 'transaction_year': 'Year'}
+                    x_col = x_col_map.get(scatter_x, "building_age")
+                    y_col = y_col_map.get(scatter_y, "unit_price")
+
+                    # Filter out invalid data
+                    plot_data = scatter_data.dropna(subset=[x_col, y_col])
+
+                    if x_col == "building_age":
+                        plot_data = plot_data[(plot_data['building_age'] >= 0) & (plot_data['building_age'] <= 60)]
+
+                    # Categorical colour key: compact, and legend order no longer depends on
+                    # which structure the sample happens to hit first
+                    if 'structure' in plot_data.columns:
+                        plot_data = plot_data.assign(structure=plot_data['structure'].astype('category'))
+
+                    if not plot_data.empty:
+                        fig = px.scatter(
+                            plot_data,
+                            x=x_col,
+                            y=y_col,
+                            color='structure' if 'structure' in plot_data.columns else None,
+                            opacity=0.3,
+                            render_mode='webgl',
+                            title=f'{scatter_y} vs {scatter_x}',
+                            labels={x_col: scatter_x, y_col: scatter_y}
                         )
 
-                        # Add markers for purchase and current
-                        fig.add_vline(x=dep_purchase_year, line_dash="dash", line_color="green",
-                                     annotation_text="Purchased")
-                        fig.add_vline(x=max_year, line_dash="dash", line_color="blue",
-                                     annotation_text="Now")
+                        # One fit over all points serves both the trend line and the stats
+                        # below (instead of statsmodels fitting per-colour OLS trendlines)
+                        regression = None
+                        if len(plot_data) > 10:
+                            from scipy import stats
+                            # The scatter query already caps the sample; fit on plain arrays
+                            regression = stats.linregress(
+                                plot_data[x_col].to_numpy(dtype=float),
+                                plot_data[y_col].to_numpy(dtype=float)
+                            )
+                            xs = np.linspace(plot_data[x_col].min(), plot_data[x_col].max(), 50)
+                            fig.add_trace(go.Scatter(
+                                x=xs,
+                                y=regression.slope * xs + regression.intercept,
+                                mode='lines',
+                                name='Trend (OLS)',
+                                line=dict(color='black', width=2)
+                            ))
 
                         fig.update_layout(
                             yaxis_tickformat=',',
-                            height=350
+                            height=600
                         )
                         st.plotly_chart(fig, width="stretch")
 
+                        # Regression stats
+                        if regression is not None:
+                            r_squared = regression.rvalue ** 2
+                            if x_col == "building_age":
+                                st.info(f"**Regression:** {scatter_y} changes by ¥{regression.slope:,.0f} per year of age (R² = {r_squared:.3f})")
+                            else:
+                                st.info(f"**Regression:** R² = {r_squared:.3f}")
                     else:
-                        st.warning("Not enough data for the purchase year or current year. Try adjusting the parameters.")
+                        st.warning("No valid data for the selected axes")
                 else:
-                    st.warning("Not enough comparable transactions found. Try selecting a different ward or adjusting the area.")
-
-            else:
-                # Estimate Value and Check Listing modes
-                comp_query = """
-                    SELECT
-                        t.trade_price,
-                        t.unit_price,
-                        t.area_m2,
-                        t.building_year,
-                        t.transaction_year - t.building_year as building_age,
-                        t.floor_plan,
-                        t.district_name,
-                        t.transaction_year,
-                        t.transaction_quarter
-                    FROM transactions t
-                    WHERE t.municipality_code = %s
-                      AND t.property_type_raw = %s
-                      AND t.unit_price IS NOT NULL
-                      AND t.unit_price > 0
-                      AND t.unit_price < 50000000
-                      AND t.transaction_year >= %s
-                      AND t.area_m2 BETWEEN %s AND %s
-                """
-                comp_params = [
-                    val_muni_code,
-                    val_property_type,
-                    current_year - 3,
-                    val_area * 0.7,
-                    val_area * 1.3
-                ]
-
-                if val_building_year > 0:
-                    comp_query += " AND t.building_year IS NOT NULL"
-                    comp_query += " AND (t.transaction_year - t.building_year) BETWEEN %s AND %s"
-                    comp_params.extend([max(0, building_age - 10), building_age + 10])
-
-                if val_floor_plan:
-                    comp_query += " AND t.floor_plan = %s"
-                    comp_params.append(val_floor_plan)
-
-                if val_district:
-                    comp_query += " AND t.district_name ILIKE %s"
-                    comp_params.append(f"%{val_district}%")
-
-                comp_query += " ORDER BY t.transaction_year DESC, t.transaction_quarter DESC LIMIT 100"
-
-                with st.spinner("Finding comparable properties..."):
-                    comparables = run_query(comp_query, comp_params)
-
-                if not comparables.empty and len(comparables) >= 3:
-                    median_unit_price = comparables['unit_price'].median()
-                    std_unit_price = comparables['unit_price'].std()
-
-                    if valuation_mode == "Estimate Value":
-                        # Valuation mode
-                        estimated_price_median = median_unit_price * val_area
-                        low_estimate = (median_unit_price - std_unit_price) * val_area
-                        high_estimate = (median_unit_price + std_unit_price) * val_area
-
-                        st.metric(
-                            "Estimated Market Value",
-                            f"¥{estimated_price_median:,.0f}",
-                            help="Based on median price per m² of comparable transactions"
-                        )
-
-                        st.markdown(f"""
-                        | Metric | Value |
-                        |--------|-------|
-                        | **Low Estimate** | ¥{max(0, low_estimate):,.0f} |
-                        | **Median Estimate** | ¥{estimated_price_median:,.0f} |
-                        | **High Estimate** | ¥{high_estimate:,.0f} |
-                        | **Price per m² (Median)** | ¥{median_unit_price:,.0f} |
-                        | **Comparable Transactions** | {len(comparables)} |
-                        """)
-
-                    else:
-                        # Check Listing mode
-                        listing_price_per_m2 = val_listing_price / val_area
-                        fair_value = median_unit_price * val_area
-                        price_diff = val_listing_price - fair_value
-                        price_diff_pct = (price_diff / fair_value) * 100
-                        percentile = (comparables['unit_price'] < listing_price_per_m2).mean() * 100
-
-                        if price_diff_pct < -15:
-                            verdict = "🟢 **UNDERPRICED**"
-                            verdict_detail = "This listing appears significantly below market value"
-                        elif price_diff_pct < -5:
-                            verdict = "🟢 **GOOD VALUE**"
-                            verdict_detail = "This listing appears below market average"
-                        elif price_diff_pct < 5:
-                            verdict = "🟡 **FAIR PRICE**"
-                            verdict_detail = "This listing is priced around market value"
-                        elif price_diff_pct < 15:
-                            verdict = "🟠 **ABOVE MARKET**"
-                            verdict_detail = "This listing is priced above market average"
-                        else:
-                            verdict = "🔴 **OVERPRICED**"
-                            verdict_detail = "This listing appears significantly above market value"
-
-                        st.markdown(f"### {verdict}")
-                        st.caption(verdict_detail)
-
-                        st.markdown(f"""
-                        | Metric | Value |
-                        |--------|-------|
-                        | **Listing Price** | ¥{val_listing_price:,.0f} |
-                        | **Listing ¥/m²** | ¥{listing_price_per_m2:,.0f} |
-                        | **Market Median ¥/m²** | ¥{median_unit_price:,.0f} |
-                        | **Fair Value Estimate** | ¥{fair_value:,.0f} |
-                        | **Difference** | ¥{price_diff:+,.0f} ({price_diff_pct:+.1f}%) |
-                        | **Price Percentile** | {percentile:.0f}% |
-                        | **Comparables Found** | {len(comparables)} |
-                        """)
-
-                    st.divider()
-                    st.markdown("##### Recent Comparable Sales")
-
-                    display_cols = ['transaction_year', 'transaction_quarter', 'district_name',
-                                   'area_m2', 'building_age', 'unit_price', 'trade_price']
-                    display_data = comparables[[c for c in display_cols if c in comparables.columns]].head(10)
-
-                    st.dataframe(
-                        display_data.style.format({
-                            'trade_price': '¥{:,.0f}',
-                            'unit_price': '¥{:,.0f}/m²',
-                            'area_m2': '{:.1f}m²',
-                            'building_age': '{:.0f}yr'
-                        }),
-                        width="stretch",
-                        height=350
-                    )
+                    st.warning("No data available for selected filters")
 
-                    # Price distribution
-                    fig = px.histogram(
-                        comparables,
-                        x='unit_price',
-                        nbins=20,
-                        title='Price Distribution of Comparable Properties',
-                        labels={'unit_price': 'Price per m² (¥)'}
-                    )
-                    fig.add_vline(x=median_unit_price, line_dash="dash", line_color="green",
-                                 annotation_text=f"Median: ¥{median_unit_price:,.0f}")
-                    if valuation_mode == "Check Listing Price":
-                        fig.add_vline(x=listing_price_per_m2, line_dash="solid", line_color="red", line_width=3,
-                                     annotation_text=f"Listing: ¥{listing_price_per_m2:,.0f}")
-                    fig.update_layout(height=300, xaxis_tickformat=',')
-                    st.plotly_chart(fig, width="stretch")
-
-                    # PDF Export button
-                    st.divider()
+        try:
+            scatter_data = scatter_future.result(timeout=0.2)
+        except FutureTimeoutError:
+            draw_scatter(run_query(*get_scatter_query(filters, limit=500, randomize=False)), preview=True)
+            scatter_data = scatter_future.result()
+        draw_scatter(scatter_data)
 
-                    # Prepare valuation data for PDF
-                    valuation_pdf_data = {
-                        'location': val_municipality,
-                        'district': val_district or 'Not specified',
-                        'property_type': val_property_type,
-                        'area': val_area,
-                        'building_year': val_building_year,
-                        'building_age': building_age,
-                        'floor_plan': val_floor_plan or 'Not specified',
-                        'median_price_m2': median_unit_price,
-                        'comparable_count': len(comparables),
-                    }
+# ============= MAP TAB =============
+elif selected_tab == "🗺️ Map":
+    render_map_tab()
 
-                    if valuation_mode == "Estimate Value":
-                        valuation_pdf_data.update({
-                            'estimated_value': estimated_price_median,
-                            'low_estimate': max(0, low_estimate),
-                            'high_estimate': high_estimate,
-                            'verdict': 'Estimated Market Value',
-                            'verdict_class': 'fair',
-                        })
-                    else:  # Check Listing Price
-                        valuation_pdf_data.update({
-                            'estimated_value': fair_value,
-                            'low_estimate': (median_unit_price - std_unit_price) * val_area,
-                            'high_estimate': (median_unit_price + std_unit_price) * val_area,
-                            'listing_price': val_listing_price,
-                            'listing_price_m2': listing_price_per_m2,
-                            'price_diff': price_diff,
-                            'price_diff_pct': price_diff_pct,
-                            'percentile': percentile,
-                            'verdict': verdict.replace('🟢 ', '').replace('🟡 ', '').replace('🟠 ', '').replace('🔴 ', ''),
-                            'verdict_class': 'good' if price_diff_pct < -5 else ('high' if price_diff_pct > 15 else 'fair'),
-                        })
-
-                    pdf_html = generate_valuation_pdf(valuation_pdf_data)
-
-                    st.download_button(
-                        label="📄 Download Valuation Report (HTML)",
-                        data=pdf_html,
-                        file_name=f"valuation_report_{val_municipality}_{datetime.now().strftime('%Y%m%d')}.html",
-                        mime="text/html",
-                        help="Download a printable HTML report. Open in browser and use Print → Save as PDF for a PDF version."
-                    )
+# ============= COHORTS TAB =============
+elif selected_tab == "📊 Cohorts":
+    render_cohorts_tab()
 
-                else:
-                    st.warning(f"Only {len(comparables)} comparable transactions found. Try adjusting criteria.")
-                    st.info("Tips: Remove floor plan filter, widen the district search, or increase the area range.")
+# ============= DISTRICT TAB =============
+elif selected_tab == "📍 District":
+    render_district_tab()
 
-        elif action_button:
-            st.warning("Please select a Ward/City")
-        else:
-            if valuation_mode == "Estimate Value":
-                st.info("👈 Enter property details and click **Estimate Value**")
-            elif valuation_mode == "Check Listing Price":
-                st.info("👈 Enter listing details and click **Check Listing**")
-            else:
-                st.info("👈 Enter your property details and click **Calculate Depreciation**")
+# ============= VALUATION TAB =============
+elif selected_tab == "💰 Valuation":
+    render_valuation_tab()
 
 # ============= RAW DATA TAB =============
 elif selected_tab == "📋 Raw Data":
     st.subheader("Sample Transactions")
 
+    # Keyset cursor (year, quarter, id) of the last row shown, tied to the filters it was
+    # taken under; any filter change starts again from the newest transactions
+    page = st.session_state.get('rawdata_cursor')
+    cursor = page[1] if page and page[0] == filters.cache_key() else None
+
     sample_query, sample_params = build_query(
-        """t.transaction_year, t.transaction_quarter, t.municipality_code,
+        """t.id, t.transaction_year, t.transaction_quarter, t.municipality_code,
            t.district_name, t.property_type_raw, t.trade_price, t.unit_price,
            t.area_m2, t.building_year, t.floor_plan, t.structure""",
-        filters,
-        order_by="t.transaction_year DESC, t.transaction_quarter DESC",
-        limit=100
+        filters if cursor is None else {**filters, 'keyset_before': cursor},
+        order_by=RAW_DATA_ORDER,
+        limit=RAW_DATA_PAGE_SIZE
     )
     with st.spinner("Loading transactions..."):
         sample_data = run_query(sample_query, sample_params)
 
+    if cursor is not None:
+        st.caption(f"Transactions older than {cursor[0]} Q{cursor[1]}")
+
     if not sample_data.empty:
         unit_label = get_unit_label()
 
-        # Apply currency/tsubo conversions
-        def convert_raw_price(row, price_col):
-            price = row[price_col]
-            if price is None:
-                return None
-            price = float(price)
-            year = int(row['transaction_year'])
-            quarter = int(row['transaction_quarter'])
-
-            # Apply FX conversion with historical rate
-            if use_fx and (year, quarter) in fx_rates:
-                price = price * fx_rates[(year, quarter)]
-            elif use_fx and current_fx_rate:
-                price = price * current_fx_rate
-
-            return price
-
-        def convert_unit_price(row):
-            price = convert_raw_price(row, 'unit_price')
-            if price is None:
-                return None
-            # Apply tsubo conversion
-            if use_tsubo:
-                price = convert_to_tsubo(price)
-            return price
-
-        sample_data['display_trade_price'] = sample_data.apply(lambda r: convert_raw_price(r, 'trade_price'), axis=1)
-        sample_data['display_unit_price'] = sample_data.apply(convert_unit_price, axis=1)
+        # Apply currency/tsubo conversions (historical FX per transaction quarter)
+        years, quarters = sample_data['transaction_year'], sample_data['transaction_quarter']
+        sample_data['display_trade_price'] = convert_price_series(sample_data['trade_price'], years, quarters, is_unit_price=False)
+        sample_data['display_unit_price'] = convert_price_series(sample_data['unit_price'], years, quarters)
 
         # Create display dataframe
         display_cols = ['transaction_year', 'transaction_quarter', 'district_name',
                        'property_type_raw', 'display_trade_price', 'display_unit_price',
                        'area_m2', 'building_year', 'floor_plan', 'structure']
-        display_df = sample_data[[c for c in display_cols if c in sample_data.columns]].copy()
+        # Repeated labels as categoricals and area as float32 shrink what st.dataframe
+        # serializes to the browser
+        display_df = sample_data[[c for c in display_cols if c in sample_data.columns]].astype({
+            'district_name': 'category',
+            'property_type_raw': 'category',
+            'floor_plan': 'category',
+            'structure': 'category',
+            'area_m2': 'float32',
+        })
 
         # Rename columns for display
-        currency_symbol = {'JPY': '¥', 'USD': '$', 'EUR': '€', 'GBP': '£'}.get(currency, '¥')
+        currency_symbol = CURRENCY_SYMBOLS[currency]
         display_df.columns = ['Year', 'Quarter', 'District', 'Property Type',
                              f'Total Price ({currency_symbol})', f'Price ({unit_label})',
                              'Area (m²)', 'Year Built', 'Layout', 'Structure']
 
+        # Formatting happens client-side, so columns stay numeric and sort as numbers
         st.dataframe(
-            display_df.style.format({
-                f'Total Price ({currency_symbol})': '{:,.0f}',
-                f'Price ({unit_label})': '{:,.0f}',
-                'Area (m²)': '{:.1f}'
-            }),
+            display_df,
+            column_config={
+                f'Total Price ({currency_symbol})': st.column_config.NumberColumn(format="localized"),
+                f'Price ({unit_label})': st.column_config.NumberColumn(format="localized"),
+                'Area (m²)': st.column_config.NumberColumn(format="%.1f")
+            },
             width="stretch",
             height=500
         )
 
-        # Download button
-        csv_data = display_df.to_csv(index=False)
+        # Download button; CSV is gzipped straight into the buffer
+        csv_buffer = io.BytesIO()
+        with gzip.GzipFile(fileobj=csv_buffer, mode='wb') as gz:
+            display_df.to_csv(gz, index=False)
         st.download_button(
             label="📥 Download CSV",
-            data=csv_data,
-            file_name=f"transactions_{selected_prefecture_name}_{currency}.csv",
-            mime="text/csv"
+            data=csv_buffer.getvalue(),
+            file_name=f"transactions_{selected_prefecture_name}_{currency}.csv.gz",
+            mime="application/gzip"
         )
+
+        nav_col1, nav_col2 = st.columns(2)
+        if cursor is not None and nav_col1.button("⏮ Newest"):
+            st.session_state.pop('rawdata_cursor', None)
+            st.rerun()
+        if len(sample_data) == RAW_DATA_PAGE_SIZE and nav_col2.button(f"Next {RAW_DATA_PAGE_SIZE} ▶"):
+            last = sample_data.iloc[-1]
+            quarter = 0 if pd.isna(last['transaction_quarter']) else int(last['transaction_quarter'])
+            st.session_state['rawdata_cursor'] = (
+                filters.cache_key(), (int(last['transaction_year']), quarter, int(last['id']))
+            )
+            st.rerun()
     else:
         st.warning("No data available for selected filters")
 
@@ -3313,14 +3809,14 @@ elif selected_tab == "⚠️ Data Quality":
         view_params = []
 
         if selected_issues:
-            placeholders = ','.join(['%s'] * len(selected_issues))
-            view_query += f" AND f.issue_code IN ({placeholders})"
-            view_params.extend(selected_issues)
+            view_query += " AND f.issue_code = ANY(%s)"
+            view_params.append(selected_issues)
 
-        view_query += f" ORDER BY f.issue_code, t.id DESC LIMIT {limit_records}"
+        view_query += " ORDER BY f.issue_code, t.id DESC LIMIT %s"
+        view_params.append(int(limit_records))
 
         with st.spinner(f"Loading up to {limit_records} suspicious records..."):
-            suspicious_df = run_query(view_query, view_params if view_params else None)
+            suspicious_df = run_query(view_query, view_params)
 
         if not suspicious_df.empty:
             st.write(f"Showing {len(suspicious_df)} records")
@@ -3501,8 +3997,7 @@ elif selected_tab == "🔭 Insights":
         with st.spinner("Loading seasonality data..."):
             df = get_seasonal_index_data(quality_filter)
         if not df.empty:
-            annual = df.groupby('transaction_year')['median_price'].mean().reset_index().rename(columns={'median_price': 'annual_median'})
-            df = df.merge(annual, on='transaction_year')
+            df['annual_median'] = df.groupby('transaction_year', sort=False)['median_price'].transform('mean')
             df['pct_deviation'] = (df['median_price'] - df['annual_median']) / df['annual_median'] * 100
             df['quarter_label'] = 'Q' + df['transaction_quarter'].astype(str)
             fig = px.line(
@@ -3771,7 +4266,7 @@ elif selected_tab == "🔭 Insights":
         with st.spinner("Loading property type data..."):
             prop_df = get_property_type_trends(filters)
         if not prop_df.empty:
-            types_with_data = prop_df.groupby('property_type')['year'].count()
+            types_with_data = prop_df.groupby('property_type', sort=False).size()
             types_with_sufficient_data = types_with_data[types_with_data >= 3].index.tolist()
             if len(types_with_sufficient_data) >= 2:
                 filtered_prop_df = prop_df[prop_df['property_type'].isin(types_with_sufficient_data)]
@@ -11,16 +11,25 @@ Usage:
 """
 
 import argparse
+import csv
 import hashlib
+import io
 import os
+import re
 import sys
-from datetime import datetime, date
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from datetime import datetime, date, timedelta
+from functools import lru_cache
+from operator import itemgetter
 from typing import List, Dict, Any, Optional
 import time
 
 import psycopg2
 from psycopg2.extras import execute_values
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 # =============================================================================
@@ -79,14 +88,41 @@ PREFECTURE_CODES = {
     "Okinawa": "47", "沖縄県": "47",
 }
 
+PREFECTURE_NAMES_EN = {v: k for k, v in PREFECTURE_CODES.items() if k.isascii()}
+ALL_PREFECTURES = sorted(PREFECTURE_NAMES_EN)
+
+
+class RateLimiter:
+    """Spaces calls at least `interval` seconds apart, across all threads."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
 
 class MLITApiClient:
-    """Client for MLIT Real Estate Information Library API."""
+    """Client for MLIT Real Estate Information Library API.
+
+    Safe to share between ingest workers: every request goes through one
+    rate limiter and one keep-alive connection pool.
+    """
 
     def __init__(self, api_key: str):
         self.api_key = api_key
+        self.rate_limiter = RateLimiter(MIN_REQUEST_INTERVAL)
         self.session = requests.Session()
         self.session.headers.update({"Ocp-Apim-Subscription-Key": api_key})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=INGEST_WORKERS)
+        self.session.mount("https://", adapter)
 
     def get_transactions(
         self,
@@ -127,6 +163,7 @@ class MLITApiClient:
         if station:
             params["station"] = station
 
+        self.rate_limiter.wait()
         try:
             resp = self.session.get(
                 f"{MLIT_API_BASE}/XIT001",
@@ -152,6 +189,12 @@ API_KEY = os.environ.get("MLIT_API_KEY", "YOUR_API_KEY_HERE")
 REQUESTS_PER_SECOND = 2
 MIN_REQUEST_INTERVAL = 1.0 / REQUESTS_PER_SECOND
 
+# Fetch workers; the rate limiter above still caps the API at 2 req/s, the
+# pool just keeps requests in flight while earlier ones wait on the network.
+INGEST_WORKERS = 8
+# Fetched-but-unloaded batches allowed to queue up if the database falls behind
+MAX_PENDING_FETCHES = 2 * INGEST_WORKERS
+
 PROPERTY_TYPE_MAP = {
     "Pre-owned Condominiums": 1,
     "Pre-owned Condominiums, etc.": 1,
@@ -168,7 +211,21 @@ PROPERTY_TYPE_MAP = {
     "Factory": 10,
 }
 
+# Fallback for labels that differ from the map only in case or spacing
+PROPERTY_TYPE_MAP_NORMALIZED = {k.strip().lower(): v for k, v in PROPERTY_TYPE_MAP.items()}
+
 
+# Japanese era (wareki) offsets: era year N is Gregorian offset + N
+ERA_OFFSETS = {
+    "令和": 2018, "Reiwa": 2018,
+    "平成": 1988, "Heisei": 1988,
+    "昭和": 1925, "Showa": 1925,
+}
+ERA_YEAR_RE = re.compile(r"(令和|Reiwa|平成|Heisei|昭和|Showa)\D*(\d+)")
+
+
+# Building-year strings repeat heavily (a few hundred distinct values per run)
+@lru_cache(maxsize=4096)
 def parse_building_year(year_str: str) -> Optional[int]:
     if not year_str:
         return None
@@ -178,25 +235,9 @@ def parse_building_year(year_str: str) -> Optional[int]:
             return year
     except (ValueError, TypeError):
         pass
-    year_str = str(year_str)
-    if "令和" in year_str or "Reiwa" in year_str:
-        try:
-            num = int(''.join(filter(str.isdigit, year_str)))
-            return 2018 + num
-        except ValueError:
-            pass
-    elif "平成" in year_str or "Heisei" in year_str:
-        try:
-            num = int(''.join(filter(str.isdigit, year_str)))
-            return 1988 + num
-        except ValueError:
-            pass
-    elif "昭和" in year_str or "Showa" in year_str:
-        try:
-            num = int(''.join(filter(str.isdigit, year_str)))
-            return 1925 + num
-        except ValueError:
-            pass
+    match = ERA_YEAR_RE.search(str(year_str))
+    if match:
+        return ERA_OFFSETS[match.group(1)] + int(match.group(2))
     return None
 
 
@@ -216,32 +257,36 @@ def parse_quarter_from_period(period: str) -> Optional[int]:
     return None
 
 
+DROP_THOUSANDS_SEPARATORS = str.maketrans("", "", ",")
+
+
+@lru_cache(maxsize=16384)
 def parse_numeric(value: Any) -> Optional[float]:
     if value is None or value == "":
         return None
     if isinstance(value, (int, float)):
         return float(value)
     try:
-        cleaned = str(value).replace(",", "").strip()
-        if cleaned:
-            return float(cleaned)
+        # float() already ignores surrounding whitespace; blank strings raise
+        return float(str(value).translate(DROP_THOUSANDS_SEPARATORS))
     except (ValueError, TypeError):
-        pass
-    return None
+        return None
+
+
+# Fields identifying a record; changing them or their order changes every source_hash
+HASH_KEY_FIELDS = (
+    "MunicipalityCode", "DistrictName", "TradePrice", "Area",
+    "Period", "BuildingYear", "Type",
+)
 
 
 def generate_record_hash(record: Dict[str, Any]) -> str:
-    key_fields = [
-        record.get("MunicipalityCode"),
-        record.get("DistrictName"),
-        record.get("TradePrice"),
-        record.get("Area"),
-        record.get("Period"),
-        record.get("BuildingYear"),
-        record.get("Type"),
-    ]
-    key_string = "|".join(str(f) for f in key_fields)
-    return hashlib.sha256(key_string.encode()).hexdigest()[:32]
+    # Incremental equivalent of sha256("|".join(str(field) ...)), without the joined copy
+    digest = hashlib.sha256(str(record.get(HASH_KEY_FIELDS[0])).encode())
+    for field in HASH_KEY_FIELDS[1:]:
+        digest.update(b"|")
+        digest.update(str(record.get(field)).encode())
+    return digest.hexdigest()[:32]
 
 
 def transform_record(
@@ -259,7 +304,10 @@ def transform_record(
         municipality_code = None
 
     property_type_raw = record.get("Type", "")
-    property_type_id = PROPERTY_TYPE_MAP.get(property_type_raw)
+    property_type_id = (
+        PROPERTY_TYPE_MAP.get(property_type_raw)
+        or PROPERTY_TYPE_MAP_NORMALIZED.get((property_type_raw or "").strip().lower())
+    )
 
     trade_price = parse_numeric(record.get("TradePrice"))
     unit_price = parse_numeric(record.get("UnitPrice"))
@@ -307,146 +355,329 @@ def get_db_connection():
     return psycopg2.connect(DATABASE_URL)
 
 
-def ensure_prefecture_exists(conn, code: str, name_en: str):
+def refresh_materialized_views(conn):
+    """Rebuild the dashboard rollups so newly imported transactions show up."""
+    print("\nRefreshing materialized views...")
     with conn.cursor() as cur:
-        cur.execute("""
-            INSERT INTO prefectures (code, name_ja, name_en)
-            VALUES (%s, %s, %s)
-            ON CONFLICT (code) DO NOTHING
-        """, (code, name_en, name_en))
+        cur.execute("SELECT refresh_materialized_views()")
     conn.commit()
 
 
-def ensure_municipality_exists(conn, code: str, prefecture_code: str, name: str):
-    if not code or len(code) != 5:
-        return
+def prepare_bulk_load(conn):
+    """
+    Drop the non-unique indexes on transactions for a --full --bulk-load run.
+    The source_hash unique index stays for ON CONFLICT.
+
+    Each definition is saved to bulk_load_dropped_indexes in the same transaction
+    as its DROP, so a run killed before finish_bulk_load leaves a record that the
+    next start-up replays (see main).
+    """
     with conn.cursor() as cur:
         cur.execute("""
-            INSERT INTO municipalities (code, prefecture_code, name_ja, name_en)
-            VALUES (%s, %s, %s, %s)
-            ON CONFLICT (code) DO NOTHING
-        """, (code, prefecture_code, name, name))
+            CREATE TABLE IF NOT EXISTS bulk_load_dropped_indexes (
+                index_name  TEXT PRIMARY KEY,
+                definition  TEXT NOT NULL,
+                dropped_at  TIMESTAMPTZ DEFAULT NOW()
+            )
+        """)
+        cur.execute("""
+            SELECT x.indexrelid::regclass::text, pg_get_indexdef(x.indexrelid)
+            FROM pg_index x
+            WHERE x.indrelid = 'transactions'::regclass
+              AND NOT x.indisunique
+              AND NOT x.indisprimary
+        """)
+        indexes = cur.fetchall()
+        print(f"\nBulk load: dropping {len(indexes)} secondary indexes on transactions")
+        for name, definition in indexes:
+            print(f"  {definition}")
+            cur.execute("""
+                INSERT INTO bulk_load_dropped_indexes (index_name, definition)
+                VALUES (%s, %s)
+                ON CONFLICT (index_name) DO NOTHING
+            """, (name, definition))
+            cur.execute(f"DROP INDEX IF EXISTS {name}")
+        # Per-job commits need not wait for the WAL flush; a crash only loses
+        # the last few jobs, which the next run re-fetches
+        cur.execute("SET synchronous_commit = off")
+    conn.commit()
+
+
+def pending_bulk_load_indexes(conn) -> List[tuple]:
+    """(index_name, definition) rows dropped by a bulk load and not yet rebuilt."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass('bulk_load_dropped_indexes')")
+        if cur.fetchone()[0] is None:
+            pending = []
+        else:
+            cur.execute("SELECT index_name, definition FROM bulk_load_dropped_indexes ORDER BY index_name")
+            pending = cur.fetchall()
     conn.commit()
+    return pending
+
+
+def finish_bulk_load(conn) -> List[str]:
+    """
+    Rebuild every index recorded in bulk_load_dropped_indexes, without blocking
+    readers. Each index is built on its own; one failure is reported and the
+    rest still get built. Returns the names that failed (they stay recorded).
+    """
+    conn.rollback()  # jobs commit as they go; this only clears a failed one
+    pending = pending_bulk_load_indexes(conn)
+    if not pending:
+        return []
+
+    print(f"\nBulk load: rebuilding {len(pending)} indexes...")
+    failed = []
+    conn.autocommit = True  # CREATE INDEX CONCURRENTLY cannot run in a transaction
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SET synchronous_commit = on")
+            cur.execute("SET maintenance_work_mem = '1GB'")
+            for name, definition in pending:
+                try:
+                    # An interrupted concurrent build leaves an invalid index behind
+                    cur.execute("""
+                        SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)
+                    """, (name,))
+                    row = cur.fetchone()
+                    if row and row[0]:
+                        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+                    cur.execute(definition.replace(
+                        "CREATE INDEX ", "CREATE INDEX CONCURRENTLY IF NOT EXISTS ", 1
+                    ))
+                    cur.execute("DELETE FROM bulk_load_dropped_indexes WHERE index_name = %s", (name,))
+                    print(f"  {name}: rebuilt")
+                except psycopg2.Error as e:
+                    failed.append(name)
+                    print(f"  {name}: FAILED: {e}".rstrip())
+            cur.execute("RESET maintenance_work_mem")
+    finally:
+        conn.autocommit = False
+
+    if failed:
+        print(f"\nBulk load: {len(failed)} index(es) not rebuilt: {', '.join(failed)}")
+        print("Their definitions stay in bulk_load_dropped_indexes; the next run retries them.")
+    return failed
+
 
+# Codes already in the reference tables; loaded once per process, since codes
+# never disappear and only this process adds new ones during a run
+_known_prefectures: set = set()
+_known_municipalities: Optional[set] = None
 
-def insert_transactions(conn, records: List[Dict[str, Any]], prefecture_code: str) -> int:
+
+def get_known_municipalities(cur) -> set:
+    global _known_municipalities
+    if _known_municipalities is None:
+        cur.execute("SELECT code FROM municipalities")
+        _known_municipalities = {row[0] for row in cur.fetchall()}
+    return _known_municipalities
+
+
+def forget_known_codes():
+    """Drop the code caches after a rollback may have undone their inserts."""
+    global _known_municipalities
+    _known_prefectures.clear()
+    _known_municipalities = None
+
+
+def ensure_prefecture_exists(cur, code: str, name_en: str):
+    """Insert the prefecture if new; the caller commits."""
+    if code in _known_prefectures:
+        return
+    cur.execute("""
+        INSERT INTO prefectures (code, name_ja, name_en)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (code) DO NOTHING
+    """, (code, name_en, name_en))
+    _known_prefectures.add(code)
+
+
+TRANSACTION_COLUMNS = (
+    "source_hash", "price_classification", "prefecture_code",
+    "municipality_code", "district_name", "property_type_id",
+    "property_type_raw", "trade_price", "unit_price", "area_m2",
+    "total_floor_area_m2", "floor_plan", "building_year", "structure",
+    "land_shape", "frontage_m", "road_direction", "road_type",
+    "road_width_m", "city_planning", "coverage_ratio", "floor_area_ratio",
+    "transaction_year", "transaction_quarter", "transaction_period",
+    "renovation", "remarks",
+)
+
+# transform_record always emits every column, so one C-level getter pulls a row
+transaction_row = itemgetter(*TRANSACTION_COLUMNS)
+
+# Written for None so empty strings survive COPY as '' rather than NULL
+COPY_NULL = "\\N"
+
+
+def insert_transactions(cur, records: List[Dict[str, Any]], prefecture_code: str) -> int:
+    """Load one batch on the caller's cursor; the caller commits."""
     if not records:
         return 0
 
-    # First, ensure all municipalities exist
-    seen_municipalities = set()
-    for record in records:
-        muni_code = record.get("municipality_code")
-        muni_name = record.get("municipality_name", "")
-        if muni_code and muni_code not in seen_municipalities:
-            ensure_municipality_exists(conn, muni_code, prefecture_code, muni_name)
-            seen_municipalities.add(muni_code)
-
-    columns = [
-        "source_hash", "price_classification", "prefecture_code",
-        "municipality_code", "district_name", "property_type_id",
-        "property_type_raw", "trade_price", "unit_price", "area_m2",
-        "total_floor_area_m2", "floor_plan", "building_year", "structure",
-        "land_shape", "frontage_m", "road_direction", "road_type",
-        "road_width_m", "city_planning", "coverage_ratio", "floor_area_ratio",
-        "transaction_year", "transaction_quarter", "transaction_period",
-        "renovation", "remarks"
-    ]
-
-    values = [
-        tuple(record.get(col) for col in columns)
+    # First, ensure all municipalities exist (one statement, committed with the batch)
+    known_municipalities = get_known_municipalities(cur)
+    municipalities = {
+        record["municipality_code"]: record.get("municipality_name", "")
         for record in records
-    ]
+        if record.get("municipality_code")
+        and record["municipality_code"] not in known_municipalities
+    }
 
-    insert_sql = f"""
-        INSERT INTO transactions ({', '.join(columns)})
-        VALUES %s
+    # COPY into a session-local staging table, then one INSERT ... SELECT into
+    # transactions so duplicates are still skipped by ON CONFLICT
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for record in records:
+        writer.writerow([
+            COPY_NULL if value is None else value
+            for value in transaction_row(record)
+        ])
+    buffer.seek(0)
+
+    column_list = ', '.join(TRANSACTION_COLUMNS)
+    if municipalities:
+        execute_values(cur, """
+            INSERT INTO municipalities (code, prefecture_code, name_ja, name_en)
+            VALUES %s
+            ON CONFLICT (code) DO NOTHING
+        """, [(code, prefecture_code, name, name) for code, name in municipalities.items()])
+
+    cur.execute(f"""
+        CREATE TEMP TABLE IF NOT EXISTS transactions_stage
+        ON COMMIT DELETE ROWS
+        AS SELECT {column_list} FROM transactions WITH NO DATA
+    """)
+    cur.copy_expert(
+        f"COPY transactions_stage ({column_list}) FROM STDIN WITH (FORMAT CSV, NULL '{COPY_NULL}')",
+        buffer
+    )
+    cur.execute(f"""
+        INSERT INTO transactions ({column_list})
+        SELECT {column_list} FROM transactions_stage
         ON CONFLICT (source_hash) DO NOTHING
-    """
+    """)
+    known_municipalities.update(municipalities)
+    return cur.rowcount
 
-    with conn.cursor() as cur:
-        execute_values(cur, insert_sql, values, page_size=1000)
-        inserted = cur.rowcount
 
+def fetch_period(
+    client: MLITApiClient,
+    prefecture_code: str,
+    year: int,
+    quarter: Optional[int] = None
+) -> Optional[List[Dict[str, Any]]]:
+    """Fetch and transform one prefecture/period; None if not yet published."""
+    transactions = client.get_transactions(
+        year=year,
+        area=prefecture_code,
+        quarter=quarter,  # None fetches the whole year in one call (4x faster)
+        language="en"
+    )
+    if transactions is None:
+        return None
+    # Transform in place so each raw dict is released as soon as it is converted,
+    # instead of holding the raw and transformed lists side by side
+    for i, transaction in enumerate(transactions):
+        transactions[i] = transform_record(transaction, prefecture_code, year, quarter)
+    return transactions
+
+
+def load_checkpoints(conn) -> set:
+    """(prefecture_code, year, quarter) jobs a previous --full run finished; quarter 0 = whole year."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS ingest_checkpoints (
+                prefecture_code CHAR(2) NOT NULL,
+                year            SMALLINT NOT NULL,
+                quarter         SMALLINT NOT NULL,
+                record_count    INTEGER NOT NULL,
+                completed_at    TIMESTAMPTZ DEFAULT NOW(),
+                PRIMARY KEY (prefecture_code, year, quarter)
+            )
+        """)
+        cur.execute("SELECT prefecture_code, year, quarter FROM ingest_checkpoints")
+        done = set(cur.fetchall())
     conn.commit()
-    return inserted
+    return done
+
+
+def save_checkpoint(cur, prefecture_code: str, year: int, quarter: Optional[int], record_count: int):
+    cur.execute("""
+        INSERT INTO ingest_checkpoints (prefecture_code, year, quarter, record_count)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (prefecture_code, year, quarter)
+        DO UPDATE SET record_count = EXCLUDED.record_count, completed_at = NOW()
+    """, (prefecture_code, year, quarter or 0, record_count))
 
 
-def ingest_prefecture_year(
+def ingest_periods(
     client: MLITApiClient,
     conn,
-    prefecture_code: str,
-    year: int,
-    quarters: Optional[List[int]] = None
+    jobs: List[tuple],
+    checkpoint_before_year: Optional[int] = None
 ) -> int:
-    total_inserted = 0
+    """
+    Ingest (prefecture_code, year, quarter) jobs.
 
-    pref_name = next(
-        (k for k, v in PREFECTURE_CODES.items() if v == prefecture_code and k.isascii()),
-        f"Prefecture {prefecture_code}"
-    )
-    ensure_prefecture_exists(conn, prefecture_code, pref_name)
+    Fetches (with transform) run on a thread pool; inserts stay on the
+    calling thread, in completion order, on one cursor with one commit per
+    job. At most MAX_PENDING_FETCHES jobs are in flight, so a slow database
+    throttles fetching instead of piling batches up in memory. Jobs for years
+    before `checkpoint_before_year` are checkpointed in the same commit.
+    """
+    total_inserted = 0
+    cur = conn.cursor()
 
-    # If no specific quarters requested, fetch all at once (4x faster)
-    if quarters is None:
-        print(f"    All quarters...", end=" ", flush=True)
+    for prefecture_code in sorted({job[0] for job in jobs}):
+        pref_name = PREFECTURE_NAMES_EN.get(prefecture_code, f"Prefecture {prefecture_code}")
+        ensure_prefecture_exists(cur, prefecture_code, pref_name)
+    conn.commit()
 
-        try:
-            transactions = client.get_transactions(
-                year=year,
-                area=prefecture_code,
-                quarter=None,  # Omit quarter to get all
-                language="en"
-            )
+    with ThreadPoolExecutor(max_workers=INGEST_WORKERS) as executor:
+        pending = {}
+        remaining = iter(jobs)
 
-            if transactions is None:
-                print("not yet available")
-            elif transactions:
-                records = [
-                    transform_record(t, prefecture_code, year, None)
-                    for t in transactions
-                ]
-                inserted = insert_transactions(conn, records, prefecture_code)
-                total_inserted += inserted
-                print(f"{len(transactions)} fetched, {inserted} new")
-            else:
-                print("0 records")
+        def submit_next():
+            job = next(remaining, None)
+            if job is not None:
+                pending[executor.submit(fetch_period, client, *job)] = job
 
-        except Exception as e:
-            print(f"Error: {e}")
+        for _ in range(MAX_PENDING_FETCHES):
+            submit_next()
 
-        time.sleep(MIN_REQUEST_INTERVAL)
-    else:
-        # Fetch specific quarters one by one
-        for quarter in quarters:
-            print(f"    Q{quarter}...", end=" ", flush=True)
+        while pending:
+            future = next(iter(wait(pending, return_when=FIRST_COMPLETED).done))
+            prefecture_code, year, quarter = pending.pop(future)
+            submit_next()
+            label = f"  [{prefecture_code}] {year} " + (f"Q{quarter}" if quarter else "all quarters")
 
             try:
-                transactions = client.get_transactions(
-                    year=year,
-                    area=prefecture_code,
-                    quarter=quarter,
-                    language="en"
-                )
-
-                if transactions is None:
-                    print("not yet available")
-                elif transactions:
-                    records = [
-                        transform_record(t, prefecture_code, year, quarter)
-                        for t in transactions
-                    ]
-                    inserted = insert_transactions(conn, records, prefecture_code)
-                    total_inserted += inserted
-                    print(f"{len(transactions)} fetched, {inserted} new")
+                records = future.result()
+
+                if records is None:
+                    print(f"{label}: not yet available")
+                    continue
+
+                inserted = insert_transactions(cur, records, prefecture_code)
+                if checkpoint_before_year and year < checkpoint_before_year:
+                    save_checkpoint(cur, prefecture_code, year, quarter, len(records))
+                conn.commit()
+                total_inserted += inserted
+                if records:
+                    print(f"{label}: {len(records)} fetched, {inserted} new")
                 else:
-                    print("0 records")
+                    print(f"{label}: 0 records")
 
             except Exception as e:
-                print(f"Error: {e}")
-
-            time.sleep(MIN_REQUEST_INTERVAL)
+                # A failed statement aborts the transaction; clear it so later jobs can load
+                conn.rollback()
+                forget_known_codes()
+                print(f"{label}: Error: {e}")
 
+    cur.close()
     return total_inserted
 
 
@@ -454,29 +685,31 @@ def ingest_full_history(
     client: MLITApiClient,
     conn,
     start_year: int = 2005,
-    prefectures: Optional[List[str]] = None
+    prefectures: Optional[List[str]] = None,
+    force: bool = False
 ):
     current_year = datetime.now().year
     years = range(start_year, current_year + 1)
 
     if prefectures is None:
-        prefectures = sorted(set(PREFECTURE_CODES.values()))
-
-    total = 0
-
-    for prefecture_code in prefectures:
-        pref_name = next(
-            (k for k, v in PREFECTURE_CODES.items() if v == prefecture_code and k.isascii()),
-            prefecture_code
-        )
-        print(f"\n{'='*60}")
-        print(f"Prefecture: {pref_name} ({prefecture_code})")
-        print('='*60)
-
-        for year in years:
-            print(f"\n  Year {year}:")
-            inserted = ingest_prefecture_year(client, conn, prefecture_code, year)
-            total += inserted
+        prefectures = ALL_PREFECTURES
+
+    # Last year's Q4 is still being published and late filings trickle in, so
+    # only years before that are checkpointed; recent years are always re-fetched
+    settled_before = current_year - 1
+    done = load_checkpoints(conn)
+
+    print(f"\nImporting {len(prefectures)} prefecture(s), {years.start}-{years.stop - 1}")
+    jobs = [
+        (prefecture_code, year, None)
+        for prefecture_code in prefectures
+        for year in years
+        if force or (prefecture_code, year, 0) not in done
+    ]
+    skipped = len(prefectures) * len(years) - len(jobs)
+    if skipped:
+        print(f"Skipping {skipped} prefecture-years already loaded (use --force to re-fetch)")
+    total = ingest_periods(client, conn, jobs, checkpoint_before_year=settled_before)
 
     print(f"\n{'='*60}")
     print(f"COMPLETE: {total:,} total records inserted")
@@ -504,7 +737,6 @@ def find_latest_available_quarter(client: MLITApiClient) -> tuple:
         if quarter == 0:
             quarter = 4
             year -= 1
-        time.sleep(0.5)
 
     return (None, None)
 
@@ -519,20 +751,10 @@ def ingest_incremental(client: MLITApiClient, conn):
 
     print(f"\nIncremental update: {year} Q{quarter}")
 
-    prefectures = sorted(set(PREFECTURE_CODES.values()))
-    total = 0
-
-    for prefecture_code in prefectures:
-        pref_name = next(
-            (k for k, v in PREFECTURE_CODES.items() if v == prefecture_code and k.isascii()),
-            prefecture_code
-        )
-        print(f"\n{pref_name}:", end=" ")
-
-        inserted = ingest_prefecture_year(
-            client, conn, prefecture_code, year, quarters=[quarter]
-        )
-        total += inserted
+    prefectures = ALL_PREFECTURES
+    total = ingest_periods(
+        client, conn, [(prefecture_code, year, quarter) for prefecture_code in prefectures]
+    )
 
     print(f"\n\nTotal inserted: {total:,}")
 
@@ -547,33 +769,40 @@ def ingest_incremental(client: MLITApiClient, conn):
 
 FX_API_BASE = "https://api.frankfurter.app"
 FX_CURRENCIES = ["USD", "EUR", "GBP"]
+FX_FETCH_WORKERS = 8
+FX_FALLBACK_DAYS = 7  # how far back to look when a date has no rate (weekend/holiday)
 
+# Shared keep-alive pool for the FX workers; transient failures are retried by urllib3
+_fx_session = requests.Session()
+_fx_session.mount("https://", HTTPAdapter(
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504]),
+    pool_connections=1,
+    pool_maxsize=FX_FETCH_WORKERS,
+))
 
-def fetch_fx_rate(rate_date: date, currency: str, max_retries: int = 3) -> Optional[float]:
+
+def fetch_fx_rate(rate_date: date, currency: str) -> Optional[float]:
     """Fetch FX rate for a specific date and currency from Frankfurter API."""
-    for attempt in range(max_retries):
+    for days_back in range(FX_FALLBACK_DAYS + 1):
+        day = rate_date - timedelta(days=days_back)
         try:
-            resp = requests.get(
-                f"{FX_API_BASE}/{rate_date.isoformat()}",
+            resp = _fx_session.get(
+                f"{FX_API_BASE}/{day.isoformat()}",
                 params={"from": "JPY", "to": currency},
                 timeout=10
             )
-
-            if resp.status_code == 200:
-                data = resp.json()
-                if 'rates' in data and currency in data['rates']:
-                    return data['rates'][currency]
-            elif resp.status_code == 404:
-                # Date not available (weekend/holiday) - try previous day
-                from datetime import timedelta
-                alt_date = rate_date - timedelta(days=1)
-                return fetch_fx_rate(alt_date, currency, max_retries=1)
-
         except requests.RequestException as e:
-            if attempt < max_retries - 1:
-                time.sleep(1)
-                continue
             print(f"  Warning: Failed to fetch {currency} for {rate_date}: {e}")
+            return None
+
+        if resp.status_code == 404:
+            # Date not available (weekend/holiday) - try previous day
+            continue
+        if resp.status_code == 200:
+            data = resp.json()
+            if 'rates' in data and currency in data['rates']:
+                return data['rates'][currency]
+        return None
 
     return None
 
@@ -592,34 +821,33 @@ def refresh_fx_rates(conn, start_year: int = 2005):
                 continue
             quarters_to_check.append((year, quarter))
 
-    # Check which rates are missing
+    # Check which rates are missing (one query, diffed locally)
     cur = conn.cursor()
+    cur.execute("SELECT currency, year, quarter FROM fx_rates")
+    existing = set(cur.fetchall())
 
-    rates_to_insert = []
-    missing_count = 0
-
-    for year, quarter in quarters_to_check:
+    missing = [
         # Use mid-quarter date
-        month = (quarter - 1) * 3 + 2
-        rate_date = date(year, month, 15)
-
-        for currency in FX_CURRENCIES:
-            # Check if rate exists
-            cur.execute("""
-                SELECT rate FROM fx_rates
-                WHERE currency = %s AND year = %s AND quarter = %s
-            """, (currency, year, quarter))
+        (currency, year, quarter, date(year, (quarter - 1) * 3 + 2, 15))
+        for year, quarter in quarters_to_check
+        for currency in FX_CURRENCIES
+        if (currency, year, quarter) not in existing
+    ]
 
-            if cur.fetchone() is None:
-                missing_count += 1
-                # Fetch from API
-                rate = fetch_fx_rate(rate_date, currency)
+    rates_to_insert = []
 
-                if rate is not None:
-                    rates_to_insert.append((currency, year, quarter, rate, rate_date))
-                    print(f"  Fetched {year} Q{quarter} {currency}: {rate:.8f}")
+    with ThreadPoolExecutor(max_workers=FX_FETCH_WORKERS) as executor:
+        futures = {
+            executor.submit(fetch_fx_rate, rate_date, currency): (currency, year, quarter, rate_date)
+            for currency, year, quarter, rate_date in missing
+        }
+        for future in as_completed(futures):
+            currency, year, quarter, rate_date = futures[future]
+            rate = future.result()
 
-                time.sleep(0.2)  # Rate limiting
+            if rate is not None:
+                rates_to_insert.append((currency, year, quarter, rate, rate_date))
+                print(f"  Fetched {year} Q{quarter} {currency}: {rate:.8f}")
 
     # Insert new rates
     if rates_to_insert:
@@ -650,12 +878,22 @@ def main():
     parser.add_argument("--prefecture", type=str, help="Prefecture code (e.g., 13 for Tokyo)")
     parser.add_argument("--quarter", type=int, choices=[1, 2, 3, 4], help="Specific quarter (1-4)")
     parser.add_argument("--refresh-fx-only", action="store_true", help="Only refresh FX rates (no API key needed)")
+    parser.add_argument("--bulk-load", action="store_true",
+                        help="With --full: drop secondary indexes during the load and rebuild them after")
+    parser.add_argument("--force", action="store_true",
+                        help="With --full: re-fetch prefecture-years already checkpointed")
 
     args = parser.parse_args()
 
     conn = get_db_connection()
 
     try:
+        # A previous --bulk-load run died before rebuilding its indexes: rebuild them
+        # now, unless this run is another bulk load that will rebuild them at the end
+        if not args.bulk_load and pending_bulk_load_indexes(conn):
+            print("Found indexes dropped by an interrupted --bulk-load run")
+            finish_bulk_load(conn)
+
         # FX-only refresh doesn't need API key
         if args.refresh_fx_only:
             print("Refreshing FX rates...")
@@ -672,21 +910,33 @@ def main():
 
         if args.full:
             prefectures = [args.prefecture] if args.prefecture else None
-            ingest_full_history(client, conn, prefectures=prefectures)
+            if args.bulk_load:
+                prepare_bulk_load(conn)
+            try:
+                ingest_full_history(client, conn, prefectures=prefectures, force=args.force)
+            finally:
+                if args.bulk_load:
+                    finish_bulk_load(conn)
+            refresh_materialized_views(conn)
             # Also refresh FX rates after full import
             print("\nRefreshing FX rates...")
             refresh_fx_rates(conn)
 
         elif args.incremental:
             ingest_incremental(client, conn)
+            refresh_materialized_views(conn)
 
         elif args.year:
-            prefectures = [args.prefecture] if args.prefecture else sorted(set(PREFECTURE_CODES.values()))
+            prefectures = [args.prefecture] if args.prefecture else ALL_PREFECTURES
             quarters = [args.quarter] if args.quarter else None
 
-            for pref in prefectures:
-                print(f"\nImporting {args.year} for prefecture {pref}")
-                ingest_prefecture_year(client, conn, pref, args.year, quarters)
+            print(f"\nImporting {args.year} for {len(prefectures)} prefecture(s)")
+            ingest_periods(client, conn, [
+                (pref, args.year, quarter)
+                for pref in prefectures
+                for quarter in (quarters or [None])
+            ])
+            refresh_materialized_views(conn)
 
         else:
             parser.print_help()
@@ -46,11 +46,13 @@ CREATE TABLE stations (
     name_en     VARCHAR(100),
     municipality_code CHAR(5) REFERENCES municipalities(code),
     latitude    DECIMAL(9, 6),
-    longitude   DECIMAL(9, 6)
+    longitude   DECIMAL(9, 6),
+    display_name VARCHAR(100) GENERATED ALWAYS AS (COALESCE(name_en, name_ja)) STORED
 );
 
 CREATE INDEX idx_stations_municipality ON stations(municipality_code);
 CREATE INDEX idx_stations_name ON stations USING gin(name_ja gin_trgm_ops);
+CREATE INDEX idx_stations_display_name ON stations(code) INCLUDE (display_name);
 
 -- Station-Line junction
 CREATE TABLE station_lines (
@@ -94,6 +96,24 @@ CREATE TABLE fx_rates (
 
 CREATE INDEX idx_fx_rates_lookup ON fx_rates(year, quarter);
 
+-- Finished ingest_data.py --full jobs, so reruns resume (quarter 0 = whole year)
+CREATE TABLE ingest_checkpoints (
+    prefecture_code CHAR(2) NOT NULL,
+    year            SMALLINT NOT NULL,
+    quarter         SMALLINT NOT NULL,
+    record_count    INTEGER NOT NULL,
+    completed_at    TIMESTAMPTZ DEFAULT NOW(),
+    PRIMARY KEY (prefecture_code, year, quarter)
+);
+
+-- Indexes dropped by ingest_data.py --full --bulk-load and not yet rebuilt;
+-- replayed by the next ingest run if the bulk load was interrupted
+CREATE TABLE bulk_load_dropped_indexes (
+    index_name  TEXT PRIMARY KEY,
+    definition  TEXT NOT NULL,
+    dropped_at  TIMESTAMPTZ DEFAULT NOW()
+);
+
 -- =============================================================================
 -- MAIN TRANSACTION TABLE
 -- =============================================================================
@@ -155,6 +175,8 @@ CREATE TABLE transactions (
     price_category      VARCHAR(20),
     size_category       VARCHAR(20),
     age_category        VARCHAR(20),
+    area_bucket         SMALLINT,           -- 0: <40m2, 1: 40-70, 2: 70-100, 3: 100+
+    sample_bucket       SMALLINT,           -- pseudo-random 0-127 from id, for uniform samples
 
     -- Timestamps
     created_at          TIMESTAMPTZ DEFAULT NOW(),
@@ -182,14 +204,24 @@ CREATE INDEX idx_tx_trends ON transactions(
 ) INCLUDE (unit_price, trade_price)
 WHERE unit_price IS NOT NULL AND unit_price > 0 AND unit_price < 50000000;
 
+-- Prefecture-wide filters over a year range (no municipality selected). The predicate
+-- matches the app's valid-price filter verbatim so the planner can use the partial index.
+CREATE INDEX idx_tx_active ON transactions(prefecture_code, transaction_year)
+WHERE unit_price IS NOT NULL AND unit_price > 0 AND unit_price < 50000000;
+
 -- For property type filtering (common in valuation)
 CREATE INDEX idx_tx_property_type_raw ON transactions(property_type_raw);
 
--- For property type + location (valuation queries)
+-- For property type + location (valuation queries). Keyed through the quarter so the
+-- comparables' newest-first ORDER BY ... LIMIT walks the index backwards and stops early.
+-- The INCLUDE list covers the comparables query's columns, so it can run index-only
+-- on all-visible pages; recently loaded pages (until VACUUM) and queries reading other
+-- columns (t.id, the data-quality filter) still visit the heap.
 CREATE INDEX idx_tx_valuation ON transactions(
     municipality_code,
     property_type_raw,
-    transaction_year
+    transaction_year,
+    transaction_quarter
 ) INCLUDE (unit_price, trade_price, area_m2, building_year, floor_plan, district_name)
 WHERE unit_price IS NOT NULL AND unit_price > 0;
 
@@ -216,14 +248,28 @@ WHERE unit_price IS NOT NULL AND unit_price > 0;
 CREATE INDEX idx_tx_structure ON transactions(structure) WHERE structure IS NOT NULL;
 CREATE INDEX idx_tx_floor_plan ON transactions(floor_plan) WHERE floor_plan IS NOT NULL;
 CREATE INDEX idx_tx_district ON transactions(municipality_code, district_name) WHERE district_name IS NOT NULL;
+-- Substring (ILIKE '%...%') district search in the valuation comparables
+CREATE INDEX idx_tx_district_trgm ON transactions USING gin(district_name gin_trgm_ops) WHERE district_name IS NOT NULL;
+
+-- Index-only scans for district price aggregates (rankings, district trends)
+CREATE INDEX idx_tx_district_prices ON transactions(municipality_code, district_name)
+INCLUDE (unit_price, area_m2, trade_price)
+WHERE unit_price IS NOT NULL AND unit_price > 0 AND unit_price < 50000000;
 
 -- For year range queries
 CREATE INDEX idx_tx_year ON transactions(transaction_year);
+
+-- Raw Data keyset pagination: walked backwards for newest-first pages within a prefecture
+CREATE INDEX idx_tx_keyset ON transactions(prefecture_code, transaction_year, (COALESCE(transaction_quarter, 0)), id);
 CREATE INDEX idx_tx_building_year ON transactions(building_year) WHERE building_year IS NOT NULL AND building_year > 1900;
 
 -- For price/area range filters
 CREATE INDEX idx_tx_trade_price ON transactions(trade_price) WHERE trade_price IS NOT NULL;
 CREATE INDEX idx_tx_area ON transactions(area_m2) WHERE area_m2 IS NOT NULL;
+CREATE INDEX idx_tx_area_bucket ON transactions(area_bucket);
+
+-- Scatter samples: a prefix of sample buckets within a prefecture
+CREATE INDEX idx_tx_sample ON transactions(prefecture_code, sample_bucket);
 CREATE INDEX idx_tx_unit_price ON transactions(unit_price) WHERE unit_price IS NOT NULL AND unit_price > 0;
 
 -- =============================================================================
@@ -262,6 +308,20 @@ BEGIN
 END;
 $$ LANGUAGE plpgsql IMMUTABLE;
 
+-- Coarse size buckets the dashboard groups on (smallint keys instead of label text)
+CREATE OR REPLACE FUNCTION area_bucket(area DECIMAL)
+RETURNS SMALLINT AS $$
+BEGIN
+    RETURN CASE
+        WHEN area IS NULL THEN NULL
+        WHEN area < 40 THEN 0
+        WHEN area < 70 THEN 1
+        WHEN area < 100 THEN 2
+        ELSE 3
+    END;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+
 CREATE OR REPLACE FUNCTION categorize_age(age SMALLINT)
 RETURNS VARCHAR(20) AS $$
 BEGIN
@@ -290,6 +350,8 @@ BEGIN
 
     NEW.price_category := categorize_price(NEW.trade_price);
     NEW.size_category := categorize_area(NEW.area_m2);
+    NEW.area_bucket := area_bucket(NEW.area_m2);
+    NEW.sample_bucket := (hashint8(NEW.id) & 127)::SMALLINT;
 
     IF NEW.building_year IS NOT NULL AND NEW.transaction_year IS NOT NULL THEN
         NEW.building_age := NEW.transaction_year - NEW.building_year;
@@ -332,6 +394,9 @@ CREATE UNIQUE INDEX idx_mv_price_trends ON mv_price_trends(
     prefecture_code, municipality_code, property_type_raw, transaction_year, transaction_quarter
 );
 
+-- Map and latest-median lookups: prefecture + year range across all municipalities
+CREATE INDEX idx_mv_price_trends_year ON mv_price_trends(prefecture_code, transaction_year);
+
 -- Ward comparison stats (used by ward comparison tab)
 CREATE MATERIALIZED VIEW mv_ward_stats AS
 SELECT
@@ -404,6 +469,80 @@ SELECT
     MAX(building_year) FILTER (WHERE building_year > 1900) as max_building_year
 FROM transactions;
 
+-- Valid-price transactions, narrowed to the columns the ranking and trend queries use.
+-- Those queries read this instead of re-applying the price sanity clamp on transactions.
+CREATE MATERIALIZED VIEW mv_transactions_clean AS
+SELECT
+    id,
+    prefecture_code,
+    municipality_code,
+    district_name,
+    nearest_station_code,
+    property_type_raw,
+    transaction_year,
+    transaction_quarter,
+    unit_price
+FROM transactions
+WHERE unit_price IS NOT NULL
+  AND unit_price > 0
+  AND unit_price < 50000000;
+
+CREATE UNIQUE INDEX idx_mv_transactions_clean ON mv_transactions_clean(id);
+-- Covering index: the ward comparison's prefecture/year scans can run index-only
+CREATE INDEX idx_mv_transactions_clean_year ON mv_transactions_clean(prefecture_code, transaction_year, transaction_quarter)
+INCLUDE (municipality_code, property_type_raw, unit_price);
+CREATE INDEX idx_mv_transactions_clean_station ON mv_transactions_clean(nearest_station_code);
+CREATE INDEX idx_mv_transactions_clean_district ON mv_transactions_clean(district_name);
+
+-- Sidebar reference lists: dimension rows that actually have transactions, so the
+-- sidebar never scans transactions for coverage
+CREATE MATERIALIZED VIEW mv_municipalities_with_tx AS
+SELECT m.prefecture_code, m.code, COALESCE(m.name_en, m.name_ja) as name
+FROM municipalities m
+WHERE EXISTS (SELECT 1 FROM transactions t WHERE t.municipality_code = m.code);
+
+CREATE UNIQUE INDEX idx_mv_municipalities_with_tx ON mv_municipalities_with_tx(prefecture_code, code);
+
+CREATE MATERIALIZED VIEW mv_stations_with_tx AS
+SELECT m.prefecture_code, s.code, s.display_name as name
+FROM stations s
+JOIN municipalities m ON s.municipality_code = m.code
+WHERE EXISTS (SELECT 1 FROM transactions t WHERE t.nearest_station_code = s.code);
+
+CREATE UNIQUE INDEX idx_mv_stations_with_tx ON mv_stations_with_tx(prefecture_code, code);
+
+-- Districts for prefectures imported without municipality codes
+CREATE MATERIALIZED VIEW mv_prefecture_districts AS
+SELECT DISTINCT prefecture_code, district_name
+FROM transactions
+WHERE municipality_code IS NULL
+  AND district_name IS NOT NULL
+  AND district_name != '';
+
+CREATE UNIQUE INDEX idx_mv_prefecture_districts ON mv_prefecture_districts(prefecture_code, district_name);
+
+-- Yearly condo medians per ward and 10m² area bin (width_bucket(area_m2, 10, 200, 19)).
+-- Track Depreciation combines the few bins spanning its ±30% area window instead of
+-- sorting the ward's raw rows for every lookup.
+CREATE MATERIALIZED VIEW mv_condo_area_prices AS
+SELECT
+    municipality_code,
+    transaction_year,
+    width_bucket(area_m2::float8, 10, 200, 19) as area_bin,
+    PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY unit_price)::INTEGER as median_price_m2,
+    COUNT(*) as transaction_count
+FROM transactions
+WHERE property_type_raw = 'Pre-owned Condominiums, etc.'
+  AND municipality_code IS NOT NULL
+  AND unit_price IS NOT NULL
+  AND unit_price > 0
+  AND unit_price < 50000000
+  AND area_m2 IS NOT NULL
+  AND building_year IS NOT NULL
+GROUP BY municipality_code, transaction_year, area_bin;
+
+CREATE UNIQUE INDEX idx_mv_condo_area_prices ON mv_condo_area_prices(municipality_code, area_bin, transaction_year);
+
 -- =============================================================================
 -- REFRESH FUNCTION
 -- =============================================================================
@@ -415,6 +554,11 @@ BEGIN
     REFRESH MATERIALIZED VIEW CONCURRENTLY mv_ward_stats;
     REFRESH MATERIALIZED VIEW mv_filter_options;
     REFRESH MATERIALIZED VIEW mv_year_ranges;
+    REFRESH MATERIALIZED VIEW CONCURRENTLY mv_transactions_clean;
+    REFRESH MATERIALIZED VIEW CONCURRENTLY mv_municipalities_with_tx;
+    REFRESH MATERIALIZED VIEW CONCURRENTLY mv_stations_with_tx;
+    REFRESH MATERIALIZED VIEW CONCURRENTLY mv_prefecture_districts;
+    REFRESH MATERIALIZED VIEW CONCURRENTLY mv_condo_area_prices;
 END;
 $$ LANGUAGE plpgsql;
 